@@ -1,22 +1,30 @@
+import json
 import sys
+import time
+from . import pulp
+from . import util
 from .pulp import PulpServer
 from .config import PulpConfig
 from .atomic import Atomic
 
 __version__ = "1.2"
 
+# Images uploaded to pulp at a time.
+IMAGES_IN_FLIGHT = 2
+
 
 def writeOut(output, lf="\n"):
     sys.stdout.flush()
     sys.stdout.write(str(output) + lf)
 
 
-def push_image_to_pulp(image, server_url, username, password, verify_ssl,
-                       docker_client):
-    if not image:
-        raise ValueError("Image required")
+def _pulp_target(image, server_url):
+    """
+    Returns the pulp server URL, image name and repository of image, which
+    may name its own server.
+    """
     parts = image.split("/")
-    if parts > 1:
+    if len(parts) > 1:
         if parts[0].find(".") != -1:
             server_url = parts[0]
             image = ("/").join(parts[1:])
@@ -27,27 +35,141 @@ def push_image_to_pulp(image, server_url, username, password, verify_ssl,
 
     if not server_url.startswith("http"):
         server_url = "https://" + server_url
+    return server_url, image, repo
 
+
+def _pulp_server(server_url, username, password, verify_ssl, docker_client,
+                 images_in_flight, pool_size=None, connect_timeout=None,
+                 read_timeout=None, chunk_size=None, upload_workers=None,
+                 queue_depth=None, task_timeout=None,
+                 compression=pulp.COMPRESSION, compress_level=None,
+                 state_dir=None):
+    if upload_workers is None:
+        upload_workers = pulp.UPLOAD_WORKERS
+    timeout = (connect_timeout or pulp.CONNECT_TIMEOUT,
+               read_timeout or pulp.READ_TIMEOUT)
     try:
-        pulp = PulpServer(server_url=server_url, username=username,
+        return PulpServer(server_url=server_url, username=username,
                           password=password, verify_ssl=verify_ssl,
-                          docker_client=docker_client)
+                          docker_client=docker_client,
+                          pool_size=(pool_size or
+                                     upload_workers * images_in_flight),
+                          timeout=timeout,
+                          chunk_size=(pulp.CHUNK_SIZE if chunk_size is None
+                                      else chunk_size),
+                          upload_workers=upload_workers,
+                          queue_depth=queue_depth,
+                          task_timeout=task_timeout or pulp.TASK_TIMEOUT,
+                          compression=(None if compression == 'none'
+                                       else compression),
+                          compress_level=(pulp.COMPRESS_LEVEL
+                                          if compress_level is None
+                                          else compress_level),
+                          state_dir=state_dir or pulp.STATE_DIR)
     except Exception as e:
         raise IOError('Failed to initialize Pulp: {0}'.format(e))
 
-    try:
-        if not pulp.is_repo(repo):
-            pulp.create_repo(image, repo)
-    except Exception as e:
-        raise IOError('Failed to create Pulp repository: {0}'.format(e))
 
+def push_images_to_pulp(images, server_url, username, password, verify_ssl,
+                        docker_client, images_in_flight=IMAGES_IN_FLIGHT,
+                        resume=False, stats_file=None, **options):
+    """
+    Uploads images to pulp, through one session per pulp server, with at
+    most images_in_flight uploads at a time. Every repository is created
+    once, and published and exported once after all of its images are
+    uploaded. options are the tuning options of PulpServer, None for the
+    default. Raises IOError naming every image which failed, after the
+    others are done. If stats_file is given, the statistics of the uploads
+    to every server are written to it as JSON, failed or not.
+    """
+    if not images:
+        raise ValueError("Image required")
+    targets = {}
+    for image in images:
+        url, name, repo = _pulp_target(image, server_url)
+        targets.setdefault(url, []).append((name, repo))
+
+    failures = []
+    stats = {}
+    start = time.time()
     try:
-        writeOut('Uploading image "{0}" to pulp server "{1}"'
-                 ''.format(image, server_url))
-        pulp.upload_docker_image(image, repo)
-        writeOut("")
-    except Exception as e:
-        raise IOError('Failed to upload image to Pulp: {0}'.format(e))
+        for url in sorted(targets):
+            server = _pulp_server(url, username, password, verify_ssl,
+                                  docker_client, images_in_flight, **options)
+            try:
+                failures += _push_images_to_pulp(server, url, targets[url],
+                                                 images_in_flight, resume)
+            finally:
+                server.close()
+                stats[url] = server.stats.summary()
+    finally:
+        if stats_file:
+            with open(stats_file, 'w') as f:
+                json.dump({'images': len(images),
+                           'failures': len(failures),
+                           'seconds': time.time() - start,
+                           'servers': stats}, f, indent=4, sort_keys=True)
+    if failures:
+        raise IOError('Failed to upload to Pulp:\n' + '\n'.join(failures))
 
-    pulp.publish_repo(repo)
-    pulp.export_repo(repo)
+
+def push_image_to_pulp(image, server_url, username, password, verify_ssl,
+                       docker_client, resume=False, stats_file=None,
+                       **options):
+    push_images_to_pulp([image], server_url, username, password, verify_ssl,
+                        docker_client, images_in_flight=1, resume=resume,
+                        stats_file=stats_file, **options)
+
+
+def _push_images_to_pulp(server, server_url, uploads, images_in_flight,
+                         resume):
+    """
+    Returns a message for every image of uploads, a list of (image, repo),
+    which could not be uploaded, published or exported.
+    """
+    repo_errors = {}
+    for repo in sorted(set(r for _, r in uploads)):
+        image = [i for i, r in uploads if r == repo][0]
+        try:
+            server.ensure_repo(image, repo)
+        except Exception as e:
+            repo_errors[repo] = e
+
+    def _upload(upload):
+        image, repo = upload
+        if repo in repo_errors:
+            return '{0}: Failed to create Pulp repository: {1}'.format(
+                image, repo_errors[repo])
+        try:
+            if not server.is_repo(repo):
+                return '{0}: Pulp repository {1} does not exist'.format(
+                    image, repo)
+            writeOut('Uploading image "{0}" to pulp server "{1}"'
+                     ''.format(image, server_url))
+            server.upload_docker_image(image, repo, resume=resume)
+        except Exception as e:
+            return '{0}: Failed to upload image to Pulp: {1}'.format(image,
+                                                                     e)
+
+    results = util.parallel_map(_upload, uploads, images_in_flight)
+    failures = [f for f in results if f]
+    uploaded = sorted(set(r for (i, r), f in zip(uploads, results)
+                          if not f))
+
+    # Pulp runs the tasks of a repository in order, so publish and export
+    # of every repository are queued together and waited for at once.
+    try:
+        phases = {'publish': [], 'export': []}
+        for repo in uploaded:
+            phases['publish'] += server.publish_repo(repo, wait=False)
+            phases['export'] += server.export_repo(repo, wait=False)
+        finished = server.wait_for_tasks(phases['publish'] +
+                                         phases['export'])
+        for name, tasks in phases.items():
+            if tasks:
+                server.stats.add_phase(name, max(finished[t['_href']]
+                                                 for t in tasks))
+    except (pulp.PulpError, pulp.PulpTaskError) as e:
+        failures.append('Failed to publish Pulp repositories {0}: {1}'
+                        ''.format(', '.join(uploaded), e))
+    return failures
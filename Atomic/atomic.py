@@ -10,7 +10,11 @@ import pipes
 import pwd
 import time
 import math
+import re
 
+import Atomic.diff as diff
+import Atomic.images as images
+import Atomic.layers as layers
 import Atomic.mount as mount
 import Atomic.util as util
 
@@ -19,9 +23,6 @@ try:
 except ImportError:
     DEVNULL = open(os.devnull, 'wb')
 
-IMAGES = []
-
-
 def convert_size(size):
     if size > 0:
         size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
@@ -33,11 +34,8 @@ def convert_size(size):
     return '0B'
 
 
-def find_repo_tag(d, id):
-    global IMAGES
-    if len(IMAGES) == 0:
-        IMAGES = d.images()
-    for image in IMAGES:
+def find_repo_tag(images, id):
+    for image in images:
         if id == image["Id"]:
             return image["RepoTags"][0]
     return ""
@@ -95,6 +93,8 @@ class Atomic(object):
         self.inspect = None
         self.force = False
         self._images = []
+        # The listing of images tags are looked up in, taken once.
+        self._listing = None
 
     def writeOut(self, output, lf="\n"):
         sys.stdout.flush()
@@ -152,26 +152,61 @@ class Atomic(object):
             self.args.password = getpass.getpass("Registry Password: ")
 
         if self.args.pulp:
-            return push_image_to_pulp(self.image, self.args.url,
-                                      self.args.username, self.args.password,
-                                      self.args.verify_ssl, self.d)
+            from Atomic import push_images_to_pulp
+            from Atomic.config import PulpConfig
+            config = PulpConfig().config()
+            return push_images_to_pulp(
+                self.args.images, self.args.url, self.args.username,
+                self.args.password, self.args.verify_ssl, self.d,
+                images_in_flight=self.args.parallel_images,
+                pool_size=config["pool_size"],
+                connect_timeout=config["connect_timeout"],
+                read_timeout=config["read_timeout"],
+                chunk_size=self.args.chunk_size,
+                upload_workers=self.args.upload_workers,
+                queue_depth=config["queue_depth"],
+                resume=self.args.resume,
+                stats_file=self.args.stats_file,
+                task_timeout=config["task_timeout"],
+                compression=self.args.compression,
+                compress_level=self.args.compress_level)
         else:
             self.d.login(self.args.username, self.args.password)
-            for line in self.d.push(self.image, stream=True):
-                bar = json.loads(line)
-                status = bar['status']
-                if prevstatus != status:
-                    self.writeOut(status, "")
-                if 'id' not in bar:
-                    continue
-                if status == "Uploading":
-                    self.writeOut(bar['progress'] + " ")
-                elif status == "Push complete":
-                    pass
-                elif status.startswith("Pushing"):
-                    self.writeOut("Pushing: " + bar['id'])
-
-                prevstatus = status
+            digests = {}
+            for image in self.args.images:
+                for line in self.d.push(image, stream=True):
+                    bar = json.loads(line)
+                    if 'error' in bar:
+                        raise ValueError(bar['error'])
+                    # The registry checks every layer against its digest
+                    # as it arrives, and reports that of the manifest.
+                    if 'aux' in bar:
+                        digests[image] = {'digest': bar['aux']['Digest']}
+                        continue
+                    status = bar['status']
+                    match = re.search(r'digest: (sha256:[0-9a-f]+)', status)
+                    if match:
+                        digests[image] = {'digest': match.group(1)}
+                    if prevstatus != status:
+                        self.writeOut(status, "")
+                    if 'id' not in bar:
+                        continue
+                    if status == "Uploading":
+                        self.writeOut(bar['progress'] + " ")
+                    elif status == "Push complete":
+                        pass
+                    elif status.startswith("Pushing"):
+                        self.writeOut("Pushing: " + bar['id'])
+
+                    prevstatus = status
+                if image in digests:
+                    self.writeOut("")
+                    self.writeOut("Pushed {0} as {1}".format(
+                        image, digests[image]['digest']))
+            if self.args.stats_file:
+                with open(self.args.stats_file, 'w') as f:
+                    json.dump({'images': digests}, f, indent=4,
+                              sort_keys=True)
 
     def set_args(self, args):
         self.args = args
@@ -620,9 +655,14 @@ class Atomic(object):
         version = ("%s-%s-%s" % (get_label("Name"), get_label("Version"),
                                  get_label("Release"))).strip("-")
         return({"Id": image['Id'], "Name": get_label("Name"),
-                "Version": version, "Tag": find_repo_tag(self.d, image['Id']),
+                "Version": version, "Tag": self._find_repo_tag(image['Id']),
                 "Parent": image['Parent']})
 
+    def _find_repo_tag(self, id):
+        if self._listing is None:
+            self._listing = self.d.images()
+        return find_repo_tag(self._listing, id)
+
     def get_layers(self):
         layers = []
         layer = self._get_layer(self.image)
@@ -639,7 +679,7 @@ class Atomic(object):
         return {"Id": image['Id'], "Name": get_label("Name"),
                 "Version": ("%s-%s-%s" % (get_label("Name"),
                                           get_label("Version"),
-                                          get_label("Release"))).strip(":"),
+                                          get_label("Release"))).strip("-"),
                 "Tag": image["RepoTags"][0]}
 
     def get_images(self):
@@ -653,40 +693,11 @@ class Atomic(object):
         return self._images
 
     def verify(self):
-        def get_label(label):
-            val = self._get_args(label)
-            if val:
-                return val[0]
-            return ""
         self.inspect = self._inspect_image()
         if not self.inspect:
             raise ValueError("Image %s does not exist" % self.image)
-        current_name = get_label("Name")
-        version = ""
-        if current_name:
-            version = "%s-%s-%s" % (current_name, get_label("Version"),
-                                    get_label("Release"))
-
-        name = None
-        buf = ""
-        for layer in self.get_layers():
-            if name == layer["Name"]:
-                continue
-            name = layer["Name"]
-            if len(name) > 0:
-                for i in self.get_images():
-                    if i["Name"] == name:
-                        if i["Version"] > layer["Version"]:
-                            buf = ("Image '%s' contains a layer '%s' that is "
-                                   "out of date.\nImage version '%s' is "
-                                   "available, current version could contain "
-                                   "vulnerabilities." % (self.image,
-                                                         layer["Version"],
-                                                         i["Version"]))
-                            buf += ("You should rebuild the '%s' image using "
-                                    "docker build." % (self.image))
-                            break
-        return buf
+        return images.ImageIndex(self.d).verify(self.inspect["Id"],
+                                                self.image)
 
     def print_verify(self):
         self.writeOut(self.verify())
@@ -694,16 +705,31 @@ class Atomic(object):
     def mount(self):
         if os.geteuid() != 0:
             raise ValueError("This command must be run as root.")
+        if len(self.args.images) > 1 and not self.args.many:
+            raise ValueError("Use --many to mount more than one "
+                             "image/container.")
         try:
             options = [opt for opt in self.args.options.split(',') if opt]
-            mount.DockerMount(self.args.mountpoint,
-                              self.args.live).mount(self.args.image, options)
+            if self.args.many:
+                mountpoints = mount.DockerMount.mount_many(
+                    self.args.images, self.args.mountpoint, options,
+                    self.args.live)
+            else:
+                mount.DockerMount(self.args.mountpoint,
+                                  self.args.live).mount(self.args.images[0],
+                                                        options)
+                mountpoints = {self.args.images[0]: self.args.mountpoint}
 
             # only need to bind-mount on the devicemapper driver
             if self.d.info()['Driver'] == 'devicemapper':
-                mount.Mount.mount_path(os.path.join(self.args.mountpoint,
-                                                    "rootfs"),
-                                       self.args.mountpoint, bind=True)
+                for mountpoint in mountpoints.values():
+                    mount.Mount.mount_path(os.path.join(mountpoint, "rootfs"),
+                                           mountpoint, bind=True)
+
+            if self.args.many:
+                for identifier in self.args.images:
+                    self.writeOut("%s %s" % (identifier,
+                                             mountpoints[identifier]))
 
         except mount.MountError as dme:
             raise ValueError(str(dme))
@@ -711,19 +737,60 @@ class Atomic(object):
     def unmount(self):
         if os.geteuid() != 0:
             raise ValueError("This command must be run as root.")
+        if len(self.args.mountpoints) > 1 and not self.args.many:
+            raise ValueError("Use --many to unmount more than one "
+                             "mountpoint.")
         try:
-            dev = mount.Mount.get_dev_at_mountpoint(self.args.mountpoint)
+            for mountpoint in self.args.mountpoints:
+                dev = mount.Mount.get_dev_at_mountpoint(mountpoint)
 
-            # If there's a bind-mount over the directory, unbind it.
-            if dev.rsplit('[', 1)[-1].strip(']') == '/rootfs' \
-                    and self.d.info()['Driver'] == 'devicemapper':
-                mount.Mount.unmount_path(self.args.mountpoint)
+                # If there's a bind-mount over the directory, unbind it.
+                if dev.rsplit('[', 1)[-1].strip(']') == '/rootfs' \
+                        and self.d.info()['Driver'] == 'devicemapper':
+                    mount.Mount.unmount_path(mountpoint)
 
-            return mount.DockerMount(self.args.mountpoint).unmount()
+            if self.args.many:
+                return mount.DockerMount.unmount_many(self.args.mountpoints)
+            return mount.DockerMount(self.args.mountpoints[0]).unmount()
 
         except mount.MountError as dme:
             raise ValueError(str(dme))
 
+    def cat(self):
+        """
+        Print a file of an image, read from its layers without mounting it.
+        """
+        try:
+            layers.cat(self.d, self.image, self.args.path,
+                       getattr(sys.stdout, 'buffer', sys.stdout))
+        except layers.LayerError as e:
+            raise ValueError(str(e))
+
+    def diff(self):
+        """
+        Print the files added (A), deleted (D) and changed (C) from the
+        first image or container to the second.
+        """
+        try:
+            changes = diff.diff(self.d, self.args.first, self.args.second)
+        except (mount.MountError, layers.LayerError) as e:
+            raise ValueError(str(e))
+        for line in changes.lines():
+            self.writeOut(line)
+
+    def export(self):
+        """
+        Write a tar stream of a directory of an image, read from its layers
+        without mounting it.
+        """
+        if sys.stdout.isatty():
+            raise ValueError("Refusing to write a tar stream to a terminal.")
+        try:
+            layers.export(self.d, self.image, self.args.subtree,
+                          getattr(sys.stdout, 'buffer', sys.stdout))
+        except layers.LayerError as e:
+            raise ValueError(str(e))
+
     def version(self):
         def get_label(label):
             val = self._get_args(label)
@@ -0,0 +1,138 @@
+import collections
+import threading
+
+import docker
+
+""" Module for caching results derived from docker images. """
+
+# Results kept by default.
+CACHE_SIZE = 256
+# Image events which may change results derived from images.
+IMAGE_EVENTS = ('pull', 'tag', 'untag', 'delete', 'import', 'load')
+# The key of results derived from the whole set of images.
+ALL_IMAGES = 'images'
+
+
+def image_key(image_id):
+    """ 'sha256:0123...' -> 'id:0123...', as old dockers leave it out """
+    return 'id:' + image_id.split(':', 1)[-1]
+
+
+def tag_keys(ref):
+    """ 'fedora' -> ['tag:fedora', 'tag:fedora:latest'] """
+    keys = ['tag:' + ref]
+    if ':' not in ref.rsplit('/', 1)[-1]:
+        keys.append('tag:' + ref + ':latest')
+    return keys
+
+
+class ResultCache(object):
+
+    """
+    Keeps at most size results, evicting the least recently used. Each
+    result is stored with the keys it depends on, such as image_key() of
+    the images it was derived from, 'name:<Name label>' or tag_keys(), and
+    dropped when any of them is invalidated.
+
+    A result is only stored if nothing was invalidated since the caller
+    read generation before computing it, so no result derived from an image
+    which changed meanwhile is kept. Results are neither kept nor returned
+    while the cache is not active, that is while nothing tells it of
+    changes.
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.generation = 0
+        self.active = False
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        """Returns the result stored for key, or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None) if self.active else None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, result, depends, generation):
+        with self._lock:
+            if not self.active or generation != self.generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (result, frozenset(depends))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, keys):
+        """Drops the results depending on any of keys"""
+        keys = set(keys)
+        with self._lock:
+            self.generation += 1
+            for k in [k for k, (_, depends) in self._entries.items()
+                      if depends & keys]:
+                del self._entries[k]
+
+    def activate(self, active=True):
+        """
+        Starts or stops keeping results. Either way, what is kept is
+        dropped, as changes may have been missed.
+        """
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self.active = active
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def event_keys(client, event):
+    """
+    Returns the keys of the results an image event of docker may change,
+    which always include ALL_IMAGES. A deleted image can not be looked up
+    any more, so the 'deleted' key stands in for the name it had.
+    """
+    actor = event.get('Actor') or {}
+    refs = set([event.get('id'), actor.get('ID'),
+                (actor.get('Attributes') or {}).get('name')])
+    refs.discard(None)
+    keys = set([ALL_IMAGES])
+    for ref in refs:
+        keys.update(tag_keys(ref))
+        try:
+            info = client.inspect_image(ref)
+        except docker.errors.APIError:
+            keys.update([image_key(ref), 'deleted'])
+            continue
+        keys.add(image_key(info['Id']))
+        name = ((info.get('Config') or {}).get('Labels') or {}).get('Name')
+        if name:
+            keys.add('name:' + name)
+    return keys
+
+
+def watch_events(client, cache, changed=None):
+    """
+    Invalidates the results of cache which the image events of docker
+    change, calling changed() after each, until the event stream ends. The
+    cache is active only while the stream is.
+    """
+    events = client.events(decode=True)
+    cache.activate()
+    try:
+        for event in events:
+            if event.get('Type', 'image') != 'image' or \
+                    event.get('status') not in IMAGE_EVENTS:
+                continue
+            cache.invalidate(event_keys(client, event))
+            if changed:
+                changed()
+    finally:
+        cache.activate(False)
@@ -13,6 +13,22 @@ class PulpConfig(object):
     [server]
     host = <pulp-server-hostname.example.com>
     verify_ssl = false
+    # optional connection tuning
+    pool_size = 4
+    connect_timeout = 30
+    read_timeout = 300
+    task_timeout = 1800
+
+    # optional upload tuning
+    [upload]
+    chunk_size = 1048576
+    workers = 4
+    queue_depth = 4
+    # images uploaded at a time
+    parallel_images = 2
+    # gzip or none
+    compression = gzip
+    compress_level = 6
 
     # optional auth section
     [auth]
@@ -27,6 +43,17 @@ class PulpConfig(object):
         self.username = self._get("auth", "username")
         self.password = self._get("auth", "password")
         self.verify_ssl = self._getboolean("server", "verify_ssl")
+        self.pool_size = self._getint("server", "pool_size")
+        self.connect_timeout = self._getfloat("server", "connect_timeout")
+        self.read_timeout = self._getfloat("server", "read_timeout")
+        self.task_timeout = self._getfloat("server", "task_timeout")
+        self.chunk_size = self._getint("upload", "chunk_size")
+        self.upload_workers = self._getint("upload", "workers")
+        self.queue_depth = self._getint("upload", "queue_depth")
+        self.parallel_images = self._getint("upload", "parallel_images")
+        self.compression = self._getchoice("upload", "compression",
+                                           ("gzip", "none"))
+        self.compress_level = self._getint("upload", "compress_level")
 
     def _get(self, section, val):
         try:
@@ -37,6 +64,14 @@ class PulpConfig(object):
             raise ValueError("Bad Value for %s in %s. %s" %
                              (val, self.config_file, e))
 
+    def _getchoice(self, section, val, choices):
+        value = self._get(section, val)
+        if value is not None and value not in choices:
+            raise ValueError("Bad Value for %s in %s. %r is not one of %s" %
+                             (val, self.config_file, value,
+                              ", ".join(choices)))
+        return value
+
     def _getboolean(self, section, val):
         try:
             return self.c.getboolean(section, val)
@@ -46,9 +81,37 @@ class PulpConfig(object):
             raise ValueError("Bad Value for %s in %s. %s" %
                              (val, self.config_file, e))
 
+    def _getint(self, section, val):
+        try:
+            return self.c.getint(section, val)
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            return None
+        except ValueError as e:
+            raise ValueError("Bad Value for %s in %s. %s" %
+                             (val, self.config_file, e))
+
+    def _getfloat(self, section, val):
+        try:
+            return self.c.getfloat(section, val)
+        except (configparser.NoSectionError, configparser.NoOptionError):
+            return None
+        except ValueError as e:
+            raise ValueError("Bad Value for %s in %s. %s" %
+                             (val, self.config_file, e))
+
     def config(self):
         return {"url": self.url, "verify_ssl": self.verify_ssl,
-                "username": self.username, "password": self.password}
+                "username": self.username, "password": self.password,
+                "pool_size": self.pool_size,
+                "connect_timeout": self.connect_timeout,
+                "read_timeout": self.read_timeout,
+                "task_timeout": self.task_timeout,
+                "chunk_size": self.chunk_size,
+                "upload_workers": self.upload_workers,
+                "queue_depth": self.queue_depth,
+                "parallel_images": self.parallel_images,
+                "compression": self.compression,
+                "compress_level": self.compress_level}
 
 if __name__ == '__main__':
     c = PulpConfig()
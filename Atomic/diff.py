@@ -0,0 +1,276 @@
+import filecmp
+import os
+import shutil
+import stat
+import tempfile
+
+from Atomic import layers
+from Atomic import manifest
+from Atomic import mount
+from Atomic import util
+
+""" Module for comparing the filesystems of images and containers. """
+
+
+class Changes(object):
+
+    """
+    The paths added, removed and modified between two filesystems.
+    """
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.modified = []
+
+    def extend(self, other):
+        self.added += other.added
+        self.removed += other.removed
+        self.modified += other.modified
+
+    def lines(self):
+        """
+        Returns the changes sorted by path, in the format of docker diff.
+        """
+        changes = [('A', p) for p in self.added] + \
+            [('D', p) for p in self.removed] + \
+            [('C', p) for p in self.modified]
+        return ['{0} /{1}'.format(k, p)
+                for k, p in sorted(changes, key=lambda c: c[1])]
+
+
+def common_ancestor(chain_a, chain_b):
+    """
+    Returns the positions in the layer chains (topmost first) of the
+    topmost layer they share, or their lengths if they share none.
+    """
+    in_b = dict((l, n) for n, l in enumerate(chain_b))
+    for n, l in enumerate(chain_a):
+        if l in in_b:
+            return n, in_b[l]
+    return len(chain_a), len(chain_b)
+
+
+def _touched(layer_manifests):
+    """
+    Returns a function telling whether a path may have been changed by any
+    of layer_manifests.
+    """
+    paths, prefixes = set(), set()
+    for m in layer_manifests:
+        paths.update(m['entries'])
+        # Deleting or hiding a directory changes everything below it.
+        prefixes.update(p + '/' for p in m['whiteouts'])
+        prefixes.update(p + '/' for p in m['opaque'] if p)
+        if '' in m['opaque']:
+            return lambda p: True
+    paths.update(p[:-1] for p in prefixes)
+
+    def touched(p):
+        return p in paths or any(p.startswith(x) for x in prefixes)
+    return touched
+
+
+def _same_entry(a, b):
+    if a['type'] != b['type'] or a['size'] != b['size'] or \
+            a['mode'] != b['mode']:
+        return False
+    return a.get('sha256') == b.get('sha256') and \
+        a.get('link') == b.get('link')
+
+
+def diff_images(client, image_a, image_b, cache=None):
+    """
+    Returns the Changes from image_a to image_b. Only the paths touched by
+    the layers above their common ancestor are compared, using the cached
+    layer manifests of ManifestCache.
+    """
+    cache = cache or manifest.ManifestCache(client)
+    chain_a = cache.layer_chain(image_a)
+    chain_b = cache.layer_chain(image_b)
+    na, nb = common_ancestor(chain_a, chain_b)
+    changes = Changes()
+    if na == 0 and nb == 0:
+        return changes
+
+    touched = _touched(cache.layer_manifest(l)
+                       for l in chain_a[:na] + chain_b[:nb])
+    merged_a = cache.image_manifest(image_a, chain_a)
+    merged_b = cache.image_manifest(image_b, chain_b)
+    for p in set(merged_a) | set(merged_b):
+        if not p or not touched(p):
+            continue
+        if p not in merged_a:
+            changes.added.append(p)
+        elif p not in merged_b:
+            changes.removed.append(p)
+        elif not _same_entry(merged_a[p], merged_b[p]):
+            changes.modified.append(p)
+    return changes
+
+
+def _same_file(path_a, st_a, path_b, st_b):
+    """
+    Compares two lstat()ed paths, reading file contents only when sizes
+    match and modification times differ.
+    """
+    if stat.S_IFMT(st_a.st_mode) != stat.S_IFMT(st_b.st_mode) or \
+            st_a.st_mode != st_b.st_mode:
+        return False
+    if stat.S_ISDIR(st_a.st_mode):
+        return True
+    if stat.S_ISLNK(st_a.st_mode):
+        return os.readlink(path_a) == os.readlink(path_b)
+    if stat.S_ISREG(st_a.st_mode):
+        if st_a.st_size != st_b.st_size:
+            return False
+        if st_a.st_mtime == st_b.st_mtime:
+            return True
+        return filecmp.cmp(path_a, path_b, shallow=False)
+    return st_a.st_rdev == st_b.st_rdev
+
+
+def _lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def _subtree(root, rel):
+    """
+    Returns rel and every path below it in root.
+    """
+    paths = [rel]
+    for dirpath, dirnames, filenames in os.walk(os.path.join(root, rel)):
+        base = os.path.relpath(dirpath, root)
+        paths += [os.path.join(base, n) for n in dirnames + filenames]
+    return paths
+
+
+def _compare_path(root_a, root_b, rel):
+    """
+    Returns the Changes at rel between the trees root_a and root_b, and
+    whether rel is a directory on both sides.
+    """
+    changes = Changes()
+    path_a, path_b = os.path.join(root_a, rel), os.path.join(root_b, rel)
+    st_a, st_b = _lstat(path_a), _lstat(path_b)
+    if st_a is None and st_b is None:
+        return changes, False
+    if st_a is None:
+        changes.added += _subtree(root_b, rel)
+    elif st_b is None:
+        changes.removed += _subtree(root_a, rel)
+    elif not _same_file(path_a, st_a, path_b, st_b):
+        changes.modified.append(rel)
+    both_dirs = st_a is not None and st_b is not None and \
+        stat.S_ISDIR(st_a.st_mode) and stat.S_ISDIR(st_b.st_mode)
+    return changes, both_dirs
+
+
+def diff_trees(root_a, root_b, paths=None, workers=8):
+    """
+    Returns the Changes from the tree at root_a to the tree at root_b. If
+    paths is given, only those paths are compared, else both trees are
+    walked. Directories are compared in parallel, one level at a time.
+
+    Paths below an added or removed directory are already reported with
+    it, as docker diff lists them both, so they are skipped.
+    """
+    changes = Changes()
+    if paths is not None:
+        paths = sorted(set(paths))
+        results = util.parallel_map(
+            lambda p: _compare_path(root_a, root_b, p), paths, workers)
+        subtrees = set()
+        for path, (c, _) in zip(paths, results):
+            if any(a in subtrees for a in layers.ancestors(path)[1:]):
+                continue
+            if c.added or c.removed:
+                subtrees.add(path)
+            changes.extend(c)
+        return changes
+
+    def _compare_dir(rel):
+        found = Changes()
+        subdirs = []
+        names = set(os.listdir(os.path.join(root_a, rel))) | \
+            set(os.listdir(os.path.join(root_b, rel)))
+        for name in names:
+            c, both_dirs = _compare_path(root_a, root_b,
+                                         os.path.join(rel, name))
+            found.extend(c)
+            if both_dirs:
+                subdirs.append(os.path.join(rel, name))
+        return found, subdirs
+
+    dirs = ['']
+    while dirs:
+        results = util.parallel_map(_compare_dir, dirs, workers)
+        dirs = []
+        for c, subdirs in results:
+            changes.extend(c)
+            dirs += subdirs
+    return changes
+
+
+def _mount(client, identifier, tmpdir):
+    """
+    Mounts identifier read-only below tmpdir and returns its mount and the
+    root of its filesystem.
+    """
+    mountpoint = tempfile.mkdtemp(dir=tmpdir)
+    dm = mount.DockerMount(mountpoint)
+    dm.mount(identifier)
+    if client.info()['Driver'] == 'devicemapper':
+        return dm, os.path.join(mountpoint, 'rootfs')
+    return dm, mountpoint
+
+
+def diff(client, identifier_a, identifier_b, workers=8, cache=None):
+    """
+    Returns the Changes from the image or container identifier_a to
+    identifier_b. Two images are compared through their layer manifests.
+    Otherwise both are mounted and compared by a parallel tree walk, which
+    is limited to the paths docker reports as changed when a container is
+    compared with its own image. Everything mounted is unmounted again
+    before returning, except that images are mounted through cache when a
+    long-running caller passes a MountCache, so later comparisons reuse
+    their mounts.
+    """
+    index = mount.IdentifierIndex(client.containers(all=True),
+                                  client.images(all=True))
+    kind_a, uuid_a = index.resolve(identifier_a)
+    kind_b, uuid_b = index.resolve(identifier_b)
+    if kind_a == 'image' and kind_b == 'image':
+        return diff_images(client, uuid_a, uuid_b)
+
+    paths = None
+    for (kind, uuid), (other_kind, other) in \
+            (((kind_a, uuid_a), (kind_b, uuid_b)),
+             ((kind_b, uuid_b), (kind_a, uuid_a))):
+        if kind == 'container' and other_kind == 'image' and \
+                client.inspect_container(uuid)['Image'] == other:
+            paths = [layers.normpath(c['Path'])
+                     for c in client.diff(uuid) or []]
+
+    if os.geteuid() != 0:
+        raise mount.MountError('Comparing containers must be done as root.')
+    tmpdir = tempfile.mkdtemp(prefix='atomic-diff-')
+    cleanups = []
+    try:
+        roots = []
+        for kind, uuid in ((kind_a, uuid_a), (kind_b, uuid_b)):
+            if kind == 'image' and cache is not None:
+                roots.append(cache.acquire(uuid))
+                cleanups.append(lambda uuid=uuid: cache.release(uuid))
+            else:
+                dm, root = _mount(client, uuid, tmpdir)
+                roots.append(root)
+                cleanups.append(dm.unmount)
+        return diff_trees(roots[0], roots[1], paths, workers)
+    finally:
+        for cleanup in reversed(cleanups):
+            cleanup()
+        shutil.rmtree(tmpdir, ignore_errors=True)
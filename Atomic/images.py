@@ -0,0 +1,113 @@
+""" Module for answering questions about every local image at once. """
+
+NO_TAG = '<none>:<none>'
+
+
+def version_string(labels):
+    """ The 'Name-Version-Release' of image labels, leaving out blanks """
+    labels = labels or {}
+    return ('%s-%s-%s' % (labels.get('Name', ''), labels.get('Version', ''),
+                          labels.get('Release', ''))).strip('-')
+
+
+def out_of_date(image, layer_version, available):
+    """ The warning of verify about a layer of image with a newer version """
+    return ("Image '%s' contains a layer '%s' that is out of date.\n"
+            "Image version '%s' is available, current version could contain "
+            "vulnerabilities.You should rebuild the '%s' image using docker "
+            "build." % (image, layer_version, available, image))
+
+
+class ImageIndex(object):
+
+    """
+    Every local image and intermediate layer, from a single listing of
+    docker. Layer chains, versions and verifications are all worked out
+    from it, without asking docker about each image and layer.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self.layers = dict((i['Id'], i) for i in client.images(all=True))
+        self.images = [i for i in self.layers.values()
+                       if [t for t in i.get('RepoTags') or [] if t != NO_TAG]]
+        self.images.sort(key=lambda i: i['Id'])
+        self._tags = {}
+        for i in self.layers.values():
+            for t in i.get('RepoTags') or []:
+                if t != NO_TAG:
+                    self._tags[t] = i['Id']
+        self._newest = None
+
+    def find(self, name):
+        """
+        The Id of the image name refers to, as docker inspect looks it up:
+        by tag, ':latest' unless given, then by Id or unique Id prefix.
+        None if name refers to no image.
+        """
+        tag = name if ':' in name.rsplit('/', 1)[-1] else name + ':latest'
+        if tag in self._tags:
+            return self._tags[tag]
+        if name in self.layers:
+            return name
+        prefix = name.split(':', 1)[-1] if name.startswith('sha256:') \
+            else name
+        if not prefix or prefix.strip('0123456789abcdef'):
+            return None
+        ids = [i for i in self.layers
+               if i.split(':', 1)[-1].startswith(prefix)]
+        return ids[0] if len(ids) == 1 else None
+
+    def labels(self, image_id):
+        entry = self.layers[image_id]
+        if 'Labels' not in entry:
+            # Dockers before API 1.17 only list labels on inspection.
+            config = self._client.inspect_image(image_id).get('Config') or {}
+            entry['Labels'] = config.get('Labels')
+        return entry['Labels'] or {}
+
+    def tag(self, image_id):
+        """ The first tag of an image, or '' """
+        tags = [t for t in self.layers[image_id].get('RepoTags') or []
+                if t != NO_TAG]
+        return tags[0] if tags else ''
+
+    def layer(self, image_id):
+        labels = self.labels(image_id)
+        return {'Id': image_id, 'Name': labels.get('Name', ''),
+                'Version': version_string(labels),
+                'Tag': self.tag(image_id)}
+
+    def chain(self, image_id):
+        """ The layers of an image, as Atomic.get_layers(), topmost first """
+        chain = []
+        while image_id in self.layers:
+            chain.append(self.layer(image_id))
+            image_id = self.layers[image_id].get('ParentId')
+        return chain
+
+    def verify(self, image_id, image=None):
+        """
+        Returns the warning of Atomic.verify() for an image, which may be
+        called image in it, or '' if none of its layers is out of date. A
+        layer is out of date if a tagged image with its Name label has a
+        greater version. The topmost such layer is reported, along with the
+        greatest version of its Name.
+        """
+        if self._newest is None:
+            self._newest = {}
+            for i in self.images:
+                layer = self.layer(i['Id'])
+                if layer['Name'] and layer['Version'] > \
+                        self._newest.get(layer['Name'], ''):
+                    self._newest[layer['Name']] = layer['Version']
+        newest = self._newest
+        name = None
+        for layer in self.chain(image_id):
+            if name == layer['Name']:
+                continue
+            name = layer['Name']
+            if name and newest.get(name, '') > layer['Version']:
+                return out_of_date(image or self.tag(image_id) or image_id,
+                                   layer['Version'], newest[name])
+        return ''
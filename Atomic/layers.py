@@ -0,0 +1,613 @@
+import hashlib
+import io
+import json
+import posixpath
+import shutil
+import tarfile
+import tempfile
+
+""" Module for reading files straight out of the layers of docker images. """
+
+# The most symlinks followed while resolving a path.
+MAX_SYMLINKS = 40
+# File contents larger than this are spooled to disk while scanning.
+SPOOL_SIZE = 1048576
+# The most bytes of file contents a scan holds in memory, over all files;
+# the contents of files which do not fit are spooled to disk.
+SPOOL_BUDGET = 33554432
+
+WHITEOUT_PREFIX = '.wh.'
+OPAQUE_WHITEOUT = '.wh..wh..opq'
+
+# The size of tar headers and the blocks contents are padded to.
+TAR_BLOCK = 512
+
+# What wanted() asks _scan() to keep of an entry.
+WANT_INFO = 1
+WANT_DATA = 2
+
+
+class LayerError(Exception):
+
+    """Generic error reading the layers of an image."""
+
+    def __init__(self, val):
+        self.val = val
+
+    def __str__(self):
+        return str(self.val)
+
+
+class Layer(object):
+
+    """
+    The entries of one image layer which a scan asked for, and the paths
+    the layer hides in the layers below it.
+    """
+
+    def __init__(self):
+        self.parent = None
+        self.entries = {}
+        self.whiteouts = set()
+        self.opaque = set()
+
+
+def normpath(name):
+    """ './etc//os-release' -> 'etc/os-release', the root is '' """
+    return posixpath.normpath('/' + name).lstrip('/')
+
+
+def ancestors(path):
+    """ 'a/b/c' -> ['', 'a', 'a/b'] """
+    parts = path.split('/')
+    return [''] + ['/'.join(parts[:n]) for n in range(1, len(parts))]
+
+
+def iter_layer(f):
+    """
+    Reads the tar stream of one layer and yields a (path, TarInfo, data)
+    tuple for every entry, where data is a file object for regular files,
+    readable until the next item, and None otherwise. Paths the layer
+    deletes come as (path, WHITEOUT_PREFIX, None), directories it makes
+    opaque as (path, OPAQUE_WHITEOUT, None).
+    """
+    tar = tarfile.open(fileobj=f, mode='r|')
+    for info in tar:
+        path = normpath(info.name)
+        dirname, base = posixpath.split(path)
+        if base == OPAQUE_WHITEOUT:
+            yield dirname, OPAQUE_WHITEOUT, None
+        elif base.startswith(WHITEOUT_PREFIX):
+            yield (posixpath.join(dirname, base[len(WHITEOUT_PREFIX):]),
+                   WHITEOUT_PREFIX, None)
+        else:
+            yield path, info, tar.extractfile(info) if info.isreg() else None
+
+
+def layer_order(layers, manifest=None):
+    """
+    Returns the ids of layers topmost first, taken from the manifest.json of
+    a 'docker save' stream if it has one, or else from the parent chain.
+    """
+    if manifest:
+        return [posixpath.dirname(normpath(l))
+                for l in reversed(manifest[0]['Layers'])]
+    parents = set(l.parent for l in layers.values())
+    tops = [i for i in layers if i not in parents]
+    if len(tops) != 1:
+        raise LayerError('Could not determine the layer order of the image.')
+    order = []
+    layer_id = tops[0]
+    while layer_id:
+        order.append(layer_id)
+        layer_id = layers[layer_id].parent if layer_id in layers else None
+    return order
+
+
+def read_save(stream, layer_fn, parents=None):
+    """
+    Reads a 'docker save' stream once, calling layer_fn(layer_id, f) with
+    the tar stream of every layer, and returns the layer ids topmost first.
+    The Layer of every id, with its parent as far as read, is kept in the
+    dict parents, if given.
+    """
+    parents = {} if parents is None else parents
+    manifest = None
+    outer = tarfile.open(fileobj=stream, mode='r|')
+    for member in outer:
+        name = normpath(member.name)
+        if name == 'manifest.json':
+            manifest = json.loads(outer.extractfile(member).read()
+                                  .decode('utf-8'))
+            continue
+        layer_id, base = posixpath.split(name)
+        if not layer_id or '/' in layer_id:
+            continue
+        layer = parents.setdefault(layer_id, Layer())
+        if base == 'json':
+            layer.parent = json.loads(outer.extractfile(member).read()
+                                      .decode('utf-8')).get('parent')
+        elif base == 'layer.tar':
+            layer_fn(layer_id, outer.extractfile(member))
+    outer.close()
+    return layer_order(parents, manifest)
+
+
+def _tar_size(field):
+    field = bytearray(field)
+    if field[0] & 0x80:
+        # GNU base-256 encoding of large sizes.
+        n = 0
+        for b in field[1:]:
+            n = n << 8 | b
+        return n
+    return int(bytes(field).strip(b' \0') or b'0', 8)
+
+
+def _tar_name(header):
+    name = header[:100].split(b'\0', 1)[0]
+    if header[257:262] == b'ustar':
+        prefix = header[345:500].split(b'\0', 1)[0]
+        if prefix:
+            name = prefix + b'/' + name
+    return name.decode('utf-8')
+
+
+def _pax_path(records):
+    """Returns the path of a pax extended header, if it has one"""
+    path = None
+    while records:
+        length = int(records.split(b' ', 1)[0])
+        key, _, value = records[:length].split(b' ', 1)[1].partition(b'=')
+        if key == b'path':
+            path = value[:-1].decode('utf-8')
+        records = records[length:]
+    return path
+
+
+class DigestReader(object):
+
+    """
+    Reads a 'docker save' stream, computing the sha256 of all of it and of
+    the layer.tar of every layer as the bytes go by. Reading the stream
+    once gives both the data and its digests. digest and layers, a dict of
+    layer ids to digests, are complete once the stream is read to the end.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.layers = {}
+        self._sha = hashlib.sha256()
+        self._header = b''
+        self._left = 0
+        self._pad = 0
+        self._member = None
+        self._meta = None
+        self._long_name = None
+        self._end = False
+
+    @property
+    def digest(self):
+        return 'sha256:' + self._sha.hexdigest()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self._sha.update(data)
+        pos = 0
+        while pos < len(data) and not self._end:
+            if self._left:
+                n = min(self._left, len(data) - pos)
+                if self._member is not None:
+                    self._member[1].update(data[pos:pos + n])
+                elif self._meta is not None:
+                    self._meta[1].extend(data[pos:pos + n])
+                self._left -= n
+                pos += n
+                if not self._left:
+                    self._done()
+            elif self._pad:
+                n = min(self._pad, len(data) - pos)
+                self._pad -= n
+                pos += n
+            else:
+                n = min(TAR_BLOCK - len(self._header), len(data) - pos)
+                self._header += data[pos:pos + n]
+                pos += n
+                if len(self._header) == TAR_BLOCK:
+                    self._start(self._header)
+                    self._header = b''
+        return data
+
+    def close(self):
+        self.stream.close()
+
+    def _start(self, header):
+        if header == b'\0' * TAR_BLOCK:
+            self._end = True
+            return
+        size = _tar_size(header[124:136])
+        kind = header[156:157]
+        self._left, self._pad = size, -size % TAR_BLOCK
+        self._member = self._meta = None
+        if kind in (b'L', b'x'):
+            self._meta = (kind, bytearray())
+        elif kind != b'g':
+            name = self._long_name or _tar_name(header)
+            self._long_name = None
+            layer_id, base = posixpath.split(normpath(name))
+            if base == 'layer.tar' and layer_id and '/' not in layer_id \
+                    and kind in (b'0', b'\0'):
+                self._member = (layer_id, hashlib.sha256())
+        if not size:
+            self._done()
+
+    def _done(self):
+        if self._member is not None:
+            layer_id, sha = self._member
+            self.layers[layer_id] = 'sha256:' + sha.hexdigest()
+        elif self._meta is not None:
+            kind, data = self._meta
+            if kind == b'L':
+                self._long_name = bytes(data).split(b'\0', 1)[0].decode(
+                    'utf-8')
+            else:
+                self._long_name = _pax_path(bytes(data))
+        self._member = self._meta = None
+
+
+def _covered(path, hidden, opaque):
+    """
+    Is path hidden from a lower layer by whiteouts, non-directories or
+    opaque directories of the layers above it?
+    """
+    if path in hidden:
+        return True
+    return any(a in hidden or a in opaque for a in ancestors(path) if a)
+
+
+def merge(order, layers, isdir=lambda entry: entry[0].isdir()):
+    """
+    Returns the entries visible in the merged filesystem of layers, given
+    their ids topmost first, as a dict of path to entry; (TarInfo, data)
+    for the layers of scan().
+    """
+    merged = {}
+    hidden, opaque = set(), set()
+    for layer_id in order:
+        layer = layers[layer_id]
+        visible = [(p, e) for p, e in layer.entries.items()
+                   if p not in merged and not _covered(p, hidden, opaque)]
+        merged.update(visible)
+        # Whiteouts and opaque directories only apply to lower layers.
+        hidden |= layer.whiteouts
+        hidden |= set(p for p, e in visible if not isdir(e))
+        opaque |= layer.opaque
+    return merged
+
+
+def _link_target(path, merged):
+    """
+    Returns path with its first symlink (or a final hardlink) resolved, or
+    None if nothing along path is a link.
+    """
+    for p in [a for a in ancestors(path) if a] + [path]:
+        entry = merged.get(p)
+        if entry is None:
+            return None
+        info = entry[0]
+        if info.issym():
+            target = posixpath.join(posixpath.dirname(p), info.linkname)
+            rest = path[len(p) + 1:]
+            return normpath(posixpath.join(target, rest) if rest else target)
+        if info.islnk() and p == path:
+            return normpath(info.linkname)
+    return None
+
+
+class _Extent(object):
+
+    """
+    The contents of a file spooled to the spool file of a scan, readable
+    as a file object of their own.
+    """
+
+    def __init__(self, spool, offset, size):
+        self.spool = spool
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def read(self, size=-1):
+        left = self.size - self.pos
+        size = left if size is None or size < 0 else min(size, left)
+        self.spool.seek(self.offset + self.pos)
+        data = self.spool.read(size)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class _Scan(object):
+
+    """
+    The entries of the merged filesystem of an image along a path, and
+    below it if subtree, kept while the layers of its 'docker save' stream
+    are read. Symlinks along the path are followed as they come up, by
+    scanning for their targets too.
+
+    Layers are merged as they are read, as docker writes them in order,
+    either way. Entries of a lower layer which the layers read are known to
+    hide are never kept, and those an upper layer hides are dropped when
+    it is read, so only the contents of visible files are kept, up to
+    SPOOL_BUDGET bytes of them in memory and the rest in one spool file on
+    disk. The layers
+    of a stream in any other order are kept apart and merged at the end.
+    """
+
+    _SEGMENT = object()
+
+    def __init__(self, path, subtree, budget=SPOOL_BUDGET):
+        self.subtree = subtree
+        self.free = budget
+        self.spool = None
+        self.layers = {}
+        # Paths scanned for, to whether nothing under them was read before.
+        self.roots = {}
+        self.parents = set()
+        self.seen = set()
+        # Path to (TarInfo, data, rank) of the layers merged so far, which
+        # are ranked in the order of the image, with their whiteouts and
+        # opaque directories.
+        self.entries = {}
+        self.ranks = {}
+        self.hidden, self.opaque = set(), set()
+        self.top = self.bottom = None
+        self.unplaced = {}
+        self._add_root(path)
+
+    def _add_root(self, path):
+        if path in self.roots:
+            return
+        self.roots[path] = path not in self.seen and not any(
+            a in self.seen for a in ancestors(path) if a) and not (
+            self.subtree and
+            any(p.startswith(path + '/') or not path for p in self.seen))
+        self.parents.update(ancestors(path) if path else [])
+
+    def _wanted(self, path):
+        for r in self.roots:
+            if path == r or (self.subtree and
+                             (not r or path.startswith(r + '/'))):
+                return WANT_DATA
+        if path in self.parents:
+            return WANT_INFO
+        return None
+
+    def _see(self, path, info, follow=True):
+        self.seen.add(path)
+        if not follow or info in (OPAQUE_WHITEOUT, WHITEOUT_PREFIX):
+            return
+        for r in list(self.roots):
+            if info.issym() and (r == path or r.startswith(path + '/')):
+                target = posixpath.join(posixpath.dirname(path),
+                                        info.linkname)
+                rest = r[len(path) + 1:]
+                self._add_root(normpath(posixpath.join(target, rest)
+                                        if rest else target))
+            elif info.islnk() and r == path:
+                self._add_root(normpath(info.linkname))
+
+    def _copy(self, info, src, want):
+        if want != WANT_DATA or not src:
+            return None
+        if info.size <= SPOOL_SIZE and info.size <= self.free:
+            self.free -= info.size
+            data = io.BytesIO(src.read())
+            return data
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile()
+        self.spool.seek(0, 2)
+        offset = self.spool.tell()
+        shutil.copyfileobj(src, self.spool)
+        return _Extent(self.spool, offset, self.spool.tell() - offset)
+
+    def _release(self, entry):
+        info, data = entry[:2]
+        if data:
+            if isinstance(data, io.BytesIO):
+                self.free += info.size
+            data.close()
+
+    def _drop_below(self, path, rank, keep_path=False):
+        """Drops the entries of layers below rank at and under path"""
+        if not self._wanted(path) and \
+                not any(r.startswith(path + '/') for r in self.roots):
+            return
+        for p in list(self.entries):
+            if ((p == path and not keep_path) or
+                    p.startswith(path + '/')) and self.entries[p][2] < rank:
+                self._release(self.entries.pop(p))
+
+    def _place(self, layer_id):
+        """
+        Returns the rank of layer_id, just above or below the layers merged
+        so far, or None if it is neither.
+        """
+        parent = self.layers[layer_id].parent
+        if self.unplaced:
+            return None
+        if self.top is None:
+            self.top = self.bottom = layer_id
+            rank = 0
+        elif parent is not None and parent == self.top:
+            self.top = layer_id
+            rank = self.ranks[parent] + 1
+        elif self.layers[self.bottom].parent == layer_id:
+            rank = self.ranks[self.bottom] - 1
+            self.bottom = layer_id
+        else:
+            return None
+        self.ranks[layer_id] = rank
+        return rank
+
+    def layer(self, layer_id, f):
+        """Reads the tar stream of layer layer_id, as read_save() calls"""
+        rank = self._place(layer_id)
+        if rank is None:
+            self._keep_layer(layer_id, f)
+        elif self.top == self.bottom or layer_id == self.bottom:
+            self._merge_below(rank, f)
+        else:
+            self._merge_above(rank, f)
+
+    def _merge_below(self, rank, f):
+        whiteouts, opaque, shadows = set(), set(), set()
+        for path, info, src in iter_layer(f):
+            # Entries of the layers above, but not of this one, hide those
+            # of this layer; whiteouts below them still apply further down.
+            old = self.entries.get(path)
+            visible = not _covered(path, self.hidden, self.opaque) and (
+                old is None or old[2] == rank or
+                info in (OPAQUE_WHITEOUT, WHITEOUT_PREFIX))
+            self._see(path, info, visible)
+            want = visible and self._wanted(path)
+            if not want:
+                continue
+            if info == OPAQUE_WHITEOUT:
+                opaque.add(path)
+            elif info == WHITEOUT_PREFIX:
+                whiteouts.add(path)
+            else:
+                self.entries[path] = (info, self._copy(info, src, want),
+                                      rank)
+                if not info.isdir():
+                    shadows.add(path)
+        # Whiteouts and non-directories only hide paths of lower layers.
+        self.hidden |= whiteouts | shadows
+        self.opaque |= opaque
+
+    def _merge_above(self, rank, f):
+        for path, info, src in iter_layer(f):
+            self._see(path, info)
+            if info == OPAQUE_WHITEOUT:
+                self._drop_below(path, rank, keep_path=True)
+                self.opaque.add(path)
+                continue
+            if info == WHITEOUT_PREFIX:
+                self._drop_below(path, rank)
+                self.hidden.add(path)
+                continue
+            old = self.entries.get(path)
+            if old is not None and old[2] < rank:
+                if not info.isdir():
+                    self._drop_below(path, rank, keep_path=True)
+                self._release(self.entries.pop(path))
+            want = self._wanted(path)
+            if want:
+                self.entries[path] = (info, self._copy(info, src, want),
+                                      rank)
+
+    def _keep_layer(self, layer_id, f):
+        layer = self.unplaced[layer_id] = Layer()
+        for path, info, src in iter_layer(f):
+            self._see(path, info)
+            want = self._wanted(path)
+            if not want:
+                continue
+            if info == OPAQUE_WHITEOUT:
+                layer.opaque.add(path)
+            elif info == WHITEOUT_PREFIX:
+                layer.whiteouts.add(path)
+            else:
+                layer.entries[path] = (info, self._copy(info, src, want))
+
+    def merged(self, order):
+        """
+        Returns the merged entries, as a dict of path to (TarInfo, data),
+        given the layer ids of the image topmost first.
+        """
+        entries = dict((p, e[:2]) for p, e in self.entries.items())
+        if not self.unplaced:
+            return entries
+        segment = Layer()
+        segment.entries = entries
+        segment.whiteouts, segment.opaque = self.hidden, self.opaque
+        layers = dict(self.unplaced)
+        layers[self._SEGMENT] = segment
+        merge_order = []
+        for layer_id in order:
+            if layer_id not in self.ranks:
+                merge_order.append(layer_id)
+            elif self._SEGMENT not in merge_order:
+                merge_order.append(self._SEGMENT)
+        return merge([l for l in merge_order if l in layers], layers)
+
+    def resolve(self, path, merged):
+        """
+        Returns path with the symlinks along it resolved, and whether the
+        entries of the result were all scanned for. If not, the scan stops
+        at the first path which was not.
+        """
+        for _ in range(MAX_SYMLINKS):
+            if not self.roots.get(path):
+                return path, False
+            target = _link_target(path, merged)
+            if target is None:
+                return path, True
+            path = target
+        raise LayerError('Too many levels of symbolic links.')
+
+
+def lookup(client, image, path, subtree=False):
+    """
+    Returns path, with any symlinks along it resolved, and the merged
+    entries of image for it (and everything below it, if subtree). The
+    image is read once, unless a symlink points into a layer read before
+    it, which costs another read from there on.
+    """
+    path = normpath(path)
+    for _ in range(MAX_SYMLINKS):
+        scan = _Scan(path, subtree)
+        order = read_save(client.get_image(image), scan.layer, scan.layers)
+        merged = scan.merged(order)
+        path, done = scan.resolve(path, merged)
+        if done:
+            return path, merged
+    raise LayerError('Too many levels of symbolic links.')
+
+
+def cat(client, image, path, out):
+    """
+    Writes the contents of file path in image to out.
+    """
+    path, merged = lookup(client, image, path)
+    if path not in merged:
+        raise LayerError('{0}: No such file in {1}.'.format(path, image))
+    info, data = merged[path]
+    if info.isdir():
+        raise LayerError('{0}: Is a directory.'.format(path))
+    if data:
+        shutil.copyfileobj(data, out)
+
+
+def export(client, image, subtree, out):
+    """
+    Writes a tar stream of subtree of the merged filesystem of image to out.
+    """
+    path, merged = lookup(client, image, subtree, subtree=True)
+    if path and path not in merged:
+        raise LayerError('{0}: No such file or directory in {1}.'
+                         ''.format(path, image))
+    prefix = path + '/' if path else ''
+    tar = tarfile.open(fileobj=out, mode='w|')
+    for p in sorted(merged):
+        if not p or (p != path and not p.startswith(prefix)):
+            continue
+        info, data = merged[p]
+        info.name = p
+        tar.addfile(info, data)
+        if data:
+            data.close()
+    tar.close()
@@ -0,0 +1,85 @@
+import errno
+import fcntl
+import os
+import time
+
+from contextlib import contextmanager
+
+try:
+    from urllib.parse import quote  # pylint: disable=no-name-in-module
+except ImportError:
+    from urllib import quote  # pylint: disable=no-name-in-module
+
+""" Module for locks shared between atomic processes. """
+
+LOCK_DIR = '/run/atomic/locks'
+
+
+class LockError(Exception):
+
+    """Failure to take a lock in time."""
+
+    def __init__(self, val):
+        self.val = val
+
+    def __str__(self):
+        return str(self.val)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+@contextmanager
+def flocked(path, shared=False, timeout=None):
+    """
+    Holds a flock() on the file at path for the duration of a with block,
+    waiting at most timeout seconds for it if timeout is given.
+
+    Locks belong to the open file, so threads of one process exclude each
+    other just like separate processes do. Lock files are never removed:
+    removing one while another process waits on it would let a third
+    process lock a new file of the same name.
+    """
+    _makedirs(os.path.dirname(path))
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    with open(path, 'a') as f:
+        if timeout is None:
+            fcntl.flock(f, mode)
+        else:
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    fcntl.flock(f, mode | fcntl.LOCK_NB)
+                    break
+                except IOError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    if time.time() >= deadline:
+                        raise LockError('Timed out waiting for lock {}.'
+                                        ''.format(path))
+                    time.sleep(0.05)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def lock_path(name, lock_dir=LOCK_DIR):
+    """
+    Returns the lock file of name, which may be any string, such as a
+    device name or the path of a mountpoint.
+    """
+    return os.path.join(lock_dir, quote(name, safe='') + '.lock')
+
+
+def locked(name, shared=False, timeout=None, lock_dir=LOCK_DIR):
+    """
+    Holds the lock called name below lock_dir for the duration of a with
+    block. Locks of different names never wait for each other.
+    """
+    return flocked(lock_path(name, lock_dir), shared, timeout)
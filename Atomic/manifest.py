@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from Atomic import layers
+from multiprocessing.pool import ThreadPool
+
+""" Module for building and caching content manifests of image layers. """
+
+# Read size while hashing file contents.
+HASH_CHUNK = 1048576
+
+
+def _entry_type(info):
+    if info.isdir():
+        return 'd'
+    if info.isreg():
+        return 'f'
+    if info.issym():
+        return 'l'
+    if info.islnk():
+        return 'h'
+    return 'o'
+
+
+def hash_layer(f):
+    """
+    Returns the manifest of the layer tar stream f: a dict with the
+    'entries' of the layer, a dict of path to a dict of its 'type' (d, f, l,
+    h or o), 'mode', 'size', 'mtime' and the 'sha256' of regular files or
+    the 'link' of links, and the 'whiteouts' and 'opaque' directories of
+    the layer.
+    """
+    manifest = {'entries': {}, 'whiteouts': [], 'opaque': []}
+    for path, info, src in layers.iter_layer(f):
+        if info == layers.OPAQUE_WHITEOUT:
+            manifest['opaque'].append(path)
+            continue
+        if info == layers.WHITEOUT_PREFIX:
+            manifest['whiteouts'].append(path)
+            continue
+        entry = {'type': _entry_type(info), 'mode': info.mode,
+                 'size': info.size, 'mtime': info.mtime}
+        if src:
+            h = hashlib.sha256()
+            for chunk in iter(lambda: src.read(HASH_CHUNK), b''):
+                h.update(chunk)
+            entry['sha256'] = h.hexdigest()
+        elif info.issym() or info.islnk():
+            entry['link'] = info.linkname
+        manifest['entries'][path] = entry
+    return manifest
+
+
+def _default_cache_dir():
+    if os.geteuid() == 0:
+        return '/var/lib/atomic/manifests'
+    return os.path.expanduser('~/.cache/atomic/manifests')
+
+
+class ManifestCache(object):
+
+    """
+    Builds file manifests of images from the manifests of their layers.
+
+    Layers are immutable, so the manifest of every layer is computed once,
+    keyed by its layer id, and stored in cache_dir. The manifest of an image
+    is composed from the manifests of its layer chain, and only layers which
+    were never seen before are read and hashed, 'workers' at a time.
+    """
+
+    def __init__(self, client, cache_dir=None, workers=4):
+        self.client = client
+        self.cache_dir = cache_dir or _default_cache_dir()
+        self.workers = workers
+        self._layers = {}
+        self._lock = threading.Lock()
+
+    def _path(self, kind, key):
+        return os.path.join(self.cache_dir, kind, key + '.json')
+
+    def _load(self, kind, key):
+        try:
+            with open(self._path(kind, key)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _store(self, kind, key, value):
+        path = self._path(kind, key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Another builder may have created it meanwhile.
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+        os.rename(tmp, path)
+
+    def layer_manifest(self, layer_id):
+        """
+        Returns the cached manifest of a layer, or None if it was never
+        built.
+        """
+        with self._lock:
+            if layer_id not in self._layers:
+                manifest = self._load('layers', layer_id)
+                if manifest is None:
+                    return None
+                self._layers[layer_id] = manifest
+            return self._layers[layer_id]
+
+    def _hash_and_store(self, layer_id, spool, slots):
+        try:
+            manifest = hash_layer(spool)
+            self._store('layers', layer_id, manifest)
+            with self._lock:
+                self._layers[layer_id] = manifest
+        finally:
+            spool.close()
+            slots.release()
+
+    def _build(self, image):
+        """
+        Reads the layers of image, hashing every layer without a cached
+        manifest, and returns the layer ids topmost first.
+        """
+        pool = ThreadPool(self.workers)
+        # Bounds the number of layers spooled to disk and not hashed yet.
+        slots = threading.BoundedSemaphore(self.workers * 2)
+        pending = []
+
+        def _layer(layer_id, f):
+            if self.layer_manifest(layer_id) is not None:
+                return
+            slots.acquire()
+            spool = tempfile.TemporaryFile()
+            shutil.copyfileobj(f, spool)
+            spool.seek(0)
+            pending.append(pool.apply_async(self._hash_and_store,
+                                            (layer_id, spool, slots)))
+
+        try:
+            order = layers.read_save(self.client.get_image(image), _layer)
+            for result in pending:
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+        return order
+
+    def layer_chain(self, image):
+        """
+        Returns the layer ids of image topmost first, building the manifest
+        of any layer which has none yet.
+        """
+        iid = self.client.inspect_image(image)['Id']
+        key = iid.replace(':', '-')
+        chain = self._load('images', key)
+        if chain is None or any(self.layer_manifest(l) is None
+                                for l in chain):
+            chain = self._build(image)
+            self._store('images', key, chain)
+        return chain
+
+    def image_manifest(self, image, chain=None):
+        """
+        Returns the merged manifest of image as a dict of path to entry, as
+        in hash_layer(). Whiteouts are applied and hidden entries dropped.
+        """
+        if chain is None:
+            chain = self.layer_chain(image)
+        merged = {}
+        for l in chain:
+            manifest = self.layer_manifest(l)
+            layer = layers.Layer()
+            layer.entries = manifest['entries']
+            layer.whiteouts = set(manifest['whiteouts'])
+            layer.opaque = set(manifest['opaque'])
+            merged[l] = layer
+        return layers.merge(chain, merged, isdir=lambda e: e['type'] == 'd')
@@ -22,15 +22,65 @@
 
 import os
 
+import bisect
 import docker
+import errno
 import json
+import time
 
+from contextlib import contextmanager
+
+from Atomic import lock
 from Atomic import util
 
 from fnmatch import fnmatch as matches
 
 """ Module for mounting and unmounting containerized applications. """
 
+# Largest device id of a device-mapper thin device (24 bits).
+THIN_ID_MAX = 0xffffff
+# How often, and after how long a first pause, device-mapper and umount
+# calls are retried while the device is busy, as udev or a concurrent
+# mount may briefly keep it open.
+BUSY_RETRIES = 5
+BUSY_DELAY = 0.1
+# The mountpoints mount_many() created, which unmount_many() removes again.
+CREATED_MOUNTPOINTS = '/run/atomic/mount-many.json'
+
+
+def _device_lock(name):
+    """
+    Serializes activating, mounting, unmounting and removing the
+    device-mapper device called name between atomic processes.
+    """
+    return lock.locked('device:' + name)
+
+
+@contextmanager
+def _created_mountpoints():
+    """
+    Yields the set of mountpoints created by mount_many(), holding a lock on
+    it for the duration and writing it back afterwards.
+    """
+    with lock.flocked(CREATED_MOUNTPOINTS + '.lock'):
+        try:
+            with open(CREATED_MOUNTPOINTS) as f:
+                created = set(json.load(f))
+        except (IOError, ValueError):
+            created = set()
+        yield created
+        tmp = CREATED_MOUNTPOINTS + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(sorted(created), f)
+        os.rename(tmp, CREATED_MOUNTPOINTS)
+
+
+def _mountpoint_lock(path):
+    """
+    Serializes mounting and unmounting at path between atomic processes.
+    """
+    return lock.locked('mountpoint:' + os.path.realpath(path))
+
 
 class MountError(Exception):
 
@@ -52,6 +102,96 @@ class SelectionMatchError(MountError):
                     '{1}'.format(i, '\n'.join(['\t' + m for m in matches])))
 
 
+class IdentifierIndex(object):
+
+    """
+    Resolves mount identifiers against a single container listing and a
+    single image listing.
+
+    Container names and image repositories are kept in hashes and container
+    and image ids in sorted lists, so that identifiers without wildcards are
+    resolved without scanning the listings. Identifiers with wildcards are
+    matched against every name and tag.
+    """
+
+    def __init__(self, containers, images):
+        self.containers = containers
+        self.images = images
+        self._names = {}
+        for c in containers:
+            for n in c['Names'] or []:
+                self._names.setdefault(n, []).append(c['Id'])
+        self._cids = sorted(c['Id'] for c in containers)
+        self._iids = sorted(set(i['Id'] for i in images))
+        self._repos = {}
+        for i in images:
+            for t in i['RepoTags'] or []:
+                reg, repo, tag = util.decompose(t)
+                self._repos.setdefault(repo, []).append((reg, tag, i))
+
+    @staticmethod
+    def _prefixed(ids, prefix):
+        """
+        Returns the ids of the sorted list ids which start with prefix.
+        """
+        start = end = bisect.bisect_left(ids, prefix)
+        while end < len(ids) and ids[end].startswith(prefix):
+            end += 1
+        return ids[start:end]
+
+    def _containers(self, identifier):
+        if any(c in identifier for c in '*?['):
+            return [c['Id'] for c in self.containers
+                    if (any([n for n in c['Names'] or []
+                             if matches(n, '/' + identifier)]) or
+                        matches(c['Id'], identifier + '*'))]
+        cids = self._names.get('/' + identifier, [])
+        return cids + [c for c in self._prefixed(self._cids, identifier)
+                       if c not in cids]
+
+    def _tagged_images(self, identifier):
+        if any(c in identifier for c in '*?['):
+            return util.image_by_name(identifier, images=self.images)
+        i_reg, i_rep, i_tag = util.decompose(identifier)
+        images = []
+        for reg, tag, i in self._repos.get(i_rep, []):
+            if (not i_reg or reg == i_reg) and (not i_tag or tag == i_tag) \
+                    and not any(i is m for m in images):
+                images.append(i)
+        return images
+
+    def resolve(self, identifier):
+        """
+        Returns a ('container', cid) or ('image', iid) tuple for identifier.
+        """
+        # Determine if identifier is a container
+        containers = self._containers(identifier)
+
+        if len(containers) > 1:
+            raise SelectionMatchError(identifier, containers)
+        elif len(containers) == 1:
+            return 'container', containers[0]
+
+        # Determine if identifier is an image UUID
+        images = self._prefixed(self._iids, identifier)
+
+        if len(images) > 1:
+            raise SelectionMatchError(identifier, images)
+        elif len(images) == 1:
+            return 'image', images[0]
+
+        # Match image tag.
+        images = self._tagged_images(identifier)
+        if len(images) > 1:
+            tags = [t for i in images for t in i['RepoTags']]
+            raise SelectionMatchError(identifier, tags)
+        elif len(images) == 1:
+            return 'image', images[0]['Id']
+
+        raise MountError('{} did not match any image or container.'
+                         ''.format(identifier))
+
+
 class Mount:
 
     """
@@ -75,17 +215,32 @@ class Mount:
         raise NotImplementedError('Mount subclass does not implement unmount()'
                                   ' method.')
 
+    @staticmethod
+    def _subp_busy(cmd):
+        """
+        Runs cmd, retrying with a growing pause while it fails because a
+        device is busy.
+        """
+        for attempt in range(BUSY_RETRIES):
+            r = util.subp(cmd)
+            if r.return_code == 0 or 'busy' not in r.stderr.lower():
+                break
+            time.sleep(BUSY_DELAY * 2 ** attempt)
+        return r
+
     # LVM DeviceMapper Utility Methods
     @staticmethod
-    def _activate_thin_device(name, dm_id, size, pool):
+    def _activate_thin_device(name, dm_id, size, pool, readonly=False):
         """
         Provisions an LVM device-mapper thin device reflecting,
         DM device id 'dm_id' in the docker pool.
         """
-        table = '0 {0} thin /dev/mapper/{1} {2}'.format(int(size) / 512,
+        table = '0 {0} thin /dev/mapper/{1} {2}'.format(int(size) // 512,
                                                         pool, dm_id)
         cmd = ['dmsetup', 'create', name, '--table', table]
-        r = util.subp(cmd)
+        if readonly:
+            cmd.append('--readonly')
+        r = Mount._subp_busy(cmd)
         if r.return_code != 0:
             raise MountError('Failed to create thin device: ' + r.stderr)
 
@@ -94,10 +249,54 @@ class Mount:
         """
         Destroys a thin device via subprocess call.
         """
-        r = util.subp(['dmsetup', 'remove', name])
+        r = Mount._subp_busy(['dmsetup', 'remove', name])
         if r.return_code != 0:
             raise MountError('Could not remove thin device:\n' + r.stderr)
 
+    @staticmethod
+    def _create_thin_snapshot(pool, origin_id, origin_name):
+        """
+        Creates a thin snapshot of DM device id 'origin_id' in the docker
+        pool and returns the device id of the snapshot. Snapshot ids are
+        taken from the top of the thin id space, docker allocates its own
+        from the bottom.
+        """
+        snap_prefix = pool.replace('pool', 'snap-')
+        ids = [n[len(snap_prefix):].split('-', 1)[0]
+               for n in util.subp(['dmsetup', 'ls']).stdout.split()
+               if n.startswith(snap_prefix)]
+        used = [int(i) for i in ids if i.isdigit()]
+        start = min(used + [THIN_ID_MAX + 1]) - 1
+        # An active origin is suspended so the snapshot is consistent.
+        suspend = Mount._is_device_active(origin_name)
+        for snap_id in range(start, start - 64, -1):
+            if suspend:
+                util.subp(['dmsetup', 'suspend', origin_name])
+            try:
+                r = util.subp(['dmsetup', 'message', pool, '0',
+                               'create_snap {0} {1}'.format(snap_id,
+                                                            origin_id)])
+            finally:
+                if suspend:
+                    util.subp(['dmsetup', 'resume', origin_name])
+            if r.return_code == 0:
+                return snap_id
+            if 'File exists' not in r.stderr:
+                raise MountError('Failed to create thin snapshot: ' +
+                                 r.stderr)
+        raise MountError('Failed to find a free thin device id for the '
+                         'snapshot.')
+
+    @staticmethod
+    def _delete_thin_device(pool, dm_id):
+        """
+        Deletes DM device id 'dm_id' from the docker pool.
+        """
+        r = Mount._subp_busy(['dmsetup', 'message', pool, '0',
+                              'delete {0}'.format(dm_id)])
+        if r.return_code != 0:
+            raise MountError('Could not delete thin device:\n' + r.stderr)
+
     @staticmethod
     def _is_device_active(device):
         """
@@ -155,7 +354,7 @@ class Mount:
         """
         Unmounts the directory specified by path.
         """
-        r = util.subp(['umount', path])
+        r = Mount._subp_busy(['umount', path])
         if r.return_code != 0:
             raise ValueError(r.stderr)
 
@@ -174,7 +373,7 @@ class DockerMount(Mount):
         Mount.__init__(self, mountpoint, live)
         self.client = docker.Client()
         self.mnt_mkdir = mnt_mkdir
-
+        self._idx = None
 
     def _create_temp_container(self, iid):
         """
@@ -191,67 +390,42 @@ class DockerMount(Mount):
         except docker.errors.APIError as ex:
             raise MountError('Error creating temporary container:\n' + str(ex))
 
-    def _clone(self, cid):
+    def _index(self):
+        """
+        Returns the IdentifierIndex of all containers and images, built
+        once per instance.
         """
-        Create a temporary image snapshot from a given cid.
+        if self._idx is None:
+            self._idx = IdentifierIndex(self.client.containers(all=True),
+                                        self.client.images(all=True))
+        return self._idx
 
-        Temporary image snapshots are marked with a sentinel label
-        so that they can be cleaned on unmount.
+    def _share_listing(self, other):
         """
-        try:
-            iid = self.client.commit(
-                container=cid,
-                conf={
-                    'Labels': {
-                        'io.projectatomic.Temporary': 'true'
-                    }
-                }
-            )['Id']
-        except docker.errors.APIError as ex:
-            raise MountError(str(ex))
-        return self._create_temp_container(iid)
+        Resolve identifiers against the container and image listing of
+        another DockerMount instead of fetching a new one.
+        """
+        self._idx = other._index()
+
+    def _resolve_identifier(self, identifier):
+        """
+        Returns a ('container', cid) or ('image', iid) tuple for identifier
+        without creating anything.
+        """
+        return self._index().resolve(identifier)
 
     def _identifier_as_cid(self, identifier):
         """
         Returns a container uuid for identifier.
 
         If identifier is an image UUID or image tag, create a temporary
-        container and return its uuid.
+        container and return its uuid. Containers are mounted as they are,
+        read-only ones from a snapshot of their device or layers.
         """
-        def __cname_matches(container, identifier):
-            return any([n for n in container['Names']
-                        if matches(n, '/' + identifier)])
-
-        # Determine if identifier is a container
-        containers = [c['Id'] for c in self.client.containers(all=True)
-                      if (__cname_matches(c, identifier) or
-                          matches(c['Id'], identifier + '*'))]
-
-        if len(containers) > 1:
-            raise SelectionMatchError(identifier, containers)
-        elif len(containers) == 1:
-            c = containers[0]
-            return c if self.live else self._clone(c)
-
-        # Determine if identifier is an image UUID
-        images = [i for i in set(self.client.images(all=True, quiet=True))
-                  if i.startswith(identifier)]
-
-        if len(images) > 1:
-            raise SelectionMatchError(identifier, images)
-        elif len(images) == 1:
-            return self._create_temp_container(images[0])
-
-        # Match image tag.
-        images = util.image_by_name(identifier)
-        if len(images) > 1:
-            tags = [t for i in images for t in i['RepoTags']]
-            raise SelectionMatchError(identifier, tags)
-        elif len(images) == 1:
-            return self._create_temp_container(images[0]['Id'])
-
-        raise MountError('{} did not match any image or container.'
-                         ''.format(identifier))
+        kind, uuid = self._resolve_identifier(identifier)
+        if kind == 'container':
+            return uuid
+        return self._create_temp_container(uuid)
 
     @staticmethod
     def _no_gd_api_dm(cid):
@@ -277,11 +451,104 @@ class DockerMount(Mount):
         driver = self.client.info()['Driver']
         driver_mount_fn = getattr(self, "_mount_" + driver,
                                   self._unsupported_backend)
-        driver_mount_fn(identifier, options)
+        if self.mnt_mkdir:
+            # The mountpoint is claimed by creating it.
+            driver_mount_fn(identifier, options)
+        else:
+            with _mountpoint_lock(self.mountpoint):
+                driver_mount_fn(identifier, options)
 
         # Return mount path so it can be later unmounted by path
         return self.mountpoint
 
+    @classmethod
+    def mount_many(cls, identifiers, parent, options=[], live=False,
+                   workers=4):
+        """
+        Mounts every identifier in its own directory below parent, named
+        after the container or image id. All identifiers are resolved
+        against a single container and image listing, identifiers naming
+        the same container or image share a mount, and at most 'workers'
+        mounts are in progress at a time.
+
+        Returns a dict mapping each identifier to its mountpoint. If any
+        mount fails, the mounts which succeeded are undone and MountError
+        is raised.
+        """
+        listing = cls(parent, live)
+        # Fail on unknown or ambiguous identifiers before mounting anything.
+        uuids = dict((i, listing._resolve_identifier(i)[1])
+                     for i in identifiers)
+
+        def _mount_one(uuid):
+            dm = cls(parent, live, mnt_mkdir=True)
+            dm._share_listing(listing)
+            try:
+                return uuid, dm.mount(uuid, list(options)), None
+            except MountError as e:
+                return uuid, None, e
+
+        results = util.parallel_map(_mount_one, set(uuids.values()), workers)
+        mounted = dict((u, mp) for u, mp, e in results if mp is not None)
+        errors = ['{0}: {1}'.format(u, e) for u, mp, e in results if e]
+        with _created_mountpoints() as created:
+            created.update(os.path.realpath(mp) for mp in mounted.values())
+        if errors:
+            cls.unmount_many(mounted.values(), workers)
+            raise MountError('Failed to mount:\n' + '\n'.join(errors))
+        return dict((i, mounted[u]) for i, u in uuids.items())
+
+    @classmethod
+    def unmount_many(cls, mountpoints, workers=4):
+        """
+        Unmounts and cleans up after a previous mount_many(), running at
+        most 'workers' unmounts at a time. Only the mountpoints which
+        mount_many() created are removed. Raises MountError naming every
+        mountpoint which could not be unmounted.
+        """
+        mountpoints = list(mountpoints)
+        with _created_mountpoints() as created:
+            ours = set(mp for mp in mountpoints
+                       if os.path.realpath(mp) in created)
+
+        def _unmount_one(mountpoint):
+            try:
+                cls(mountpoint, mnt_mkdir=mountpoint in ours).unmount()
+            except (MountError, ValueError) as e:
+                return mountpoint, '{0}: {1}'.format(mountpoint, e)
+            return mountpoint, None
+
+        results = util.parallel_map(_unmount_one, mountpoints, workers)
+        with _created_mountpoints() as created:
+            created.difference_update(os.path.realpath(mp)
+                                      for mp, e in results if not e)
+        errors = [e for mp, e in results if e]
+        if errors:
+            raise MountError('Failed to unmount:\n' + '\n'.join(errors))
+
+    def _make_mountpoint(self, uuid):
+        """
+        If the given mountpoint is just a parent dir for where to mount
+        things by id, then the new mountpoint is the mountpoint plus the
+        first 20 chars of the id.
+        """
+        if self.mnt_mkdir:
+            self.mountpoint = os.path.join(self.mountpoint, uuid[:20])
+            try:
+                os.mkdir(self.mountpoint)
+            except Exception as e:
+                raise MountError(e)
+
+    def _remove_mountpoint(self):
+        """
+        Removes a mountpoint created by _make_mountpoint().
+        """
+        if self.mnt_mkdir:
+            try:
+                os.rmdir(self.mountpoint)
+            except Exception as e:
+                raise MountError(e)
+
     def _unsupported_backend(self, identifier='', options=[]):
         raise MountError('Atomic mount is not supported on the {} docker '
                          'storage backend.'
@@ -313,18 +580,18 @@ class DockerMount(Mount):
                              'mount.')
 
         info = self.client.info()
+        dm_pool = info['DriverStatus'][0][1]
 
-        cid = self._identifier_as_cid(identifier)
+        kind, uuid = self._resolve_identifier(identifier)
+        if kind == 'container' and not self.live:
+            return self._mount_devicemapper_snapshot(uuid, options, dm_pool)
+        if kind == 'image':
+            if self.live:
+                raise MountError('Cannot live mount an image.')
+            return self._mount_devicemapper_image(uuid, options, dm_pool)
 
-        if self.mnt_mkdir:
-            # If the given mount_path is just a parent dir for where
-            # to mount things by cid, then the new mountpoint is the
-            # mount_path plus the first 20 chars of the cid
-            self.mountpoint = os.path.join(self.mountpoint, cid[:20])
-            try:
-                os.mkdir(self.mountpoint)
-            except Exception as e:
-                raise MountError(e)
+        cid = self._identifier_as_cid(identifier)
+        self._make_mountpoint(cid)
 
         cinfo = self.client.inspect_container(cid)
 
@@ -337,7 +604,6 @@ class DockerMount(Mount):
             default_options=[] if self.live else ['ro', 'nosuid', 'nodev'])
 
         dm_dev_name, dm_dev_id, dm_dev_size = '', '', ''
-        dm_pool = info['DriverStatus'][0][1]
 
         try:
             dm_dev_name = cinfo['GraphDriver']['Data']['DeviceName']
@@ -349,26 +615,121 @@ class DockerMount(Mount):
             dm_dev_name = dm_pool.replace('pool', cid)
 
         dm_dev_path = os.path.join('/dev/mapper', dm_dev_name)
-        # If the device isn't already there, activate it.
-        if not os.path.exists(dm_dev_path):
-            if self.live:
-                raise MountError('Error: Attempted to live-mount unactivated '
-                                 'device.')
-            Mount._activate_thin_device(dm_dev_name, dm_dev_id, dm_dev_size,
-                                        dm_pool)
+        with _device_lock(dm_dev_name):
+            # If the device isn't already there, activate it.
+            if not os.path.exists(dm_dev_path):
+                if self.live:
+                    raise MountError('Error: Attempted to live-mount '
+                                     'unactivated device.')
+                Mount._activate_thin_device(dm_dev_name, dm_dev_id,
+                                            dm_dev_size, dm_pool)
+
+            # XFS should get nosuid
+            fstype = Mount._get_fs(dm_dev_path)
+            if fstype.upper() == 'XFS' and 'suid' not in options:
+                if 'nosuid' not in options:
+                    options.append('nosuid')
+            try:
+                Mount.mount_path(dm_dev_path, self.mountpoint,
+                                 optstring=(','.join(options)))
+            except MountError as de:
+                if not self.live:
+                    Mount._remove_thin_device(dm_dev_name)
+                self._cleanup_container(cinfo)
+                raise de
 
-        # XFS should get nosuid
-        fstype = Mount._get_fs(dm_dev_path)
-        if fstype.upper() == 'XFS' and 'suid' not in options:
-            if 'nosuid' not in options:
+    @staticmethod
+    def _xfs_shared_options(dev_path, options):
+        """
+        XFS should get nosuid, and devices which share their filesystem UUID
+        with another docker device, which may be mounted, need nouuid.
+        """
+        if Mount._get_fs(dev_path).upper() == 'XFS':
+            if 'suid' not in options and 'nosuid' not in options:
                 options.append('nosuid')
+            if 'nouuid' not in options:
+                options.append('nouuid')
+
+    def _mount_devicemapper_image(self, iid, options, dm_pool):
+        """
+        Mounts the thin device of image iid read-only, straight from the
+        image's graph driver metadata, without a temporary container.
+        """
+        iinfo = self.client.inspect_image(iid)
         try:
-            Mount.mount_path(dm_dev_path, self.mountpoint,
+            dm_dev_id = iinfo['GraphDriver']['Data']['DeviceId']
+            dm_dev_size = iinfo['GraphDriver']['Data']['DeviceSize']
+        except:
+            # TODO: deprecated when GraphDriver patch makes it upstream
+            dm_dev_id, dm_dev_size = DockerMount._no_gd_api_dm(iid)
+
+        options = self._default_options(
+            options, default_options=['ro', 'nosuid', 'nodev'])
+
+        self._make_mountpoint(iid)
+        dm_dev_name = dm_pool.replace('pool', 'image-' + iid)
+        dm_dev_path = os.path.join('/dev/mapper', dm_dev_name)
+        with _device_lock(dm_dev_name):
+            # Another atomic mount of the same image may have activated it.
+            activated = not os.path.exists(dm_dev_path)
+            try:
+                if activated:
+                    Mount._activate_thin_device(dm_dev_name, dm_dev_id,
+                                                dm_dev_size, dm_pool,
+                                                readonly=True)
+                DockerMount._xfs_shared_options(dm_dev_path, options)
+                Mount.mount_path(dm_dev_path, self.mountpoint,
+                                 optstring=(','.join(options)))
+            except MountError as de:
+                if activated and os.path.exists(dm_dev_path):
+                    Mount._remove_thin_device(dm_dev_name)
+                self._remove_mountpoint()
+                raise de
+
+    def _mount_devicemapper_snapshot(self, cid, options, dm_pool):
+        """
+        Mounts a read-only thin snapshot of the device of container cid.
+        This is a point-in-time view of the container which needs neither
+        docker commit nor a temporary container.
+        """
+        cinfo = self.client.inspect_container(cid)
+        try:
+            dm_dev_name = cinfo['GraphDriver']['Data']['DeviceName']
+            dm_dev_id = cinfo['GraphDriver']['Data']['DeviceId']
+            dm_dev_size = cinfo['GraphDriver']['Data']['DeviceSize']
+        except:
+            # TODO: deprecated when GraphDriver patch makes it upstream
+            dm_dev_id, dm_dev_size = DockerMount._no_gd_api_dm(cid)
+            dm_dev_name = dm_pool.replace('pool', cid)
+
+        options = self._default_options(
+            options, default_con=cinfo['MountLabel'],
+            default_options=['ro', 'nosuid', 'nodev'])
+
+        self._make_mountpoint(cid)
+        # Concurrent snapshots of one container must not interleave their
+        # suspends and resumes of its device.
+        try:
+            with _device_lock(dm_dev_name):
+                snap_id = Mount._create_thin_snapshot(dm_pool, dm_dev_id,
+                                                      dm_dev_name)
+        except MountError:
+            self._remove_mountpoint()
+            raise
+        snap_name = dm_pool.replace('pool', 'snap-{0}-{1}'.format(snap_id,
+                                                                  cid))
+        snap_path = os.path.join('/dev/mapper', snap_name)
+        try:
+            Mount._activate_thin_device(snap_name, snap_id, dm_dev_size,
+                                        dm_pool)
+            DockerMount._xfs_shared_options(snap_path, options)
+            Mount.mount_path(snap_path, self.mountpoint,
                              optstring=(','.join(options)))
         except MountError as de:
-            if not self.live:
-                Mount._remove_thin_device(dm_dev_name)
-            self._cleanup_container(cinfo)
+            if os.path.exists(snap_path):
+                Mount._remove_thin_device(snap_name)
+            Mount._delete_thin_device(dm_pool, snap_id)
+            self._remove_mountpoint()
             raise de
 
     def _mount_overlay(self, identifier, options):
@@ -385,8 +746,20 @@ class DockerMount(Mount):
             raise MountError('The OverlayFS backend does not support '
                              'writeable mounts.')
 
-        cid = self._identifier_as_cid(identifier)
+        kind, uuid = self._resolve_identifier(identifier)
+        if kind == 'image':
+            try:
+                rootdir = self.client.inspect_image(
+                    uuid)['GraphDriver']['Data']['RootDir']
+            except (KeyError, TypeError):
+                rootdir = None
+            if rootdir:
+                return self._mount_overlay_image(uuid, rootdir)
+
+        cid = uuid if kind == 'container' else \
+            self._identifier_as_cid(identifier)
         cinfo = self.client.inspect_container(cid)
+        self._make_mountpoint(cid)
 
         ld, ud, wd = '', '', ''
         try:
@@ -396,17 +769,116 @@ class DockerMount(Mount):
         except:
             ld, ud, wd = DockerMount._no_gd_api_overlay(cid)
 
-        options += ['ro', 'lowerdir=' + ld, 'upperdir=' + ud, 'workdir=' + wd]
+        if kind == 'container':
+            # Stack the container's upper dir read-only on top of its lower
+            # dir rather than committing the container to a new image.
+            options += ['ro', 'lowerdir=' + ud + ':' + ld]
+        else:
+            options += ['ro', 'lowerdir=' + ld, 'upperdir=' + ud,
+                        'workdir=' + wd]
         optstring = ','.join(options)
         cmd = ['mount', '-t', 'overlay', '-o', optstring, 'overlay',
                self.mountpoint]
         status = util.subp(cmd)
 
         if status.return_code != 0:
-            self._cleanup_container(cinfo)
+            if kind == 'container':
+                self._remove_mountpoint()
+            else:
+                self._cleanup_container(cinfo)
             raise MountError('Failed to mount OverlayFS device.\n' +
                              status.stderr)
 
+    def _mount_overlay_image(self, iid, rootdir):
+        """
+        Bind mounts the root directory of an OverlayFS image layer
+        read-only, without a temporary container.
+        """
+        self._make_mountpoint(iid)
+        try:
+            self._bind_ro(rootdir)
+        except MountError as de:
+            self._remove_mountpoint()
+            raise de
+
+    def _bind_ro(self, rootdir):
+        """
+        Bind mounts rootdir read-only at the mountpoint.
+        """
+        Mount.mount_path(rootdir, self.mountpoint, bind=True)
+        try:
+            Mount.mount_path(rootdir, self.mountpoint,
+                             optstring='remount,ro,bind')
+        except MountError:
+            Mount.unmount_path(self.mountpoint)
+            raise
+
+    @staticmethod
+    def _overlay2_lowerdir(dirs):
+        """
+        Returns the lowerdir option for the overlay2 layer dirs (topmost
+        first), and the directory mount has to run in. When the full paths
+        would not fit into the one page the kernel accepts for mount
+        options, the short 'l/<link>' names docker keeps for every layer are
+        used, relative to the overlay2 root.
+        """
+        lowerdir = 'lowerdir=' + ':'.join(dirs)
+        if len(lowerdir) < os.sysconf('SC_PAGE_SIZE') - 256:
+            return lowerdir, None
+        root = os.path.dirname(os.path.dirname(dirs[0]))
+        links = []
+        for d in dirs:
+            with open(os.path.join(os.path.dirname(d), 'link')) as f:
+                links.append(os.path.join('l', f.read().strip()))
+        return 'lowerdir=' + ':'.join(links), root
+
+    def _mount_overlay2(self, identifier, options):
+        """
+        OverlayFS (overlay2) mount backend. Images and containers are
+        mounted read-only by stacking their layer dirs, as found in their
+        graph driver metadata, without a temporary container.
+        """
+        if os.geteuid() != 0:
+            raise MountError('Insufficient privileges to mount device.')
+
+        if self.live:
+            raise MountError('The OverlayFS backend does not support live '
+                             'mounts.')
+        elif 'rw' in options:
+            raise MountError('The OverlayFS backend does not support '
+                             'writeable mounts.')
+
+        kind, uuid = self._resolve_identifier(identifier)
+        if kind == 'container':
+            info = self.client.inspect_container(uuid)
+        else:
+            info = self.client.inspect_image(uuid)
+        try:
+            data = info['GraphDriver']['Data']
+            dirs = [data['UpperDir']]
+        except (KeyError, TypeError):
+            raise MountError('{} has no overlay2 graph driver data.'
+                             ''.format(identifier))
+        if data.get('LowerDir'):
+            dirs += data['LowerDir'].split(':')
+
+        self._make_mountpoint(uuid)
+        try:
+            if len(dirs) == 1:
+                # A single layer image; overlay needs two lower dirs.
+                return self._bind_ro(dirs[0])
+            lowerdir, cwd = DockerMount._overlay2_lowerdir(dirs)
+            optstring = ','.join(options + ['ro', lowerdir])
+            cmd = ['mount', '-t', 'overlay', '-o', optstring, 'overlay',
+                   os.path.abspath(self.mountpoint)]
+            status = util.subp(cmd, cwd=cwd)
+            if status.return_code != 0:
+                raise MountError('Failed to mount OverlayFS device.\n' +
+                                 status.stderr)
+        except MountError as de:
+            self._remove_mountpoint()
+            raise de
+
     def _cleanup_container(self, cinfo):
         """
         Remove a container and clean up its image if necessary.
@@ -429,11 +901,7 @@ class DockerMount(Mount):
         # If we are creating temporary dirs for mount points
         # based on the cid, then we should rmdir them while
         # cleaning up.
-        if self.mnt_mkdir:
-            try:
-                os.rmdir(self.mountpoint)
-            except Exception as e:
-                raise MountError(e)
+        self._remove_mountpoint()
 
     def unmount(self):
         """
@@ -442,7 +910,8 @@ class DockerMount(Mount):
         driver = self.client.info()['Driver']
         driver_unmount_fn = getattr(self, "_unmount_" + driver,
                                     self._unsupported_backend)
-        driver_unmount_fn()
+        with _mountpoint_lock(self.mountpoint):
+            driver_unmount_fn()
 
     def _unmount_devicemapper(self):
         """
@@ -456,6 +925,28 @@ class DockerMount(Mount):
             raise MountError('Device mounted at {} is not a docker container.'
                              ''.format(self.mountpoint))
 
+        snap_prefix = pool.replace('pool', 'snap-')
+        if dev_name.startswith(snap_prefix):
+            # A snapshot of a container, not a temporary container.
+            snap_id = dev_name[len(snap_prefix):].split('-', 1)[0]
+            Mount.unmount_path(self.mountpoint)
+            Mount._remove_thin_device(dev_name)
+            Mount._delete_thin_device(pool, snap_id)
+            self._remove_mountpoint()
+            return
+
+        if dev_name.startswith(pool.replace('pool', 'image-')):
+            # An image device activated by atomic mount. It stays active
+            # while other mounts of the same image still use it.
+            with _device_lock(dev_name):
+                Mount.unmount_path(self.mountpoint)
+                r = util.subp(['dmsetup', 'remove', dev_name])
+            if r.return_code != 0 and 'busy' not in r.stderr:
+                raise MountError('Could not remove thin device:\n' +
+                                 r.stderr)
+            self._remove_mountpoint()
+            return
+
         cid = dev_name.replace(pool.replace('pool', ''), '')
         try:
             self.client.inspect_container(cid)
@@ -464,17 +955,18 @@ class DockerMount(Mount):
                              'with any container.'.format(dev_name,
                                                           self.mountpoint))
 
-        Mount.unmount_path(self.mountpoint)
-        cinfo = self.client.inspect_container(cid)
+        with _device_lock(dev_name):
+            Mount.unmount_path(self.mountpoint)
+            cinfo = self.client.inspect_container(cid)
 
-        # Was the container live mounted? If so, done.
-        # TODO: Container.Config.Env should be {} (iterable) not None.
-        #       Fix in docker-py.
-        env = cinfo['Config']['Env']
-        if (env and '_ATOMIC_TEMP_CONTAINER' not in env) or not env:
-            return
+            # Was the container live mounted? If so, done.
+            # TODO: Container.Config.Env should be {} (iterable) not None.
+            #       Fix in docker-py.
+            env = cinfo['Config']['Env']
+            if (env and '_ATOMIC_TEMP_CONTAINER' not in env) or not env:
+                return
 
-        Mount._remove_thin_device(dev_name)
+            Mount._remove_thin_device(dev_name)
         self._cleanup_container(cinfo)
 
     def _get_overlay_mount_cid(self):
@@ -487,8 +979,16 @@ class DockerMount(Mount):
             raise MountError('No devices mounted at that location.')
         optstring = r.stdout.strip().split('\n')[-1]
         upperdir = [o.replace('upperdir=', '') for o in optstring.split(',')
-                    if o.startswith('upperdir=')][0]
-        cdir = upperdir.rsplit('/', 1)[0]
+                    if o.startswith('upperdir=')]
+        if not upperdir:
+            # Container snapshots stack the upper dir on top of the lower.
+            upperdir = [o.replace('lowerdir=', '').split(':')[0]
+                        for o in optstring.split(',')
+                        if o.startswith('lowerdir=')]
+        if not upperdir:
+            raise MountError('The device mounted at that location is not a '
+                             'docker container.')
+        cdir = upperdir[0].rsplit('/', 1)[0]
         if not cdir.startswith('/var/lib/docker/overlay/'):
             raise MountError('The device mounted at that location is not a '
                              'docker container.')
@@ -498,8 +998,235 @@ class DockerMount(Mount):
         """
         OverlayFS unmount backend.
         """
-        if Mount.get_dev_at_mountpoint(self.mountpoint) != 'overlay':
-            raise MountError('Device mounted at {} is not an atomic mount.')
+        dev = Mount.get_dev_at_mountpoint(self.mountpoint)
+        if '/overlay/' in dev.rsplit('[', 1)[-1] and dev.endswith('/root]'):
+            # The read-only bind mount of an image layer.
+            Mount.unmount_path(self.mountpoint)
+            self._remove_mountpoint()
+            return
+        if dev != 'overlay':
+            raise MountError('Device mounted at {} is not an atomic mount.'
+                             ''.format(self.mountpoint))
         cid = self._get_overlay_mount_cid()
         Mount.unmount_path(self.mountpoint)
-        self._cleanup_container(self.client.inspect_container(cid))
+        cinfo = self.client.inspect_container(cid)
+        env = cinfo['Config']['Env']
+        if not env or '_ATOMIC_TEMP_CONTAINER' not in env:
+            # A snapshot of a container, not a temporary container.
+            self._remove_mountpoint()
+            return
+        self._cleanup_container(cinfo)
+
+    def _unmount_overlay2(self):
+        """
+        OverlayFS (overlay2) unmount backend.
+        """
+        dev = Mount.get_dev_at_mountpoint(self.mountpoint)
+        if dev == 'overlay':
+            r = util.subp(['findmnt', '-o', 'OPTIONS', '-n',
+                           self.mountpoint])
+            optstring = r.stdout.strip().split('\n')[-1]
+            lowerdir = [o.replace('lowerdir=', '')
+                        for o in optstring.split(',')
+                        if o.startswith('lowerdir=')]
+            if not lowerdir or not ('/overlay2/' in lowerdir[0] or
+                                    lowerdir[0].startswith('l/')):
+                raise MountError('The device mounted at that location is not '
+                                 'a docker image or container.')
+        elif not ('/overlay2/' in dev.rsplit('[', 1)[-1] and
+                  dev.endswith('/diff]')):
+            raise MountError('Device mounted at {} is not an atomic mount.'
+                             ''.format(self.mountpoint))
+        Mount.unmount_path(self.mountpoint)
+        self._remove_mountpoint()
+
+
+class MountCache(object):
+
+    """
+    A cache of read-only image mounts which is shared between processes.
+
+    Mounts are keyed by image Id, so repeated mounts of an unchanged image
+    reuse the existing mount and only take a reference on it. Mounts which
+    are no longer referenced stay mounted until they have been idle for
+    'ttl' seconds or room is needed for a new mount, in which case the least
+    recently used one is evicted. At most 'max_mounts' mounts are active at
+    a time, though images being mounted concurrently may briefly exceed it.
+    The references live in a state file, by process id, so that separate
+    processes share the same mounts and the references of processes which
+    died are dropped. The state is only locked while it is read and
+    updated, and mounting one image does not hold up another.
+    """
+
+    STATE_FILE = '/run/atomic/mount-cache.json'
+    MOUNT_DIR = '/run/atomic/mounts'
+
+    def __init__(self, max_mounts=16, ttl=600, state_file=STATE_FILE,
+                 mount_dir=MOUNT_DIR, lock_dir=lock.LOCK_DIR):
+        self.max_mounts = max_mounts
+        self.ttl = ttl
+        self.state_file = state_file
+        self.mount_dir = mount_dir
+        self.lock_dir = lock_dir
+        self.client = docker.Client()
+
+    @staticmethod
+    def _is_mounted(path):
+        return os.path.ismount(path)
+
+    @staticmethod
+    def _alive(pid):
+        try:
+            os.kill(int(pid), 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    @contextmanager
+    def _state(self):
+        """
+        Yields the cache state, holding an exclusive lock on it for the
+        duration and writing it back afterwards.
+        """
+        for d in (os.path.dirname(self.state_file), self.mount_dir):
+            try:
+                os.makedirs(d)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise MountError(e)
+
+        with lock.flocked(self.state_file + '.lock'):
+            try:
+                with open(self.state_file) as f:
+                    state = json.load(f)
+            except (IOError, ValueError):
+                state = {}
+            # Drop entries whose mount has disappeared behind our back.
+            for iid in [i for i in state
+                        if not self._is_mounted(state[i]['mountpoint'])]:
+                del state[iid]
+            # And the references of processes which are gone.
+            for entry in state.values():
+                holders = entry.get('holders', {})
+                entry['holders'] = dict((p, n) for p, n in holders.items()
+                                        if self._alive(p))
+                entry['refs'] = sum(entry['holders'].values())
+            yield state
+            tmp = self.state_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp, self.state_file)
+
+    def _image_id(self, identifier):
+        try:
+            return self.client.inspect_image(identifier)['Id']
+        except docker.errors.APIError:
+            raise MountError('{} did not match any image.'.format(identifier))
+
+    @staticmethod
+    def _evictable(state, now, ttl, max_mounts, room=0):
+        """
+        Returns the Ids of the idle entries of state to evict: every entry
+        idle for longer than ttl, plus the least recently used idle entries
+        needed to make room for 'room' more mounts.
+        """
+        idle = sorted([i for i in state if state[i]['refs'] <= 0],
+                      key=lambda i: state[i]['last_used'])
+        evict = [i for i in idle if now - state[i]['last_used'] > ttl]
+        for i in idle:
+            if len(state) - len(evict) + room <= max_mounts:
+                break
+            if i not in evict:
+                evict.append(i)
+        return evict
+
+    def _evict(self, state, room=0):
+        for iid in MountCache._evictable(state, time.time(), self.ttl,
+                                         self.max_mounts, room):
+            mountpoint = state.pop(iid)['mountpoint']
+            DockerMount(mountpoint).unmount()
+            os.rmdir(mountpoint)
+
+    def acquire(self, identifier):
+        """
+        Returns the path of the root filesystem of the image referred to by
+        identifier, mounting it read-only unless it already is. Every
+        acquire() must be paired with a release().
+        """
+        iid = self._image_id(identifier)
+        # Only one process mounts a given image, the others wait for it.
+        with lock.locked('mount-cache:' + iid, lock_dir=self.lock_dir):
+            with self._state() as state:
+                if iid in state:
+                    return self._take(state[iid])
+                self._evict(state, room=1)
+                if len(state) >= self.max_mounts:
+                    raise MountError('All {} cached mounts are in use.'
+                                     ''.format(self.max_mounts))
+            mountpoint = os.path.join(self.mount_dir,
+                                      iid.split(':', 1)[-1][:20])
+            if not os.path.isdir(mountpoint):
+                os.mkdir(mountpoint)
+            dm = DockerMount(mountpoint)
+            try:
+                dm.mount(iid)
+            except:
+                os.rmdir(mountpoint)
+                raise
+            root = mountpoint
+            # devicemapper devices keep the filesystem in rootfs/
+            if dm.client.info()['Driver'] == 'devicemapper':
+                root = os.path.join(mountpoint, 'rootfs')
+            with self._state() as state:
+                state[iid] = {'mountpoint': mountpoint, 'root': root,
+                              'refs': 0, 'holders': {}}
+                return self._take(state[iid])
+
+    @staticmethod
+    def _take(entry):
+        pid = str(os.getpid())
+        entry['holders'][pid] = entry['holders'].get(pid, 0) + 1
+        entry['refs'] += 1
+        entry['last_used'] = time.time()
+        return entry['root']
+
+    def release(self, identifier):
+        """
+        Drops a reference taken by acquire() and evicts expired idle mounts.
+        """
+        iid = self._image_id(identifier)
+        with self._state() as state:
+            if iid in state:
+                entry = state[iid]
+                pid = str(os.getpid())
+                if entry['holders'].get(pid, 0) > 0:
+                    entry['holders'][pid] -= 1
+                    entry['refs'] -= 1
+                    if not entry['holders'][pid]:
+                        del entry['holders'][pid]
+                entry['last_used'] = time.time()
+            self._evict(state)
+
+    @contextmanager
+    def mounted(self, identifier):
+        """
+        Yields the root filesystem path of identifier for the duration of a
+        with block.
+        """
+        root = self.acquire(identifier)
+        try:
+            yield root
+        finally:
+            self.release(identifier)
+
+    def evict(self, all_idle=False):
+        """
+        Unmounts idle mounts which have expired, or every idle mount if
+        all_idle is set.
+        """
+        with self._state() as state:
+            if all_idle:
+                for iid in state:
+                    if state[iid]['refs'] <= 0:
+                        state[iid]['last_used'] = 0
+            self._evict(state)
@@ -1,6 +1,27 @@
 import sys
 import requests
+import bisect
+import gzip
+import hashlib
+import io
 import json
+import os
+import random
+import tarfile
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    import Queue as queue
+except ImportError:  # py3 compat
+    import queue
+
+from requests.adapters import HTTPAdapter
+
+from Atomic import layers
 
 # On latest Fedora, this is a symlink
 if hasattr(requests, 'packages'):
@@ -20,12 +41,512 @@ else:
             urllib3.disable_warnings()
 
 
+# Seconds to wait for a connection to, and for a response from, Pulp.
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 300
+# Connections kept open to Pulp for reuse.
+POOL_SIZE = 4
+# Bytes per upload call, and upload calls in flight at a time.
+CHUNK_SIZE = 1048576
+UPLOAD_WORKERS = 4
+# Seconds to wait for spawned tasks, and the first and longest pauses
+# between polls of them.
+TASK_TIMEOUT = 1800
+TASK_POLL_MIN = 0.5
+TASK_POLL_MAX = 10
+# Attempts of a call failing transiently, and the first and longest pauses
+# between them.
+RETRIES = 5
+RETRY_MIN = 1
+RETRY_MAX = 30
+# Statuses worth retrying a call for, and those of which pulp has not
+# acted on the request, so even a POST can be retried.
+RETRY_STATUS = (429, 500, 502, 503, 504)
+UNPROCESSED_STATUS = (429, 503)
+# Byte strings buffered between the threads of a QueuePipe.
+PIPE_DEPTH = 64
+# Compression of uploads, and its level from 1 (fastest) to 9 (smallest).
+COMPRESSION = 'gzip'
+COMPRESS_LEVEL = 6
+# Bytes read at a time while compressing.
+COMPRESS_CHUNK = 65536
+# Upper bounds, in seconds, of the buckets of the chunk upload latency
+# histogram.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Least seconds between redraws of the progress line.
+PROGRESS_INTERVAL = 0.5
+# Where the progress of uploads is kept, so they can be resumed.
+STATE_DIR = '~/.pulp/uploads'
+# Least seconds between writes of the progress of an upload.
+STATE_INTERVAL = 1.0
+
+
+class PulpError(Exception):
+
+    """A pulp call which failed, with its HTTP status code if it had one"""
+
+    def __init__(self, val, status_code=None):
+        self.val = val
+        self.status_code = status_code
+
+    def __str__(self):
+        return str(self.val)
+
+
+class UploadStats(object):
+
+    """
+    The number of calls made to pulp per request type, their retries,
+    failures and total seconds over all attempts, a histogram of the
+    seconds successful chunk uploads took, the bytes read from docker and
+    PUT, the seconds spent in each phase of the uploads: reading the
+    docker save stream ('save'), uploading, importing, publishing and
+    exporting, and the sha256 digests of the save stream of every image
+    uploaded and of its layers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+        self.bytes_put = 0
+        self.bytes_read = 0
+        self.phases = {}
+        self.put_latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.images = {}
+
+    def add_phase(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        """Adds the duration of a with block to phase name"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - start)
+
+    def digests(self, image, digest, layer_digests):
+        with self._lock:
+            self.images[image] = {'digest': digest,
+                                  'layers': dict(layer_digests)}
+
+    def read(self, nbytes, seconds):
+        """Records a read of the docker save stream"""
+        self.add_phase('save', seconds)
+        with self._lock:
+            self.bytes_read += nbytes
+
+    def record(self, req_type, seconds, retry=False, failed=False,
+               nbytes=0):
+        """Records one attempt of a call"""
+        with self._lock:
+            c = self.calls.setdefault(req_type, {'calls': 0, 'retries': 0,
+                                                 'failures': 0,
+                                                 'seconds': 0.0})
+            c['retries' if retry else 'calls'] += 1
+            c['failures'] += 1 if failed else 0
+            c['seconds'] += seconds
+            if not failed:
+                self.bytes_put += nbytes
+            if req_type == 'put' and not failed:
+                self.put_latency[bisect.bisect_left(LATENCY_BUCKETS,
+                                                    seconds)] += 1
+
+    def summary(self):
+        with self._lock:
+            latency = dict(('<={0}'.format(b), n) for b, n in
+                           zip(LATENCY_BUCKETS, self.put_latency))
+            latency['>{0}'.format(LATENCY_BUCKETS[-1])] = \
+                self.put_latency[-1]
+            return {'calls': dict((k, dict(v))
+                                  for k, v in self.calls.items()),
+                    'bytes_put': self.bytes_put,
+                    'bytes_read': self.bytes_read,
+                    'phases': dict(self.phases),
+                    'put_latency': latency,
+                    'images': dict((k, dict(v))
+                                   for k, v in self.images.items())}
+
+
+def _human_size(n):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024:
+            return '{0:.1f} {1}'.format(n, unit)
+        n /= 1024.0
+    return '{0:.1f} TiB'.format(n)
+
+
+class Progress(object):
+
+    """
+    The progress of the uploads of a PulpServer, as read from the docker
+    save streams of their images. On a TTY, one line sums up the images in
+    flight, with the share read, the rate and the time left, and is redrawn
+    at most every PROGRESS_INTERVAL seconds; a line is left above it for
+    every image finished. Elsewhere a dot is written for every chunk
+    uploaded.
+    """
+
+    def __init__(self, out=None):
+        self.out = out or sys.stdout
+        self.tty = hasattr(self.out, 'isatty') and self.out.isatty()
+        self.images = []
+        self._drawn = 0
+        self._lock = threading.Lock()
+
+    def image(self, name, total):
+        """Returns the ImageProgress of an image of total bytes"""
+        image = ImageProgress(self, name, total)
+        with self._lock:
+            self.images.append(image)
+        return image
+
+    def _read(self):
+        with self._lock:
+            if self.tty and time.time() - self._drawn >= PROGRESS_INTERVAL:
+                self._draw(self.images)
+
+    def _uploaded(self):
+        if not self.tty:
+            with self._lock:
+                self.out.flush()
+                self.out.write(".")
+
+    def _finish(self, image):
+        with self._lock:
+            self.images.remove(image)
+            if self.tty:
+                self._draw([image])
+                self.out.write("\n")
+                if self.images:
+                    self._draw(self.images)
+            else:
+                self.out.write("\n")
+            self.out.flush()
+
+    def _draw(self, images):
+        self._drawn = time.time()
+        done = sum(i.done for i in images)
+        total = sum(i.total for i in images) \
+            if all(i.total for i in images) else 0
+        rate = sum(i.done / max(self._drawn - i.start, 0.001)
+                   for i in images)
+        if len(images) == 1:
+            line = '{0}: {1}'.format(images[0].name, _human_size(done))
+        else:
+            line = '{0} images: {1}'.format(len(images), _human_size(done))
+        if total:
+            line += ' of {0} ({1}%)'.format(
+                _human_size(total), min(100, int(100 * done / total)))
+        line += ', {0}/s'.format(_human_size(rate))
+        if total and rate and done < total:
+            left = int((total - done) / rate)
+            line += ', {0}:{1:02d} left'.format(left // 60, left % 60)
+        self.out.write('\r' + line.ljust(79))
+        self.out.flush()
+
+
+class ImageProgress(object):
+
+    """
+    The progress of uploading one image of 'total' bytes, drawn by the
+    Progress of its server.
+    """
+
+    def __init__(self, progress, name, total):
+        self.progress = progress
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+
+    def read(self, nbytes):
+        with self.progress._lock:
+            self.done += nbytes
+        self.progress._read()
+
+    def uploaded(self):
+        self.progress._uploaded()
+
+    def finish(self):
+        self.progress._finish(self)
+
+
+class MeteredStream(object):
+
+    """
+    Reads stream, recording the bytes read and the time spent waiting for
+    them in stats and progress.
+    """
+
+    def __init__(self, stream, stats, progress=None):
+        self.stream = stream
+        self.stats = stats
+        self.progress = progress
+
+    def read(self, size):
+        start = time.time()
+        data = self.stream.read(size)
+        self.stats.read(len(data), time.time() - start)
+        if self.progress:
+            self.progress.read(len(data))
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+class PulpTaskError(Exception):
+
+    """A pulp task which failed, or did not finish in time"""
+
+    def __init__(self, val, task=None):
+        self.val = val
+        self.task = task
+
+    def __str__(self):
+        return str(self.val)
+
+
+class QueuePipe(object):
+
+    """
+    A pipe between a thread writing a stream and one reading it, through a
+    queue of at most 'depth' byte strings. The writer calls close() at the
+    end of the stream, or fail() with the exception which cut it short,
+    which read() then raises. The reader calls abort() if it stops
+    reading early, which makes write(), and read() by a reader waiting on
+    the writer, raise.
+    """
+
+    def __init__(self, depth=PIPE_DEPTH):
+        self._queue = queue.Queue(depth)
+        self._parts = []
+        self._buffered = 0
+        self._eof = False
+        self._error = None
+        self._aborted = threading.Event()
+
+    def write(self, data):
+        if not data:
+            return
+        while True:
+            if self._aborted.is_set():
+                raise IOError('The reader of the pipe went away.')
+            try:
+                self._queue.put(bytes(data), timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _end(self):
+        while not self._aborted.is_set():
+            try:
+                self._queue.put(None, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        self._end()
+
+    def fail(self, error):
+        self._error = error
+        self._end()
+
+    def abort(self):
+        self._aborted.set()
+
+    def flush(self):
+        pass
+
+    def read(self, size):
+        while self._buffered < size and not self._eof:
+            try:
+                data = self._queue.get(timeout=0.1)
+            except queue.Empty:
+                if self._aborted.is_set():
+                    raise IOError('The pipe was aborted.')
+                continue
+            if data is None:
+                self._eof = True
+                if self._error:
+                    raise self._error
+            else:
+                self._parts.append(data)
+                self._buffered += len(data)
+        data = b''.join(self._parts)
+        self._parts = [data[size:]] if len(data) > size else []
+        self._buffered = len(data) - len(data[:size])
+        return data[:size]
+
+
+def filter_save(stream, skip, out):
+    """
+    Copies the 'docker save' tar stream to the file object out, leaving out
+    the directory of every layer for which skip(layer_id) is true. skip is
+    called once per layer, when its directory comes up in the stream. The
+    manifest.json, which lists every layer, is copied last, and only if no
+    layer was left out.
+    """
+    skipped = {}
+    manifest = None
+    tar_in = tarfile.open(fileobj=stream, mode='r|')
+    tar_out = tarfile.open(fileobj=out, mode='w|')
+    for member in tar_in:
+        parts = layers.normpath(member.name).split('/', 1)
+        if parts == ['manifest.json']:
+            manifest = (member, tar_in.extractfile(member).read())
+            continue
+        if len(parts) == 2 or member.isdir():
+            if parts[0] not in skipped:
+                skipped[parts[0]] = skip(parts[0])
+            if skipped[parts[0]]:
+                continue
+        tar_out.addfile(member, tar_in.extractfile(member)
+                        if member.isreg() else None)
+    if manifest and not any(skipped.values()):
+        tar_out.addfile(manifest[0], io.BytesIO(manifest[1]))
+    tar_out.close()
+    tar_in.close()
+
+
+def compress(stream, out, level=COMPRESS_LEVEL):
+    """
+    Writes stream gzip compressed to the file object out. The output only
+    depends on the input and level, so a resumed upload sends the same
+    bytes.
+    """
+    gz = gzip.GzipFile(filename='', mode='wb', compresslevel=level,
+                       fileobj=out, mtime=0)
+    for data in iter(lambda: stream.read(COMPRESS_CHUNK), b''):
+        gz.write(data)
+    gz.close()
+
+
+class UploadState(object):
+
+    """
+    The progress of uploading one image to one repository: the pulp upload
+    id, the image Id, the chunk size, the layers left out of the upload as
+    pulp already has them and those uploaded, as decided while the image
+    was read, the compression of the upload and its level,
+    and the sha256 of every chunk pulp has acknowledged, by offset. It is
+    written to path, if given, at most every STATE_INTERVAL seconds while
+    chunks are acknowledged.
+    """
+
+    def __init__(self, path, upload_id, image_id, chunk_size, chunks=None,
+                 skip_layers=None, compression=None,
+                 compress_level=COMPRESS_LEVEL, upload_layers=None):
+        self.path = path
+        self.upload_id = upload_id
+        self.image_id = image_id
+        self.chunk_size = chunk_size
+        self.chunks = chunks or {}
+        self.skip_layers = skip_layers or []
+        self.upload_layers = upload_layers or []
+        self.compression = compression
+        self.compress_level = compress_level
+        self._lock = threading.Lock()
+        self._saved = 0
+
+    @classmethod
+    def load(cls, path):
+        """Returns the state stored at path, or None"""
+        try:
+            with open(path) as f:
+                s = json.load(f)
+            return cls(path, s['upload_id'], s['image_id'], s['chunk_size'],
+                       s['chunks'], s.get('skip_layers'),
+                       s.get('compression'),
+                       s.get('compress_level', COMPRESS_LEVEL),
+                       s.get('upload_layers'))
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def decision(self, layer_id):
+        """
+        Whether layer_id was left out of the upload, or None if that was
+        not decided yet.
+        """
+        with self._lock:
+            if layer_id in self.skip_layers:
+                return True
+            if layer_id in self.upload_layers:
+                return False
+            return None
+
+    def decide(self, layer_id, skip):
+        with self._lock:
+            (self.skip_layers if skip else self.upload_layers).append(
+                layer_id)
+
+    def acknowledged(self, offset, digest):
+        """Was the chunk at offset, with sha256 digest, uploaded before?"""
+        return self.chunks.get(str(offset)) == digest
+
+    def acknowledge(self, offset, digest):
+        with self._lock:
+            self.chunks[str(offset)] = digest
+            if time.time() - self._saved >= STATE_INTERVAL:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        self._saved = time.time()
+        if not self.path:
+            return
+        d = os.path.dirname(self.path)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        fd, tmp = tempfile.mkstemp(dir=d)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'upload_id': self.upload_id,
+                       'image_id': self.image_id,
+                       'chunk_size': self.chunk_size,
+                       'chunks': self.chunks,
+                       'skip_layers': self.skip_layers,
+                       'upload_layers': self.upload_layers,
+                       'compression': self.compression,
+                       'compress_level': self.compress_level}, f)
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        if self.path and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
 class PulpServer(object):
 
     """Interact with Pulp API"""
 
     def __init__(self, server_url, username, password, verify_ssl,
-                 docker_client):
+                 docker_client, pool_size=POOL_SIZE,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                 chunk_size=CHUNK_SIZE, upload_workers=UPLOAD_WORKERS,
+                 queue_depth=None, state_dir=STATE_DIR,
+                 task_timeout=TASK_TIMEOUT, dedup_layers=True,
+                 compression=COMPRESSION, compress_level=COMPRESS_LEVEL):
+        """
+        All calls go through one requests session, which keeps up to
+        pool_size connections to the server alive for reuse. timeout is
+        the (connect, read) timeout of every call in seconds.
+
+        Images are uploaded in chunks of chunk_size bytes by upload_workers
+        threads, with up to queue_depth (by default upload_workers) chunks
+        read ahead of them. Their progress is kept in state_dir.
+
+        Tasks spawned by pulp are waited for up to task_timeout seconds.
+        If dedup_layers is set, image layers pulp already has are not
+        uploaded again. Uploads are compressed with compression, 'gzip' or
+        None, at compress_level.
+        """
         self._server_url = server_url
         self._username = username
         self._password = password
@@ -36,15 +557,116 @@ class PulpServer(object):
         self._importer = "docker_importer"
         self._export_dir = "/var/www/pub/docker/web/"
         self._unit_type_id = "docker_image"
-        self._chunk_size = 1048576  # 1 MB per upload call
+        if chunk_size < 1:
+            raise ValueError('Invalid chunk_size: {0}'.format(chunk_size))
+        if upload_workers < 1:
+            raise ValueError('Invalid upload_workers: {0}'
+                             ''.format(upload_workers))
+        self._chunk_size = chunk_size
+        self._upload_workers = upload_workers
+        self._queue_depth = queue_depth or upload_workers
+        self._state_dir = os.path.expanduser(state_dir)
+        self._task_timeout = task_timeout
+        self._dedup_layers = dedup_layers
+        if compression not in (None, 'gzip'):
+            raise ValueError('Unknown compression: {0}'.format(compression))
+        if compress_level not in range(1, 10):
+            raise ValueError('Unknown compress_level: {0}'
+                             ''.format(compress_level))
+        self._compression = compression
+        self._compress_level = compress_level
+        # Repositories known to exist, for the life of the session.
+        self._repos = set()
+        self.stats = UploadStats()
+        self.progress = Progress()
+        self._timeout = timeout
+        self._session = requests.Session()
+        self._session.auth = (username, password)
+        self._session.verify = verify_ssl
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=max(pool_size, upload_workers))
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def close(self):
+        """Close the connections to the server"""
+        self._session.close()
 
     def _call_pulp(self, url, req_type='get', payload=None):
+        """
+        Calls pulp and returns the JSON of its response, or None if it had
+        none. Connection failures, timeouts and the statuses in
+        RETRY_STATUS are retried up to RETRIES times with jittered,
+        growing pauses, honoring Retry-After. A POST is only retried when
+        pulp cannot have acted on it. Raises PulpError if the call fails
+        for good.
+        """
+        if req_type not in ('get', 'post', 'put', 'delete'):
+            raise ValueError('Invalid value of "req_type" parameter: {0}'
+                             ''.format(req_type))
+        nbytes = len(payload) if req_type == 'put' and payload else 0
+        delay = RETRY_MIN
+        for attempt in range(RETRIES):
+            start = time.time()
+            retry_after = None
+            try:
+                r = self._request(url, req_type, payload)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = PulpError('Pulp call {0} {1} failed: {2}'.format(
+                    req_type.upper(), url, e))
+                retryable = req_type != 'post' or \
+                    isinstance(e, requests.exceptions.ConnectTimeout)
+            else:
+                if r.status_code < 400:
+                    self.stats.record(req_type, time.time() - start,
+                                      attempt > 0, nbytes=nbytes)
+                    return self._response_json(r)
+                error = PulpError(self._error_message(r), r.status_code)
+                retryable = r.status_code in RETRY_STATUS and \
+                    (req_type != 'post' or
+                     r.status_code in UNPROCESSED_STATUS)
+                retry_after = r.headers.get('Retry-After')
+            self.stats.record(req_type, time.time() - start, attempt > 0,
+                              failed=True)
+            if not retryable or attempt == RETRIES - 1:
+                raise error
+            try:
+                pause = min(float(retry_after), RETRY_MAX)
+            except (TypeError, ValueError):
+                pause = delay * random.uniform(0.5, 1.0)
+            time.sleep(pause)
+            delay = min(delay * 2, RETRY_MAX)
+
+    @staticmethod
+    def _response_json(r):
+        try:
+            return r.json()
+        except ValueError:
+            # Not every response, nor every error page, is JSON.
+            return None
+
+    @staticmethod
+    def _failed(r_json):
+        """
+        Whether r_json, as returned by _call_pulp, is not the JSON object
+        of a successful call. Pulp answers some calls with no JSON at all.
+        """
+        return not isinstance(r_json, dict) or 'error_message' in r_json
+
+    def _error_message(self, r):
+        r_json = self._response_json(r)
+        if isinstance(r_json, dict) and 'error_message' in r_json:
+            message = r_json['error_message']
+        else:
+            message = r.text[:200].strip() or r.reason
+        return 'Pulp returned {0}: {1}'.format(r.status_code, message)
+
+    def _request(self, url, req_type, payload):
         # FIXME: remove debug print statements if not desired or move to debug
         #        mode
         if req_type == 'get':
             # print('Calling Pulp URL "{0}"'.format(url))
-            r = requests.get(url, auth=(self._username, self._password),
-                             verify=self._verify_ssl)
+            r = self._session.get(url, timeout=self._timeout)
         elif req_type == 'post':
             """
             print('Posting to Pulp URL "{0}"'.format(url))
@@ -52,45 +674,63 @@ class PulpServer(object):
                 print('Pulp HTTP payload:\n{0}'.format(
                     json.dumps(payload, indent=2)))
             """
-            r = requests.post(url, auth=(self._username, self._password),
-                              data=json.dumps(payload),
-                              verify=self._verify_ssl)
+            r = self._session.post(url, data=json.dumps(payload),
+                                   timeout=self._timeout)
         elif req_type == 'put':
             # some calls pass in binary data so we don't log payload data or
             # json encode it here
             # print('Putting to Pulp URL "{0}"'.format(url))
-            r = requests.put(url, auth=(self._username, self._password),
-                             data=payload, verify=self._verify_ssl)
+            r = self._session.put(url, data=payload, timeout=self._timeout)
         elif req_type == 'delete':
             # print('Delete call to Pulp URL "{0}"'.format(url))
-            r = requests.delete(url, auth=(self._username, self._password),
-                                verify=self._verify_ssl)
-        else:
-            raise ValueError('Invalid value of "req_type" parameter: {0}'
-                             ''.format(req_type))
-        r_json = r.json()
-        # some requests return null
-        if not r_json:
-            return r_json
-
+            r = self._session.delete(url, timeout=self._timeout)
         """
         print('Pulp HTTP status code: {0}'.format(r.status_code))
-        print('Pulp JSON response:\n{0}'.format(json.dumps(r_json, indent=2)))
         """
+        return r
 
-        if 'error_message' in r_json:
-            sys.stderr.write('Error messages from Pulp response:\n{0}'
-                             ''.format(r_json['error_message']))
+    def wait_for_tasks(self, tasks):
+        """
+        Waits for all tasks, as found in the 'spawned_tasks' of a pulp
+        response, to finish. All unfinished tasks are polled in every round,
+        with pauses growing from TASK_POLL_MIN to TASK_POLL_MAX seconds and
+        jittered so that concurrent waiters spread out. Raises PulpTaskError
+        for the first task which failed or was canceled, or if the tasks do
+        not all finish within the task timeout.
 
-        if 'spawned_tasks' in r_json:
-            for task in r_json['spawned_tasks']:
-                """
-                print('Checking status of spawned task {0}'
-                      ''.format(task['task_id']))
-                """
-                self._call_pulp('{0}/{1}'.format(self._server_url,
-                                                 task['_href']))
-        return r_json
+        Returns a dict of the href of every task to the seconds until it was
+        seen finished.
+        """
+        pending = [t['_href'] for t in tasks]
+        start = time.time()
+        finished = {}
+        deadline = start + self._task_timeout
+        delay = TASK_POLL_MIN
+        while pending:
+            for href in list(pending):
+                # print('Checking status of spawned task {0}'.format(href))
+                task = self._call_pulp(self._server_url + href)
+                if not isinstance(task, dict):
+                    # No status this time, poll the task again.
+                    task = {}
+                state = task.get('state')
+                if state in ('error', 'canceled'):
+                    error = task.get('error') or {}
+                    raise PulpTaskError('Pulp task {0} {1}: {2}'.format(
+                        task.get('task_id', href), state,
+                        error.get('description', task.get('traceback'))),
+                        task)
+                if state in ('finished', 'skipped'):
+                    pending.remove(href)
+                    finished[href] = time.time() - start
+            if not pending:
+                break
+            if time.time() + delay > deadline:
+                raise PulpTaskError('Timed out waiting for pulp tasks: {0}'
+                                    ''.format(', '.join(pending)))
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, TASK_POLL_MAX)
+        return finished
 
     @property
     def status(self):
@@ -101,10 +741,33 @@ class PulpServer(object):
 
     def is_repo(self, repo_id):
         """Return true if repo exists"""
-        url = '{0}/pulp/api/v2/repositories/'.format(self._server_url)
+        if repo_id in self._repos:
+            return True
+        url = '{0}/pulp/api/v2/repositories/{1}/'.format(self._server_url,
+                                                         repo_id)
         # print('Verifying pulp repository "{0}"'.format(repo_id))
-        r_json = self._call_pulp(url)
-        return repo_id in [repo['id'] for repo in r_json]
+        try:
+            self._call_pulp(url)
+        except PulpError as e:
+            if e.status_code == 404:
+                return False
+            raise
+        self._repos.add(repo_id)
+        return True
+
+    def ensure_repo(self, image, repo_id):
+        """
+        Create pulp docker repository unless it exists. A repository
+        created by someone else meanwhile is taken as it is.
+        """
+        if self.is_repo(repo_id):
+            return
+        try:
+            self.create_repo(image, repo_id)
+        except PulpError as e:
+            if e.status_code != 409:
+                raise
+        self._repos.add(repo_id)
 
     def create_repo(self, image, repo_id, redirect_url=None):
         """Create pulp docker repository"""
@@ -142,7 +805,7 @@ class PulpServer(object):
         url = '{0}/pulp/api/v2/repositories/'.format(self._server_url)
         # print('Verifying pulp repository "{0}"'.format(repo_id))
         r_json = self._call_pulp(url, "post", payload)
-        if 'error_message' in r_json:
+        if isinstance(r_json, dict) and 'error_message' in r_json:
             raise Exception('Failed to create repository "{0}"'
                             ''.format(repo_id))
 
@@ -151,7 +814,7 @@ class PulpServer(object):
         """Get a pulp upload ID"""
         url = '{0}/pulp/api/v2/content/uploads/'.format(self._server_url)
         r_json = self._call_pulp(url, "post")
-        if 'error_message' in r_json:
+        if self._failed(r_json):
             raise Exception('Unable to get a pulp upload ID')
         return r_json['upload_id']
 
@@ -160,32 +823,289 @@ class PulpServer(object):
         # print('Deleting pulp upload ID {0}'.format(upload_id))
         url = '{0}/pulp/api/v2/content/uploads/{1}/'.format(self._server_url,
                                                             upload_id)
-        self._call_pulp(url, "delete")
+        try:
+            self._call_pulp(url, "delete")
+        except PulpError as e:
+            # Already gone, as stale upload IDs may be.
+            if e.status_code != 404:
+                raise
+
+    def _upload_ids(self):
+        """Return the upload IDs pulp knows of"""
+        url = '{0}/pulp/api/v2/content/uploads/'.format(self._server_url)
+        r_json = self._call_pulp(url)
+        return r_json.get('upload_ids', []) if r_json else []
 
-    def upload_docker_image(self, image, repo_id):
-        """Upload image to pulp repository"""
-        upload_id = self._upload_id
+    def _upload_state(self, image, repo_id, resume):
+        """
+        Returns the UploadState of image in repo_id: the one of an earlier,
+        failed upload of the same image if resume is set and pulp still has
+        its upload ID, else a new one. The upload ID of an earlier upload
+        which is not resumed is deleted.
+        """
+        image_id = self._docker_client.inspect_image(image)['Id']
+        path = os.path.join(self._state_dir, '{0}-{1}.json'.format(
+            repo_id, image_id.replace(':', '-')))
+        state = UploadState.load(path)
+        if state:
+            if resume and state.image_id == image_id and \
+                    state.upload_id in self._upload_ids():
+                return state
+            self._delete_upload_id(state.upload_id)
+        state = UploadState(path, self._upload_id, image_id,
+                            self._chunk_size, compression=self._compression,
+                            compress_level=self._compress_level)
+        state.save()
+        return state
+
+    def _skip_layer(self, state, layer_id):
+        """
+        Whether to leave layer_id out of the upload of state: as decided by
+        an earlier attempt of the upload, so a resumed upload sends the same
+        bytes, else if dedup_layers is set and pulp has the layer.
+        """
+        skip = state.decision(layer_id)
+        if skip is None:
+            skip = self._dedup_layers and \
+                bool(self._existing_layers([layer_id]))
+            state.decide(layer_id, skip)
+        return skip
+
+    def _existing_layers(self, layer_ids):
+        """
+        Returns a dict of the layers among layer_ids which pulp has, to the
+        ids of the repositories holding them.
+        """
+        if not layer_ids:
+            return {}
+        url = '{0}/pulp/api/v2/content/units/{1}/search/' \
+              ''.format(self._server_url, self._unit_type_id)
+        payload = {
+            'criteria': {
+                'filters': {'image_id': {'$in': layer_ids}},
+                'fields': ['image_id']
+            },
+            'include_repos': True
+        }
+        units = self._call_pulp(url, "post", payload) or []
+        return dict((u['image_id'], u.get('repository_memberships', []))
+                    for u in units if u.get('repository_memberships'))
+
+    def _associate_layers(self, repo_id, layer_ids):
+        """
+        Copies the units of layer_ids, which pulp already has, into repo_id
+        from the repositories holding them.
+        """
+        existing = self._existing_layers(layer_ids)
+        missing = set(layer_ids) - set(existing)
+        if missing:
+            raise PulpError('Layers {0} are no longer in pulp, upload the '
+                            'image again without resuming.'
+                            ''.format(', '.join(sorted(missing))))
+        sources = {}
+        for layer_id, repos in existing.items():
+            if repo_id not in repos:
+                sources.setdefault(repos[0], []).append(layer_id)
+        tasks = []
+        for source, ids in sources.items():
+            url = '{0}/pulp/api/v2/repositories/{1}/actions/associate/' \
+                  ''.format(self._server_url, repo_id)
+            payload = {
+                'source_repo_id': source,
+                'criteria': {
+                    'type_ids': [self._unit_type_id],
+                    'filters': {'unit': {'image_id': {'$in': ids}}}
+                }
+            }
+            r_json = self._call_pulp(url, "post", payload) or {}
+            tasks += r_json.get('spawned_tasks', [])
+        self.wait_for_tasks(tasks)
+
+    def upload_docker_image(self, image, repo_id, resume=False):
+        """
+        Upload image to pulp repository. If an earlier upload of image
+        failed and resume is set, only the chunks pulp did not acknowledge
+        are uploaded again. Layers pulp already has in any repository are
+        associated with repo_id instead of being uploaded, as they come up
+        while the image is read.
+
+        The sha256 digests of the image and its layers are computed while
+        it is uploaded. The layers must match those docker reports for the
+        image, and be in repo_id once pulp has imported them.
+        """
+        state = self._upload_state(image, repo_id, resume)
+        info = self._docker_client.inspect_image(image)
+        progress = self.progress.image(image, info.get('VirtualSize') or
+                                       info.get('Size') or 0)
         # print('Uploading image using ID "{0}"'.format(upload_id))
         # print('\nUploading image "{0}"'.format(image))
-        self._upload_docker_image(upload_id, image)
-        self._import_upload(upload_id, repo_id)
-        self._delete_upload_id(upload_id)
+        try:
+            with self.stats.phase('upload'):
+                digests = self._upload_docker_image(state, image, progress)
+        except KeyboardInterrupt:
+            # Aborted, rather than failed: nothing to resume.
+            self._discard_upload(state)
+            raise
+        finally:
+            progress.finish()
+        diff_ids = (info.get('RootFS') or {}).get('Layers') or []
+        unmatched = set(diff_ids) - set(digests.layers.values())
+        if unmatched:
+            # What was read is not the image: nothing worth resuming.
+            self._discard_upload(state)
+            raise PulpError('The layers of image {0} read from docker do '
+                            'not match {1}'.format(image,
+                                                   ', '.join(unmatched)))
+        if state.skip_layers:
+            with self.stats.phase('associate'):
+                self._associate_layers(repo_id, state.skip_layers)
+        with self.stats.phase('import'):
+            self._import_upload(state.upload_id, repo_id)
+        self._delete_upload_id(state.upload_id)
+        state.remove()
+        self._verify_import(repo_id, sorted(digests.layers))
+        self.stats.digests(image, digests.digest, digests.layers)
+
+    def _discard_upload(self, state):
+        self._delete_upload_id(state.upload_id)
+        state.remove()
+
+    def _verify_import(self, repo_id, layer_ids):
+        """
+        Raises PulpError unless every layer of layer_ids is in repo_id.
+        """
+        existing = self._existing_layers(layer_ids)
+        missing = [l for l in layer_ids if repo_id not in existing.get(l, ())]
+        if missing:
+            raise PulpError('Pulp did not import layers {0} into {1}'
+                            ''.format(', '.join(missing), repo_id))
 
-    def _upload_docker_image(self, upload_id, image):
+    def _upload_docker_image(self, state, image, progress=None):
+        """
+        Uploads the save stream of image and returns the DigestReader it
+        was read through.
+        """
         # print('Uploading docker image ({0})'.format(image))
-        offset = 0
         image_stream = self._docker_client.get_image(image)
-        while True:
-            data = image_stream.read(self._chunk_size)
-            if not data:
-                break
-            url = '{0}/pulp/api/v2/content/uploads/{1}/{2}/' \
-                  ''.format(self._server_url, upload_id, offset)
-            sys.stdout.flush()
-            sys.stdout.write(".")
-            self._call_pulp(url, "put", data)
-            offset += self._chunk_size
-        image_stream.close()
+        stages = []
+        try:
+            digests = layers.DigestReader(
+                MeteredStream(image_stream, self.stats, progress))
+            stream = digests
+            # Leaving out layers and compressing each run on their own
+            # thread, overlapping with the uploads.
+            if self._dedup_layers or state.skip_layers:
+                stream = self._pipe_through(
+                    lambda s, out: filter_save(
+                        s, lambda l: self._skip_layer(state, l), out),
+                    stream, stages)
+            if state.compression == 'gzip':
+                stream = self._pipe_through(
+                    lambda s, out: compress(s, out, state.compress_level),
+                    stream, stages)
+            self._upload_stream(state, stream, progress)
+            # Leaving out layers stops reading at the end of the archive,
+            # before the padding docker writes after it.
+            for _ in iter(lambda: digests.read(COMPRESS_CHUNK), b''):
+                pass
+            return digests
+        finally:
+            for pipe, _ in stages:
+                pipe.abort()
+            for _, t in stages:
+                t.join()
+            image_stream.close()
+            state.save()
+
+    @staticmethod
+    def _pipe_through(fn, stream, stages):
+        """
+        Starts a thread running fn(stream, out) and returns a QueuePipe
+        reading what it writes to out. The pipe and the thread are added to
+        stages.
+        """
+        pipe = QueuePipe()
+
+        def _run():
+            try:
+                fn(stream, pipe)
+                pipe.close()
+            except Exception as e:  # pylint: disable=broad-except
+                pipe.fail(e)
+
+        t = threading.Thread(target=_run)
+        t.daemon = True
+        t.start()
+        stages.append((pipe, t))
+        return pipe
+
+    def _upload_chunk(self, state, progress, offset, data, digest):
+        url = '{0}/pulp/api/v2/content/uploads/{1}/{2}/' \
+              ''.format(self._server_url, state.upload_id, offset)
+        self._call_pulp(url, "put", data)
+        state.acknowledge(offset, digest)
+        if progress:
+            progress.uploaded()
+
+    def _upload_stream(self, state, stream, progress=None):
+        """
+        Uploads stream in chunks at their offsets. The stream is read in
+        this thread into a bounded queue, from which the upload workers PUT
+        the chunks concurrently, so at most chunk_size * (upload_workers +
+        queue_depth + 1) bytes are held in memory. Chunks state has seen
+        acknowledged with the same contents are skipped.
+        """
+        chunks = queue.Queue(self._queue_depth)
+        stop = threading.Event()
+        errors = []
+
+        def _work():
+            while not stop.is_set():
+                try:
+                    item = chunks.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    return
+                try:
+                    self._upload_chunk(state, progress, *item)
+                except Exception as e:  # pylint: disable=broad-except
+                    errors.append(e)
+                    stop.set()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        workers = [threading.Thread(target=_work)
+                   for _ in range(self._upload_workers)]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        try:
+            offset = 0
+            while not stop.is_set():
+                data = stream.read(state.chunk_size)
+                if not data:
+                    break
+                digest = hashlib.sha256(data).hexdigest()
+                if not state.acknowledged(offset, digest):
+                    _put((offset, data, digest))
+                offset += len(data)
+            for _ in workers:
+                _put(None)
+        except:
+            stop.set()
+            raise
+        finally:
+            for t in workers:
+                t.join()
+        if errors:
+            raise errors[0]
 
     def _import_upload(self, upload_id, repo_id):
         """Import uploaded content"""
@@ -202,12 +1122,17 @@ class PulpServer(object):
             'override_config': None
         }
         r_json = self._call_pulp(url, "post", payload)
-        if 'error_message' in r_json:
+        if self._failed(r_json):
             raise Exception('Unable to import pulp content into {0}'
                             ''.format(repo_id))
+        # The upload is only deleted once pulp has imported it.
+        self.wait_for_tasks(r_json.get('spawned_tasks', []))
 
-    def publish_repo(self, repo_id):
-        """Publish pulp repository to pulp web server"""
+    def publish_repo(self, repo_id, wait=True):
+        """
+        Publish pulp repository to pulp web server. Returns the spawned
+        tasks, after waiting for them to finish if wait is set.
+        """
         url = '{0}/pulp/api/v2/repositories/{1}/actions/publish/' \
               ''.format(self._server_url, repo_id)
         payload = {
@@ -216,16 +1141,24 @@ class PulpServer(object):
         }
         # print('Publishing pulp repository "{0}"'.format(repo_id))
         r_json = self._call_pulp(url, "post", payload)
-        if 'error_message' in r_json:
+        if self._failed(r_json):
             raise Exception('Unable to publish pulp repo "{0}"'
                             ''.format(repo_id))
+        return self._spawned(r_json, wait)
+
+    def _spawned(self, r_json, wait):
+        tasks = r_json.get('spawned_tasks', [])
+        if wait:
+            self.wait_for_tasks(tasks)
+        return tasks
 
-    def export_repo(self, repo_id):
+    def export_repo(self, repo_id, wait=True):
         """
         Export pulp repository to pulp web server as tar
 
         The tarball is split into the layer components and crane metadata.
-        It is for the purpose of uploading to remote crane server
+        It is for the purpose of uploading to remote crane server. Returns
+        the spawned tasks, after waiting for them to finish if wait is set.
         """
         url = '{0}/pulp/api/v2/repositories/{1}/actions/publish/' \
               ''.format(self._server_url, repo_id)
@@ -237,5 +1170,6 @@ class PulpServer(object):
         }
         # print('Exporting pulp repository "{0}"'.format(repo_id))
         r_json = self._call_pulp(url, "post", payload)
-        if 'error_message' in r_json:
+        if self._failed(r_json):
             raise Exception('Unable to export pulp repo "{0}"'.format(repo_id))
+        return self._spawned(r_json, wait)
@@ -5,6 +5,7 @@ import subprocess
 import sys
 
 from fnmatch import fnmatch as matches
+from multiprocessing.pool import ThreadPool
 
 """Atomic Utility Module"""
 
@@ -17,33 +18,35 @@ else:
     input = input
 
 
-def image_by_name(img_name):
+def decompose(compound_name):
+    """ '[reg/]repo[:tag]' -> (reg, repo, tag) """
+    reg, repo, tag = '', compound_name, ''
+    if '/' in repo:
+        reg, repo = repo.split('/', 1)
+    if ':' in repo:
+        repo, tag = repo.rsplit(':', 1)
+    return reg, repo, tag
+
+
+def image_by_name(img_name, images=None):
     """
     Returns a list of image data for images which match img_name.
+    Optional: match against an existing image listing instead of asking
+    the docker daemon for one.
     """
-    def _decompose(compound_name):
-        """ '[reg/]repo[:tag]' -> (reg, repo, tag) """
-        reg, repo, tag = '', compound_name, ''
-        if '/' in repo:
-            reg, repo = repo.split('/', 1)
-        if ':' in repo:
-            repo, tag = repo.rsplit(':', 1)
-        return reg, repo, tag
-
-    c = docker.Client()
-
-    i_reg, i_rep, i_tag = _decompose(img_name)
+    i_reg, i_rep, i_tag = decompose(img_name)
     # Correct for bash-style matching expressions.
     if not i_reg:
         i_reg = '*'
     if not i_tag:
         i_tag = '*'
 
-    images = c.images(all=False)
+    if images is None:
+        images = docker.Client().images(all=False)
     valid_images = []
     for i in images:
-        for t in i['RepoTags']:
-            reg, rep, tag = _decompose(t)
+        for t in i['RepoTags'] or []:
+            reg, rep, tag = decompose(t)
             if matches(reg, i_reg) \
                     and matches(rep, i_rep) \
                     and matches(tag, i_tag):
@@ -52,13 +55,29 @@ def image_by_name(img_name):
     return valid_images
 
 
-def subp(cmd):
+def parallel_map(fn, items, workers):
+    """
+    Returns [fn(item) for item in items], running at most 'workers' calls
+    at a time in a thread pool.
+    """
+    items = list(items)
+    if len(items) < 2 or workers < 2:
+        return [fn(i) for i in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(fn, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def subp(cmd, cwd=None):
     """
     Run a command as a subprocess.
     Return a triple of return code, standard out, standard err.
     """
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE)
+                            stderr=subprocess.PIPE, cwd=cwd)
     out, err = proc.communicate()
     return ReturnTuple(proc.returncode, stdout=out, stderr=err)
 
@@ -25,6 +25,27 @@ class AtomicDBus (object):
         ret = self.dbus_object.verify(image, dbus_interface="org.atomic")
         return ret
 
+    @polkit.enable_proxy
+    def Images(self):
+        ret = self.dbus_object.Images(dbus_interface="org.atomic")
+        return ret
+
+    @polkit.enable_proxy
+    def Info(self, images):
+        ret = self.dbus_object.Info(images, dbus_interface="org.atomic")
+        return ret
+
+    @polkit.enable_proxy
+    def VerifyAll(self):
+        ret = self.dbus_object.VerifyAll(dbus_interface="org.atomic")
+        return ret
+
+    @polkit.enable_proxy
+    def VersionAll(self, recurse):
+        ret = self.dbus_object.VersionAll(recurse,
+                                          dbus_interface="org.atomic")
+        return ret
+
 
 if __name__ == "__main__":
     try:
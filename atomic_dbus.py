@@ -4,9 +4,20 @@ import dbus
 import dbus.service
 import dbus.mainloop.glib
 from gi.repository import GLib
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+import docker
 import slip.dbus.service
 from slip.dbus import polkit
 import Atomic
+from Atomic import cache
+from Atomic import images as image_index
+
+# Requests handled at a time, off the main loop.
+WORKERS = 4
+# Seconds between attempts to follow the events of docker.
+EVENTS_RETRY = 5
 
 
 class atomic_dbus(slip.dbus.service.Object):
@@ -19,40 +30,233 @@ class atomic_dbus(slip.dbus.service.Object):
 
     def __init__(self, *p, **k):
         super(atomic_dbus, self).__init__(*p, **k)
-        self.atomic = Atomic.Atomic()
+        self.pool = ThreadPool(WORKERS)
+        self.cache = cache.ResultCache()
+        watcher = threading.Thread(target=self._watch_events)
+        watcher.daemon = True
+        watcher.start()
 
     """
-    The version method takes in an image name and returns its version
-    information
+    Follows the image events of docker, dropping the cached results they
+    change. Nothing is cached while docker can not be followed.
     """
-    @slip.dbus.polkit.require_auth("org.atomic.read")
-    @dbus.service.method("org.atomic", in_signature='asb',
-                         out_signature='aa{sv}')
-    def version(self, images, recurse=False):
+    def _watch_events(self):
+        while True:
+            try:
+                cache.watch_events(docker.Client(), self.cache)
+            except Exception:
+                pass
+            time.sleep(EVENTS_RETRY)
+
+    """
+    Returns the result of compute(atomic) for image, from the cache if it
+    holds the result for the image Id and kind. compute returns the result
+    and the keys it depends on.
+    """
+    def _cached(self, atomic, kind, image, compute):
+        image_id = self.cache.get(("id", image))
+        if image_id is None:
+            generation = self.cache.generation
+            try:
+                image_id = atomic.d.inspect_image(image)["Id"]
+            except docker.errors.APIError:
+                # Missing images may be pulled, which gives them an Id.
+                return compute(atomic)[0]
+            self.cache.put(("id", image), image_id,
+                           cache.tag_keys(image) + [cache.image_key(image_id)],
+                           generation)
+        key = (kind, image_id)
+        result = self.cache.get(key)
+        if result is None:
+            generation = self.cache.generation
+            result, depends = compute(atomic)
+            self.cache.put(key, result, depends, generation)
+        return result
+
+    """
+    Runs fn() on the thread pool and replies with its result, or error, from
+    the main loop, which keeps serving other requests meanwhile.
+    """
+    def _run(self, fn, reply_handler, error_handler):
+        def _reply(handler, result):
+            handler(result)
+            return False
+
+        def _task():
+            try:
+                result = fn()
+            except Exception as e:
+                GLib.idle_add(_reply, error_handler, e)
+            else:
+                GLib.idle_add(_reply, reply_handler, result)
+
+        self.pool.apply_async(_task)
+
+    """
+    Every request works on its own Atomic, so requests never share state.
+    """
+    def _version(self, images, recurse):
+        def _compute(atomic):
+            layers = atomic.version()
+            depends = set()
+            for layer in layers:
+                depends.add(cache.image_key(layer["Id"]))
+                if layer["Tag"]:
+                    depends.update(cache.tag_keys(layer["Tag"]))
+            return layers, depends
+
+        atomic = Atomic.Atomic()
         versions = []
         for image in images:
             args = self.Args(str(image))
             args.recurse = recurse
-            self.atomic.set_args(args)
+            atomic.set_args(args)
             versions.append({"Image": image,
-                             "Version": self.atomic.version()})
+                             "Version": self._cached(
+                                 atomic, ("version", recurse), args.image,
+                                 _compute)})
         return versions
 
-    """
-    The verify method takes in an image name and returns whether or not the
-    image should be updated
-    """
-    @slip.dbus.polkit.require_auth("org.atomic.read")
-    @dbus.service.method("org.atomic", in_signature='as', out_signature='av')
-    def verify(self, images):
+    def _verify(self, images):
+        def _compute(atomic):
+            verification = atomic.verify()
+            # Newer versions of any layer found among all images, or gone
+            # with a deleted one, change the verification.
+            depends = set(["deleted"])
+            for layer in atomic.get_layers():
+                depends.add(cache.image_key(layer["Id"]))
+                if layer["Name"]:
+                    depends.add("name:" + layer["Name"])
+            return verification, depends
+
+        atomic = Atomic.Atomic()
         verifications = []
         for image in images:
             args = self.Args(str(image))
-            self.atomic.set_args(args)
+            atomic.set_args(args)
             verifications.append({"Image": image,
-                                  "Verification": self.atomic.verify()})
+                                  "Verification": self._cached(
+                                      atomic, "verify", args.image,
+                                      _compute)})
         return verifications
 
+    """
+    Returns compute(index) for an ImageIndex of all images, from the cache
+    unless any image changed since it was computed.
+    """
+    def _all_images(self, kind, compute):
+        key = ("all", kind)
+        result = self.cache.get(key)
+        if result is None:
+            generation = self.cache.generation
+            result = compute(image_index.ImageIndex(docker.Client()))
+            self.cache.put(key, result, [cache.ALL_IMAGES], generation)
+        return result
+
+    def _info(self, images):
+        index = self._all_images("index", lambda index: index)
+        labels = {}
+        for image in images:
+            image_id = index.find(str(image))
+            if image_id is not None:
+                labels[image] = index.labels(image_id)
+        return labels
+
+    """
+    The version method takes in an image name and returns its version
+    information
+    """
+    @slip.dbus.polkit.require_auth("org.atomic.read")
+    @dbus.service.method("org.atomic", in_signature='asb',
+                         out_signature='aa{sv}',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def version(self, images, recurse, reply_handler, error_handler):
+        self._run(lambda: self._version(images, recurse), reply_handler,
+                  error_handler)
+
+    """
+    The verify method takes in an image name and returns whether or not the
+    image should be updated
+    """
+    @slip.dbus.polkit.require_auth("org.atomic.read")
+    @dbus.service.method("org.atomic", in_signature='as', out_signature='av',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def verify(self, images, reply_handler, error_handler):
+        self._run(lambda: self._verify(images), reply_handler,
+                  error_handler)
+
+    """
+    The Images method returns the Id, tags, Name label and version of every
+    tagged image
+    """
+    @slip.dbus.polkit.require_auth("org.atomic.read")
+    @dbus.service.method("org.atomic", in_signature='',
+                         out_signature='a(sass)',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def Images(self, reply_handler, error_handler):
+        def _images(index):
+            images = []
+            for i in index.images:
+                layer = index.layer(i["Id"])
+                tags = [t for t in i["RepoTags"] if t != image_index.NO_TAG]
+                images.append((i["Id"], tags, layer["Name"],
+                               layer["Version"]))
+            return images
+
+        self._run(lambda: self._all_images("images", _images),
+                  reply_handler, error_handler)
+
+    """
+    The Info method takes in image names and returns the labels of each,
+    leaving out images which do not exist
+    """
+    @slip.dbus.polkit.require_auth("org.atomic.read")
+    @dbus.service.method("org.atomic", in_signature='as',
+                         out_signature='a{sa{ss}}',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def Info(self, images, reply_handler, error_handler):
+        self._run(lambda: self._info(images), reply_handler, error_handler)
+
+    """
+    The VerifyAll method returns, by Id, whether or not every tagged image
+    should be updated, as verify does
+    """
+    @slip.dbus.polkit.require_auth("org.atomic.read")
+    @dbus.service.method("org.atomic", in_signature='',
+                         out_signature='a{ss}',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def VerifyAll(self, reply_handler, error_handler):
+        def _verify_all(index):
+            return dict((i["Id"], index.verify(i["Id"]))
+                        for i in index.images)
+
+        self._run(lambda: self._all_images("verify", _verify_all),
+                  reply_handler, error_handler)
+
+    """
+    The VersionAll method returns, by Id, the Id, Name label, version and
+    tag of every tagged image, followed by those of its layers if recurse
+    is set
+    """
+    @slip.dbus.polkit.require_auth("org.atomic.read")
+    @dbus.service.method("org.atomic", in_signature='b',
+                         out_signature='a{sa(ssss)}',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def VersionAll(self, recurse, reply_handler, error_handler):
+        def _version_all(index):
+            versions = {}
+            for i in index.images:
+                chain = index.chain(i["Id"])
+                versions[i["Id"]] = [(l["Id"], l["Name"], l["Version"],
+                                      l["Tag"])
+                                     for l in (chain if recurse
+                                               else chain[:1])]
+            return versions
+
+        self._run(lambda: self._all_images(("version", bool(recurse)),
+                                           _version_all),
+                  reply_handler, error_handler)
+
 
 if __name__ == "__main__":
         mainloop = GLib.MainLoop()
@@ -61,4 +265,8 @@ if __name__ == "__main__":
         name = dbus.service.BusName("org.atomic", system_bus)
         object = atomic_dbus(system_bus, "/org/atomic/object")
         slip.dbus.service.set_mainloop(mainloop)
-        mainloop.run()
+        try:
+            mainloop.run()
+        finally:
+            object.pool.close()
+            object.pool.join()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#
+# Benchmark of atomic upload --pulp against a local stand-in pulp server.
+#
+# Uploads a synthetic image with push_image_to_pulp for every combination
+# of chunk size and workers given, and prints the throughput of each:
+#
+#   python tests/bench_pulp.py --size 64 --latency 0.02 --bandwidth 50 \
+#       --chunk_sizes 262144 1048576 4194304 --workers 1 4 8
+#
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'unit'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+import Atomic  # noqa: E402
+from fake_pulp import FakeDocker, FakePulp, synthetic_save  # noqa: E402
+
+
+def run(args, save, layer_ids, chunk_size, workers):
+    docker = FakeDocker()
+    docker.add('bench', layer_ids, save)
+    state_dir = tempfile.mkdtemp(prefix='atomic-bench-')
+    stats_file = os.path.join(state_dir, 'stats.json')
+    with FakePulp(latency=args.latency,
+                  bandwidth=args.bandwidth * 1024 * 1024 or None,
+                  error_rate=args.error_rate) as fake:
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        start = time.time()
+        try:
+            Atomic.push_image_to_pulp(
+                'bench', fake.url, 'u', 'p', False, docker,
+                chunk_size=chunk_size, upload_workers=workers,
+                compression=args.compression, state_dir=state_dir,
+                stats_file=stats_file)
+            seconds = time.time() - start
+            with open(stats_file) as f:
+                stats = json.load(f)['servers'][fake.url]
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            shutil.rmtree(state_dir, ignore_errors=True)
+        if fake.imported['bench'][0] != save:
+            raise SystemExit('Pulp received a different image')
+    return seconds, stats, fake.errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark pulp uploads against a local stand-in.')
+    parser.add_argument('--size', type=int, default=32,
+                        help='image size in MiB (default 32)')
+    parser.add_argument('--layers', type=int, default=4)
+    parser.add_argument('--compressible', type=float, default=0.5,
+                        help='share of the image which is zeros')
+    parser.add_argument('--compression', choices=['gzip', 'none'],
+                        default='gzip')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds added to every request')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='MiB/s of the link to the server, 0 for '
+                        'unlimited')
+    parser.add_argument('--error_rate', type=float, default=0,
+                        help='share of chunk uploads failed with 503')
+    parser.add_argument('--chunk_sizes', type=int, nargs='+',
+                        default=[262144, 1048576, 4194304])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args()
+
+    layer_ids, save = synthetic_save(args.size * 1024 * 1024, args.layers,
+                                     args.compressible)
+    results = []
+    for chunk_size in args.chunk_sizes:
+        for workers in args.workers:
+            seconds, stats, errors = run(args, save, layer_ids, chunk_size,
+                                         workers)
+            results.append({'chunk_size': chunk_size, 'workers': workers,
+                            'seconds': seconds,
+                            'mib_per_second': len(save) / seconds / 2 ** 20,
+                            'bytes_put': stats['bytes_put'],
+                            'retries': stats['calls']['put']['retries'],
+                            'injected_errors': errors,
+                            'phases': stats['phases']})
+    if args.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+        return
+    print('{0:>10} {1:>8} {2:>9} {3:>9} {4:>8}'.format(
+        'chunk', 'workers', 'seconds', 'MiB/s', 'retries'))
+    for r in results:
+        print('{0:>10} {1:>8} {2:>9.2f} {3:>9.1f} {4:>8}'.format(
+            r['chunk_size'], r['workers'], r['seconds'],
+            r['mib_per_second'], r['retries']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+import gzip
+import hashlib
+import io
+import json
+import random
+import re
+import tarfile
+import threading
+import time
+import uuid
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+""" A local stand-in for the pulp v2 REST API, and synthetic images. """
+
+API = '/pulp/api/v2'
+
+
+class FakePulp(object):
+
+    """
+    Serves the parts of the pulp v2 API which PulpServer calls on an
+    ephemeral localhost port, keeping uploads, repositories and the
+    docker_image units imported into them in memory.
+
+    Every request is delayed by latency seconds, and its body by the time
+    it takes to go through a link of bandwidth bytes per second shared by
+    all connections. A share error_rate of the requests of the methods in
+    error_methods fails with 503 before it is handled. Tasks are running
+    for task_polls polls and then finished.
+    """
+
+    def __init__(self, latency=0, bandwidth=None, error_rate=0,
+                 error_methods=('PUT',), task_polls=1, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_methods = error_methods
+        self.task_polls = task_polls
+        self.uploads = {}
+        self.repos = {}
+        self.units = {}
+        self.tasks = {}
+        self.imported = {}
+        self.requests = {}
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._link_free = 0
+        self._httpd = None
+        self.url = None
+
+    def start(self):
+        self._httpd = _Server(('127.0.0.1', 0), _Handler)
+        self._httpd.fake = self
+        thread = threading.Thread(target=self._httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:{0}'.format(self._httpd.server_port)
+        return self.url
+
+    def stop(self):
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def transfer(self, nbytes):
+        """Waits for nbytes to go through the shared link"""
+        if not self.bandwidth:
+            return
+        with self._lock:
+            start = max(time.time(), self._link_free)
+            self._link_free = start + float(nbytes) / self.bandwidth
+            done = self._link_free
+        time.sleep(max(0, done - time.time()))
+
+    def inject_error(self, method):
+        with self._lock:
+            if method in self.error_methods and \
+                    self._random.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+    def count(self, method, route):
+        with self._lock:
+            key = '{0} {1}'.format(method, route)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def _task(self):
+        task_id = uuid.uuid4().hex
+        with self._lock:
+            self.tasks[task_id] = self.task_polls
+        return {'spawned_tasks': [{'_href': '{0}/tasks/{1}/'.format(
+            API, task_id), 'task_id': task_id}]}
+
+    # Handlers of the routes below, returning (status, JSON body).
+
+    def status(self, match, body):
+        return 200, {'versions': {'platform_version': 'fake'}}
+
+    def create_repo(self, match, body):
+        repo_id = body['id']
+        with self._lock:
+            if repo_id in self.repos:
+                return 409, {'error_message': 'Duplicate resource: {0}'
+                             ''.format(repo_id)}
+            self.repos[repo_id] = set()
+        return 201, {'id': repo_id}
+
+    def get_repo(self, match, body):
+        repo_id = match.group(1)
+        if repo_id not in self.repos:
+            return 404, {'error_message': 'Missing resource: {0}'
+                         ''.format(repo_id)}
+        return 200, {'id': repo_id,
+                     'content_unit_counts': {
+                         'docker_image': len(self.repos[repo_id])}}
+
+    def import_upload(self, match, body):
+        repo_id = match.group(1)
+        with self._lock:
+            chunks = self.uploads.get(body['upload_id'])
+        if repo_id not in self.repos or chunks is None:
+            return 404, {'error_message': 'Missing resource'}
+        data = b''.join(chunks[o] for o in sorted(chunks))
+        if data[:2] == b'\x1f\x8b':
+            data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            layer_ids = set(n.split('/')[0] for n in tar.getnames()
+                            if n.endswith('/layer.tar'))
+        with self._lock:
+            self.imported.setdefault(repo_id, []).append(data)
+            self.repos[repo_id].update(layer_ids)
+            for layer_id in layer_ids:
+                self.units.setdefault(layer_id, set()).add(repo_id)
+        return 202, self._task()
+
+    def publish(self, match, body):
+        if match.group(1) not in self.repos:
+            return 404, {'error_message': 'Missing resource'}
+        return 202, self._task()
+
+    def associate(self, match, body):
+        repo_id = match.group(1)
+        source = body['source_repo_id']
+        ids = body['criteria']['filters']['unit']['image_id']['$in']
+        with self._lock:
+            for layer_id in ids:
+                if source in self.units.get(layer_id, ()):
+                    self.repos[repo_id].add(layer_id)
+                    self.units[layer_id].add(repo_id)
+        return 202, self._task()
+
+    def search(self, match, body):
+        ids = body['criteria']['filters']['image_id']['$in']
+        with self._lock:
+            return 200, [{'image_id': i,
+                          'repository_memberships': sorted(self.units[i])}
+                         for i in ids if i in self.units]
+
+    def new_upload(self, match, body):
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.uploads[upload_id] = {}
+        return 201, {'upload_id': upload_id,
+                     '_href': '{0}/content/uploads/{1}/'.format(API,
+                                                                upload_id)}
+
+    def list_uploads(self, match, body):
+        with self._lock:
+            return 200, {'upload_ids': sorted(self.uploads)}
+
+    def put_chunk(self, match, body):
+        with self._lock:
+            chunks = self.uploads.get(match.group(1))
+            if chunks is None:
+                return 404, {'error_message': 'Missing resource'}
+            chunks[int(match.group(2))] = body
+        return 200, None
+
+    def delete_upload(self, match, body):
+        with self._lock:
+            if self.uploads.pop(match.group(1), None) is None:
+                return 404, {'error_message': 'Missing resource'}
+        return 200, None
+
+    def get_task(self, match, body):
+        task_id = match.group(1)
+        with self._lock:
+            if task_id not in self.tasks:
+                return 404, {'error_message': 'Missing resource'}
+            self.tasks[task_id] -= 1
+            running = self.tasks[task_id] > 0
+        return 200, {'task_id': task_id,
+                     'state': 'running' if running else 'finished'}
+
+    ROUTES = [
+        ('GET', r'/status/$', 'status'),
+        ('POST', r'/repositories/$', 'create_repo'),
+        ('GET', r'/repositories/([^/]+)/$', 'get_repo'),
+        ('POST', r'/repositories/([^/]+)/actions/import_upload/$',
+         'import_upload'),
+        ('POST', r'/repositories/([^/]+)/actions/publish/$', 'publish'),
+        ('POST', r'/repositories/([^/]+)/actions/associate/$', 'associate'),
+        ('POST', r'/content/units/docker_image/search/$', 'search'),
+        ('POST', r'/content/uploads/$', 'new_upload'),
+        ('GET', r'/content/uploads/$', 'list_uploads'),
+        ('PUT', r'/content/uploads/([^/]+)/(\d+)/$', 'put_chunk'),
+        ('DELETE', r'/content/uploads/([^/]+)/$', 'delete_upload'),
+        ('GET', r'/tasks/([^/]+)/$', 'get_task'),
+    ]
+
+    def handle(self, method, path, body):
+        """Returns the status and JSON body of the response to a request"""
+        time.sleep(self.latency)
+        self.transfer(len(body))
+        if self.inject_error(method):
+            return 503, {'error_message': 'Injected failure'}
+        for route_method, pattern, name in self.ROUTES:
+            match = re.match(re.escape(API) + pattern, path)
+            if match and route_method == method:
+                self.count(method, name)
+                if method == 'POST':
+                    body = json.loads(body.decode('utf-8') or 'null')
+                return getattr(self, name)(match, body)
+        return 404, {'error_message': 'No route {0} {1}'.format(method,
+                                                                path)}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Keep connections alive, as pulp does, so connection pooling counts.
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, r_json = self.server.fake.handle(self.command, self.path,
+                                                 body)
+        data = json.dumps(r_json).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+def _layer_tar(size, rnd, compressible):
+    """
+    Returns a layer.tar holding one file of size bytes, of which a share
+    compressible is zeros and the rest random.
+    """
+    zeros = int(size * compressible)
+    # Repeating a block longer than the gzip window keeps it incompressible.
+    block = bytes(bytearray(rnd.getrandbits(8) for _ in range(65536)))
+    noise = block * ((size - zeros) // len(block) + 1)
+    content = noise[:size - zeros] + b'\0' * zeros
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode='w')
+    info = tarfile.TarInfo('data')
+    info.size = len(content)
+    tar.addfile(info, io.BytesIO(content))
+    tar.close()
+    return buf.getvalue()
+
+
+def synthetic_save(size, layers=4, compressible=0.5, seed=0):
+    """
+    Returns the layer ids, topmost first, and a 'docker save' stream of
+    about size bytes, spread over layers layers.
+    """
+    rnd = random.Random(seed)
+    ids, files, parent = [], [], None
+    for n in range(layers):
+        layer_id = hashlib.sha256('{0}-{1}'.format(seed, n).encode(
+            'utf-8')).hexdigest()
+        files.append((layer_id + '/json',
+                      json.dumps({'id': layer_id, 'parent': parent})))
+        files.append((layer_id + '/layer.tar',
+                      _layer_tar(size // layers, rnd, compressible)))
+        ids.insert(0, layer_id)
+        parent = layer_id
+    files.reverse()
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode='w')
+    for name, content in files:
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    tar.close()
+    return ids, buf.getvalue()
+
+
+class FakeDocker(object):
+
+    """A docker client holding images made by synthetic_save"""
+
+    def __init__(self):
+        self.images = {}
+        self.diff_ids = {}
+        self.reads = 0
+
+    def add(self, name, layer_ids, save):
+        self.images[name] = (layer_ids, save)
+        with tarfile.open(fileobj=io.BytesIO(save)) as tar:
+            digests = dict((m.name.split('/')[0], 'sha256:' + hashlib.sha256(
+                tar.extractfile(m).read()).hexdigest())
+                for m in tar if m.name.endswith('/layer.tar'))
+        self.diff_ids[name] = [digests[i] for i in reversed(layer_ids)]
+
+    def get_image(self, image):
+        self.reads += 1
+        return io.BytesIO(self.images[image][1])
+
+    def inspect_image(self, image):
+        layer_ids, save = self.images[image]
+        return {'Id': 'sha256:' + layer_ids[0], 'VirtualSize': len(save),
+                'RootFS': {'Type': 'layers',
+                           'Layers': self.diff_ids[image]}}
+
+    def history(self, image):
+        # As docker 1.10 and later list pulled images.
+        layer_ids = self.images[image][0]
+        return [{'Id': 'sha256:' + layer_ids[0]}] + \
+            [{'Id': '<missing>'} for _ in layer_ids[1:]]
@@ -0,0 +1,61 @@
+import unittest
+
+from Atomic import atomic
+from Atomic import images
+from test_images import FakeImagesClient, LISTING, image
+
+
+class FakeAtomicClient(FakeImagesClient):
+    """Lists and inspects images as docker does for Atomic"""
+    def images(self, all=False):
+        return [dict(i) for i in self.listing
+                if all or i['RepoTags'] != ['<none>:<none>']]
+
+    def inspect_image(self, image_id):
+        for i in self.listing:
+            if image_id in [i['Id']] + i['RepoTags']:
+                return {'Id': i['Id'], 'Parent': i['ParentId'],
+                        'Config': {'Labels': i.get('Labels')}}
+
+
+def make_atomic(client, name=None):
+    a = atomic.Atomic()
+    a.d = client
+    a.image = name
+    return a
+
+
+class TestAtomic(unittest.TestCase):
+    def test_tags_are_looked_up_per_instance(self):
+        client = FakeAtomicClient(LISTING)
+        first = make_atomic(client)
+        self.assertEqual(first._find_repo_tag('app'), 'app:latest')
+        client.listing = [image('app', 'b1', ['app:2'])]
+        self.assertEqual(make_atomic(client)._find_repo_tag('app'), 'app:2')
+        # Every instance keeps the listing it took.
+        self.assertEqual(first._find_repo_tag('app'), 'app:latest')
+
+    def test_verify_reports_topmost_layer_and_newest_version(self):
+        def mid(version):
+            return {'Name': 'mid', 'Version': version, 'Release': '1'}
+
+        # Both layers below app are out of date.
+        listing = [image('b1', labels={'Name': 'base', 'Version': '1'}),
+                   image('m1', 'b1', labels=mid('1')),
+                   image('app', 'm1', ['app:latest'], {'Name': 'app'}),
+                   image('m3', tags=['mid:3'], labels=mid('3')),
+                   image('m2', tags=['mid:2'], labels=mid('2')),
+                   image('b2', tags=['base:2'],
+                         labels={'Name': 'base', 'Version': '2'})]
+        warning = make_atomic(FakeAtomicClient(listing), 'app').verify()
+        self.assertTrue(warning.startswith(
+            "Image 'app' contains a layer 'mid-1-1' that is out of date.\n"
+            "Image version 'mid-3-1' is available"))
+        index = images.ImageIndex(FakeAtomicClient(listing))
+        self.assertEqual(index.verify('app', 'app'), warning)
+        self.assertEqual(make_atomic(FakeAtomicClient(listing),
+                                     'mid:3').verify(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+import requests
+import unittest
+
+import docker
+
+from Atomic import cache
+
+
+class FakeEventsClient(object):
+    """Streams events, knowing images by Id or tag, with Name labels"""
+    def __init__(self, events, images):
+        self._events = events
+        self.images = images
+
+    def events(self, decode=False):
+        return iter(self._events)
+
+    def inspect_image(self, ref):
+        for image in self.images:
+            if ref in (image['Id'], image['Tag']) or \
+                    ref + ':latest' == image['Tag']:
+                return {'Id': image['Id'],
+                        'Config': {'Labels': {'Name': image['Name']}}}
+        response = requests.Response()
+        response.status_code = 404
+        response._content = b'No such image: ' + ref.encode('utf-8')
+        raise docker.errors.APIError('404', response)
+
+
+class TestAtomicCache(unittest.TestCase):
+    def active_cache(self, size=cache.CACHE_SIZE):
+        c = cache.ResultCache(size)
+        c.activate()
+        return c
+
+    def test_least_recently_used_are_evicted(self):
+        c = self.active_cache(2)
+        c.put('a', 1, [], c.generation)
+        c.put('b', 2, [], c.generation)
+        self.assertEqual(c.get('a'), 1)
+        c.put('c', 3, [], c.generation)
+        self.assertEqual((c.get('a'), c.get('b'), c.get('c')), (1, None, 3))
+        self.assertEqual((c.hits, c.misses), (3, 1))
+
+    def test_invalidate_drops_dependents(self):
+        c = self.active_cache()
+        c.put('a', 1, ['id:1', 'name:fedora'], c.generation)
+        c.put('b', 2, ['id:2'], c.generation)
+        c.invalidate(['name:fedora'])
+        self.assertEqual((c.get('a'), c.get('b')), (None, 2))
+
+    def test_results_computed_across_changes_are_not_kept(self):
+        c = self.active_cache()
+        generation = c.generation
+        c.invalidate(['id:1'])
+        c.put('a', 1, ['id:1'], generation)
+        self.assertEqual(c.get('a'), None)
+
+        c.put('a', 1, ['id:1'], c.generation)
+        c.activate(False)
+        self.assertEqual(c.get('a'), None)
+        c.put('a', 1, ['id:1'], c.generation)
+        c.activate()
+        self.assertEqual(len(c), 0)
+
+    def test_watch_events(self):
+        client = FakeEventsClient(
+            [{'status': 'pull', 'id': 'fedora'},
+             {'status': 'create', 'id': 'container'},
+             {'Type': 'image', 'status': 'delete', 'id': 'sha256:9'}],
+            [{'Id': 'sha256:3', 'Tag': 'fedora:latest', 'Name': 'base'}])
+        c = cache.ResultCache()
+        changes = []
+
+        def changed():
+            changes.append(sorted(c._entries))
+
+        def fill(active=True):
+            c.active = active
+            c.put('version-1', 'x', ['id:1', 'tag:fedora:latest'],
+                  c.generation)
+            c.put('version-2', 'x', ['id:2'], c.generation)
+            c.put('verify-2', 'x', ['id:2', 'name:base'], c.generation)
+            c.put('verify-5', 'x', ['id:5', 'deleted'], c.generation)
+
+        c.activate = fill
+        cache.watch_events(client, c, changed)
+        # The pull drops what depends on the tag or the Name of the image,
+        # the delete what may have seen the deleted image.
+        self.assertEqual(changes, [['verify-5', 'version-2'],
+                                   ['version-2']])
+        self.assertFalse(c.active)
+
+    def test_event_keys(self):
+        client = FakeEventsClient([], [{'Id': 'sha256:3', 'Tag': 'f:1',
+                                        'Name': 'base'}])
+        self.assertEqual(
+            cache.event_keys(client, {'status': 'tag', 'id': 'sha256:3',
+                                      'Actor': {'Attributes': {
+                                          'name': 'f:1'}}}),
+            set(['tag:sha256:3', 'tag:f:1', 'id:3', 'name:base', 'images']))
+        self.assertEqual(
+            cache.event_keys(client, {'status': 'delete', 'id': '0123'}),
+            set(['tag:0123', 'tag:0123:latest', 'id:0123', 'deleted',
+                 'images']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from Atomic import diff
+from Atomic import manifest
+from test_layers import IMAGE, make_save
+
+
+class ImagesClient(object):
+    def __init__(self, images):
+        self.images = images
+        self.reads = 0
+
+    def get_image(self, image):
+        self.reads += 1
+        ids = ['layer0', 'layer1', image]
+        return io.BytesIO(make_save(self.images[image], ids=ids))
+
+    def inspect_image(self, image):
+        return {'Id': 'sha256:' + image}
+
+
+class TestAtomicDiff(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_common_ancestor(self):
+        self.assertEqual(diff.common_ancestor(['c', 'b', 'a'], ['d', 'a']),
+                         (2, 1))
+        self.assertEqual(diff.common_ancestor(['b'], ['a']), (1, 1))
+
+    def test_diff_images_compares_divergent_layers(self):
+        client = ImagesClient({
+            'old': IMAGE + [[('etc', None), ('etc/hosts', 'a'),
+                             ('usr', None), ('usr/.wh.lib', '')]],
+            'new': IMAGE + [[('etc', None), ('etc/hosts', 'b'),
+                             ('etc/new', 'x')]]})
+        cache = manifest.ManifestCache(client, self.tmpdir)
+        changes = diff.diff_images(client, 'old', 'new', cache)
+        self.assertEqual(changes.lines(),
+                         ['C /etc/hosts', 'A /etc/new', 'A /usr/lib',
+                          'A /usr/lib/os-release'])
+        self.assertEqual(diff.diff_images(client, 'old', 'old', cache)
+                         .lines(), [])
+
+    def test_diff_trees(self):
+        a, b = os.path.join(self.tmpdir, 'a'), os.path.join(self.tmpdir, 'b')
+        for root in (a, b):
+            os.makedirs(os.path.join(root, 'etc'))
+            with open(os.path.join(root, 'etc/same'), 'w') as f:
+                f.write('same')
+            with open(os.path.join(root, 'etc/hosts'), 'w') as f:
+                f.write('hosts ' + root[-1])
+        os.makedirs(os.path.join(a, 'var/lib'))
+        open(os.path.join(a, 'var/lib/db'), 'w').close()
+        os.symlink('hosts', os.path.join(b, 'etc/link'))
+        changes = diff.diff_trees(a, b, workers=2)
+        self.assertEqual(changes.lines(),
+                         ['C /etc/hosts', 'A /etc/link', 'D /var',
+                          'D /var/lib', 'D /var/lib/db'])
+        changes = diff.diff_trees(a, b, paths=['etc/hosts', 'etc/same'])
+        self.assertEqual(changes.lines(), ['C /etc/hosts'])
+        # As docker diff lists them, with the contents of new directories.
+        changes = diff.diff_trees(a, b, paths=['etc', 'etc/hosts',
+                                               'etc/link', 'var', 'var/lib',
+                                               'var/lib/db'])
+        self.assertEqual(changes.lines(),
+                         ['C /etc/hosts', 'A /etc/link', 'D /var',
+                          'D /var/lib', 'D /var/lib/db'])
+
+    def test_diff_unmounts_images_without_a_cache(self):
+        class Client(object):
+            def containers(self, all=False):
+                return [{'Id': 'c1', 'Names': ['/web']}]
+
+            def images(self, all=False):
+                return [{'Id': 'sha256:i1', 'RepoTags': ['app:latest']}]
+
+            def inspect_container(self, uuid):
+                return {'Image': 'sha256:other'}
+
+        class Mounted(object):
+            def __init__(self, uuid):
+                self.uuid = uuid
+
+            def unmount(self):
+                mounts.remove(self.uuid)
+
+        def fake_mount(client, uuid, tmpdir):
+            mounts.append(uuid)
+            root = os.path.join(tmpdir, uuid.split(':')[-1])
+            os.mkdir(root)
+            return Mounted(uuid), root
+
+        mounts = []
+        saved = diff._mount, os.geteuid
+        diff._mount, os.geteuid = fake_mount, lambda: 0
+        try:
+            changes = diff.diff(Client(), 'app', 'web')
+        finally:
+            diff._mount, os.geteuid = saved
+        self.assertEqual(changes.lines(), [])
+        self.assertEqual(mounts, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+
+from Atomic import images
+
+
+def image(image_id, parent='', tags=None, labels=None):
+    entry = {'Id': image_id, 'ParentId': parent,
+             'RepoTags': tags or [images.NO_TAG]}
+    if labels is not None:
+        entry['Labels'] = labels
+    return entry
+
+
+class FakeImagesClient(object):
+    def __init__(self, listing):
+        self.listing = listing
+        self.inspected = []
+
+    def images(self, all=False):
+        return [dict(i) for i in self.listing]
+
+    def inspect_image(self, image_id):
+        self.inspected.append(image_id)
+        return {'Config': {'Labels': {'Name': 'old'}}}
+
+
+def base(version):
+    return {'Name': 'base', 'Version': version, 'Release': '1'}
+
+
+LISTING = [
+    image('b1', labels=base('1')),
+    image('app', 'b1', ['app:latest'],
+          {'Name': 'app', 'Version': '3', 'Release': '1'}),
+    image('b2', labels=base('2')),
+    image('base', 'b2', ['base:latest'], base('2')),
+    image('plain', tags=['plain:latest'], labels={}),
+]
+
+
+class TestAtomicImages(unittest.TestCase):
+    def test_version_string(self):
+        self.assertEqual(images.version_string(base('2')), 'base-2-1')
+        self.assertEqual(images.version_string({'Name': 'x'}), 'x')
+        self.assertEqual(images.version_string(None), '')
+
+    def test_chain_and_tags(self):
+        index = images.ImageIndex(FakeImagesClient(LISTING))
+        self.assertEqual([i['Id'] for i in index.images],
+                         ['app', 'base', 'plain'])
+        self.assertEqual(index.chain('app'), [
+            {'Id': 'app', 'Name': 'app', 'Version': 'app-3-1',
+             'Tag': 'app:latest'},
+            {'Id': 'b1', 'Name': 'base', 'Version': 'base-1-1', 'Tag': ''}])
+
+    def test_verify(self):
+        index = images.ImageIndex(FakeImagesClient(LISTING))
+        warning = index.verify('app')
+        self.assertTrue(warning.startswith(
+            "Image 'app:latest' contains a layer 'base-1-1' that is out of "
+            "date.\nImage version 'base-2-1' is available"))
+        self.assertEqual(index.verify('base'), '')
+        self.assertEqual(index.verify('plain'), '')
+
+    def test_labels_of_old_dockers_are_inspected(self):
+        client = FakeImagesClient([image('old', tags=['old:1'])])
+        index = images.ImageIndex(client)
+        self.assertEqual(index.layer('old')['Name'], 'old')
+        index.layer('old')
+        self.assertEqual(client.inspected, ['old'])
+
+    def test_find_looks_up_names_as_docker_does(self):
+        listing = LISTING + [
+            image('sha256:c0ffee01', tags=['reg.io:5000/app:2']),
+            image('sha256:c0ffee02', tags=['app:2'])]
+        index = images.ImageIndex(FakeImagesClient(listing))
+        self.assertEqual(index.find('app'), 'app')
+        self.assertEqual(index.find('app:2'), 'sha256:c0ffee02')
+        self.assertEqual(index.find('reg.io:5000/app:2'), 'sha256:c0ffee01')
+        self.assertEqual(index.find('b1'), 'b1')
+        self.assertEqual(index.find('c0ffee01'), 'sha256:c0ffee01')
+        self.assertEqual(index.find('sha256:c0ffee02'), 'sha256:c0ffee02')
+        # Ambiguous, and no image at all.
+        self.assertEqual(index.find('c0ffee'), None)
+        self.assertEqual(index.find('app:3'), None)
+        self.assertEqual(index.find('b'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+import hashlib
+import io
+import json
+import tarfile
+import unittest
+
+from Atomic import layers
+
+
+def make_tar(entries):
+    """
+    Returns the bytes of a tar archive of entries, a list of
+    (name, content) for files, (name, None) for directories and
+    (name, '->target') for symlinks.
+    """
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode='w')
+    for name, content in entries:
+        info = tarfile.TarInfo(name)
+        data = None
+        if content is None:
+            info.type = tarfile.DIRTYPE
+        elif content.startswith('->'):
+            info.type = tarfile.SYMTYPE
+            info.linkname = content[2:]
+        else:
+            data = io.BytesIO(content.encode('utf-8'))
+            info.size = len(content)
+        tar.addfile(info, data)
+    tar.close()
+    return buf.getvalue()
+
+
+def make_save(image_layers, manifest=False, ids=None, order=None):
+    """
+    Returns a 'docker save' stream of image_layers, a list of entry lists
+    bottom layer first, with layer ids 'layer0', 'layer1'... or those of
+    ids. Layers are written topmost first, or in the order of their
+    positions in order.
+    """
+    ids = ids or ['layer{0}'.format(n) for n in range(len(image_layers))]
+    files = []
+    parent = None
+    for layer_id, entries in zip(ids, image_layers):
+        files.append((layer_id + '/json',
+                      json.dumps({'id': layer_id, 'parent': parent})))
+        files.append((layer_id + '/layer.tar', make_tar(entries)))
+        parent = layer_id
+    if order is None:
+        files.reverse()
+    else:
+        files = [f for n in order for f in files[2 * n:2 * n + 2]]
+    if manifest:
+        files.append(('manifest.json', json.dumps([{
+            'Layers': [l + '/layer.tar' for l in ids]}])))
+    buf = io.BytesIO()
+    tar = tarfile.open(fileobj=buf, mode='w')
+    for name, content in files:
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    tar.close()
+    return buf.getvalue()
+
+
+class FakeClient(object):
+    def __init__(self, save, iid='sha256:0123'):
+        self.save = save
+        self.iid = iid
+        self.reads = 0
+
+    def get_image(self, image):
+        self.reads += 1
+        return io.BytesIO(self.save)
+
+    def inspect_image(self, image):
+        return {'Id': self.iid}
+
+
+IMAGE = [
+    [('etc', None), ('etc/os-release', 'base'), ('etc/motd', 'hello'),
+     ('usr', None), ('usr/lib', None), ('usr/lib/os-release', 'fedora'),
+     ('var', None), ('var/cache', None), ('var/cache/a', 'a')],
+    [('etc', None), ('etc/.wh.motd', ''),
+     ('etc/os-release', '->../usr/lib/os-release'),
+     ('var', None), ('var/cache', None), ('var/cache/.wh..wh..opq', ''),
+     ('var/cache/b', 'b')],
+]
+
+
+class TestAtomicLayers(unittest.TestCase):
+    def cat(self, path, manifest=False, order=None):
+        client = FakeClient(make_save(IMAGE, manifest, order=order))
+        out = io.BytesIO()
+        layers.cat(client, 'image', path, out)
+        return out.getvalue().decode('utf-8'), client.reads
+
+    def test_cat_follows_symlinks_into_lower_layers(self):
+        self.assertEqual(self.cat('/etc/os-release'), ('fedora', 1))
+        self.assertEqual(self.cat('usr/lib/os-release', True), ('fedora', 1))
+        # The target was read before the symlink above it.
+        self.assertEqual(self.cat('/etc/os-release', order=[0, 1]),
+                         ('fedora', 2))
+
+    def test_cat_follows_symlinks_within_a_layer(self):
+        image = [[('etc', None), ('etc/os-release', '->../usr/lib/os-release'),
+                  ('usr', None), ('usr/lib', None),
+                  ('usr/lib/os-release', 'fedora')]]
+        client = FakeClient(make_save(image))
+        out = io.BytesIO()
+        layers.cat(client, 'image', '/etc/os-release', out)
+        self.assertEqual((out.getvalue(), client.reads), (b'fedora', 1))
+
+    def test_cat_honours_whiteouts(self):
+        for order in (None, [0, 1]):
+            self.assertRaises(layers.LayerError, self.cat, '/etc/motd',
+                              order=order)
+            self.assertRaises(layers.LayerError, self.cat, '/var/cache/a',
+                              order=order)
+            self.assertEqual(self.cat('/var/cache/b', order=order), ('b', 1))
+
+    def test_export_merges_subtree(self):
+        image = IMAGE + [[('var', None), ('var/cache', None),
+                          ('var/cache/c', 'c')]]
+        # Written top-down, bottom-up and in no order of the image.
+        for order in (None, [0, 1, 2], [0, 2, 1]):
+            client = FakeClient(make_save(image, order=order))
+            out = io.BytesIO()
+            layers.export(client, 'image', '/var', out)
+            out.seek(0)
+            tar = tarfile.open(fileobj=out)
+            self.assertEqual(tar.getnames(), ['var', 'var/cache',
+                                              'var/cache/b', 'var/cache/c'])
+            self.assertEqual(tar.extractfile('var/cache/b').read(), b'b')
+
+    def test_scan_keeps_only_visible_contents(self):
+        image = [[('etc', None), ('etc/big', 'x' * 100),
+                  ('etc/small', 'old')],
+                 [('etc', None), ('etc/big', 'y' * 100),
+                  ('etc/small', 'new')]]
+        for order in (None, [0, 1]):
+            scan = layers._Scan('', True, budget=50)
+            read = layers.read_save(io.BytesIO(make_save(image, order=order)),
+                                    scan.layer, scan.layers)
+            merged = scan.merged(read)
+            self.assertEqual(merged['etc/small'][1].read(), b'new')
+            # Contents over the budget are on disk, shadowed ones dropped.
+            self.assertTrue(isinstance(merged['etc/big'][1], layers._Extent))
+            self.assertEqual(merged['etc/big'][1].read(), b'y' * 100)
+            self.assertEqual(scan.free, 47)
+
+    def test_layer_order_without_manifest(self):
+        l0, l1, l2 = layers.Layer(), layers.Layer(), layers.Layer()
+        l1.parent, l2.parent = 'l0', 'l1'
+        self.assertEqual(layers.layer_order({'l1': l1, 'l0': l0, 'l2': l2}),
+                         ['l2', 'l1', 'l0'])
+
+    def test_digest_reader(self):
+        save = make_save(IMAGE, ids=['l' * 120, 'layer1'])
+        reader = layers.DigestReader(io.BytesIO(save))
+        self.assertEqual(b''.join(iter(lambda: reader.read(333), b'')), save)
+        self.assertEqual(reader.digest,
+                         'sha256:' + hashlib.sha256(save).hexdigest())
+        self.assertEqual(reader.layers['layer1'], 'sha256:' + hashlib.sha256(
+            make_tar(IMAGE[1])).hexdigest())
+        self.assertEqual(sorted(reader.layers), ['layer1', 'l' * 120])
+
+
+if __name__ == '__main__':
+    unittest.main()
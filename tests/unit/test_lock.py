@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from Atomic import lock
+
+
+class TestAtomicLock(unittest.TestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def test_lock_path_is_flat(self):
+        path = lock.lock_path('mountpoint:/mnt/a', self.lock_dir)
+        self.assertEqual(os.path.dirname(path), self.lock_dir)
+        self.assertNotEqual(path, lock.lock_path('mountpoint:/mnt:a',
+                                                 self.lock_dir))
+
+    def test_locks_exclude_threads(self):
+        held = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with lock.locked('device:a', lock_dir=self.lock_dir):
+                held.set()
+                release.wait()
+
+        t = threading.Thread(target=hold)
+        t.start()
+        held.wait()
+        try:
+            self.assertRaises(lock.LockError, self._take, 'device:a', 0.1)
+            # Unrelated locks do not wait.
+            self._take('device:b', 0)
+        finally:
+            release.set()
+            t.join()
+        self._take('device:a', 1)
+
+    def _take(self, name, timeout):
+        with lock.locked(name, timeout=timeout, lock_dir=self.lock_dir):
+            pass
+
+
+if __name__ == '__main__':
+    unittest.main()
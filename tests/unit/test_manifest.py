@@ -0,0 +1,58 @@
+import hashlib
+import shutil
+import tempfile
+import unittest
+
+from Atomic import manifest
+from test_layers import FakeClient, IMAGE, make_save
+
+
+class TestAtomicManifest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_image_manifest_applies_whiteouts(self):
+        client = FakeClient(make_save(IMAGE))
+        cache = manifest.ManifestCache(client, self.cache_dir)
+        m = cache.image_manifest('image')
+        self.assertEqual(sorted(m), ['etc', 'etc/os-release', 'usr',
+                                     'usr/lib', 'usr/lib/os-release', 'var',
+                                     'var/cache', 'var/cache/b'])
+        self.assertEqual(m['etc/os-release']['link'], '../usr/lib/os-release')
+        self.assertEqual(m['usr/lib/os-release']['sha256'],
+                         hashlib.sha256(b'fedora').hexdigest())
+
+    def test_only_new_layers_are_hashed(self):
+        hashed = []
+        hash_layer = manifest.hash_layer
+
+        def counting_hash_layer(f):
+            hashed.append(f)
+            return hash_layer(f)
+
+        manifest.hash_layer = counting_hash_layer
+        try:
+            client = FakeClient(make_save(IMAGE))
+            manifest.ManifestCache(client, self.cache_dir).image_manifest('a')
+            self.assertEqual(len(hashed), 2)
+
+            # A fresh cache object finds both layers and the chain on disk.
+            cache = manifest.ManifestCache(client, self.cache_dir)
+            cache.image_manifest('a')
+            self.assertEqual((len(hashed), client.reads), (2, 1))
+
+            child = FakeClient(make_save(IMAGE + [[('new', 'x')]]),
+                               iid='sha256:4567')
+            m = manifest.ManifestCache(child, self.cache_dir).image_manifest(
+                'b')
+            self.assertEqual(len(hashed), 3)
+            self.assertTrue('new' in m and 'etc/motd' not in m)
+        finally:
+            manifest.hash_layer = hash_layer
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,45 @@
+import contextlib
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
 from Atomic import mount
 
 
+@contextlib.contextmanager
+def unlocked(name):
+    yield
+
+
+def linear_resolve(containers, images, identifier):
+    """
+    Resolves identifier by scanning the listings, as DockerMount did before
+    IdentifierIndex.
+    """
+    cids = [c['Id'] for c in containers
+            if (any([n for n in c['Names'] or []
+                     if mount.matches(n, '/' + identifier)]) or
+                mount.matches(c['Id'], identifier + '*'))]
+    if len(cids) > 1:
+        raise mount.SelectionMatchError(identifier, cids)
+    elif len(cids) == 1:
+        return 'container', cids[0]
+    iids = [i for i in set(i['Id'] for i in images)
+            if i.startswith(identifier)]
+    if len(iids) > 1:
+        raise mount.SelectionMatchError(identifier, iids)
+    elif len(iids) == 1:
+        return 'image', iids[0]
+    tagged = mount.util.image_by_name(identifier, images=images)
+    if len(tagged) > 1:
+        raise mount.SelectionMatchError(identifier, [])
+    elif len(tagged) == 1:
+        return 'image', tagged[0]['Id']
+    raise mount.MountError(identifier)
+
+
 class TestAtomicMount(unittest.TestCase):
     def test_mount_excepts_unknown_backend(self):
         def mock_info():
@@ -33,6 +70,267 @@ class TestAtomicMount(unittest.TestCase):
                                default_con='foobar_context')
         self.assertEqual(o, ['ro', 'context="foobang_context"'])
 
+    def test_resolve_identifier_uses_listing(self):
+        m = mount.DockerMount('foobar')
+        m._idx = mount.IdentifierIndex(
+            [{'Id': 'c0ffee01', 'Names': ['/web']}],
+            [{'Id': 'abcdef01', 'RepoTags': ['fedora:22']},
+             {'Id': 'abcdef02', 'RepoTags': ['<none>:<none>']}])
+        self.assertEqual(m._resolve_identifier('web'),
+                         ('container', 'c0ffee01'))
+        self.assertEqual(m._resolve_identifier('c0ff'),
+                         ('container', 'c0ffee01'))
+        self.assertEqual(m._resolve_identifier('fedora'),
+                         ('image', 'abcdef01'))
+        self.assertRaises(mount.SelectionMatchError,
+                          m._resolve_identifier, 'abcdef')
+        self.assertRaises(mount.MountError, m._resolve_identifier, 'nope')
+
+    def test_identifier_index_matches_unindexed_resolution(self):
+        containers = [{'Id': 'aa01', 'Names': ['/web', '/db/web']},
+                      {'Id': 'aa02', 'Names': ['/db']},
+                      {'Id': 'bb01', 'Names': ['/web2']},
+                      {'Id': 'ee01', 'Names': None}]
+        images = [{'Id': 'cc01', 'RepoTags': ['fedora:22', 'fedora:latest']},
+                  {'Id': 'cc02', 'RepoTags': ['reg.io/fedora:21']},
+                  {'Id': 'dd01', 'RepoTags': ['centos:7']},
+                  {'Id': 'dd02', 'RepoTags': None}]
+        idx = mount.IdentifierIndex(containers, images)
+        self.assertEqual(idx.resolve('db'), ('container', 'aa02'))
+        self.assertEqual(idx.resolve('db/web'), ('container', 'aa01'))
+        self.assertEqual(idx.resolve('bb'), ('container', 'bb01'))
+        self.assertEqual(idx.resolve('web?'), ('container', 'bb01'))
+        self.assertEqual(idx.resolve('ee*'), ('container', 'ee01'))
+        self.assertEqual(idx.resolve('dd02'), ('image', 'dd02'))
+        self.assertEqual(idx.resolve('fedora:22'), ('image', 'cc01'))
+        self.assertEqual(idx.resolve('reg.io/fedora'), ('image', 'cc02'))
+        self.assertEqual(idx.resolve('cent*'), ('image', 'dd01'))
+        self.assertRaises(mount.SelectionMatchError, idx.resolve, 'aa')
+        self.assertRaises(mount.SelectionMatchError, idx.resolve, 'fedora')
+        self.assertRaises(mount.MountError, idx.resolve, 'fedora:20')
+
+        def outcome(resolve, identifier):
+            try:
+                return resolve(identifier)
+            except mount.MountError as e:
+                return type(e)
+
+        for identifier in ('db', 'db/web', 'web', 'web2', 'bb', 'aa', 'aa0',
+                           'aa01', 'web?', 'w*', 'ee*', 'ee01', 'cc',
+                           'cc01', 'dd02', 'fedora', 'fedora:22',
+                           'fedora:latest', 'fedora:2?', 'reg.io/fedora',
+                           'reg.io/fedora:21', 'other.io/fedora', 'cent*',
+                           'centos', 'centos:7', '*:7', 'fedora:20',
+                           'nope'):
+            self.assertEqual(
+                outcome(idx.resolve, identifier),
+                outcome(lambda i: linear_resolve(containers, images, i),
+                        identifier), identifier)
+
+    def test_mount_cache_evicts_expired_then_lru(self):
+        state = {'busy': {'refs': 1, 'last_used': 0},
+                 'old': {'refs': 0, 'last_used': 10},
+                 'older': {'refs': 0, 'last_used': 5},
+                 'fresh': {'refs': 0, 'last_used': 95}}
+        evictable = mount.MountCache._evictable
+        self.assertEqual(evictable(state, 100, 600, 4), [])
+        self.assertEqual(evictable(state, 100, 600, 4, room=1), ['older'])
+        self.assertEqual(evictable(state, 100, 600, 1, room=1),
+                         ['older', 'old', 'fresh'])
+        self.assertEqual(evictable(state, 100, 92, 4), ['older'])
+
+    def mount_cache(self, fail=False):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        mounted = []
+
+        class FakeDockerMount(object):
+            def __init__(self, mountpoint):
+                self.mountpoint = mountpoint
+                self.client = self
+
+            def info(self):
+                return {'Driver': 'overlay'}
+
+            def mount(self, iid):
+                if fail:
+                    raise mount.MountError('no space left')
+                mounted.append(self.mountpoint)
+
+            def unmount(self):
+                mounted.remove(self.mountpoint)
+
+        class FakeClient(object):
+            def inspect_image(self, identifier):
+                return {'Id': 'sha256:' + identifier * 8}
+
+        docker_mount = mount.DockerMount
+        mount.DockerMount = FakeDockerMount
+        self.addCleanup(setattr, mount, 'DockerMount', docker_mount)
+        cache = mount.MountCache(state_file=os.path.join(root, 'state.json'),
+                                 mount_dir=os.path.join(root, 'mounts'),
+                                 lock_dir=os.path.join(root, 'locks'))
+        cache.client = FakeClient()
+        cache._is_mounted = lambda path: path in mounted
+        return cache, mounted
+
+    def test_mount_cache_reuses_mounts(self):
+        cache, mounted = self.mount_cache()
+        root = cache.acquire('ab')
+        self.assertEqual(cache.acquire('ab'), root)
+        self.assertEqual(len(mounted), 1)
+        cache.release('ab')
+        cache.release('ab')
+        # Idle, but not expired.
+        self.assertEqual(len(mounted), 1)
+        cache.evict(all_idle=True)
+        self.assertEqual(mounted, [])
+        self.assertFalse(os.path.exists(root))
+
+    def test_mount_cache_drops_references_of_dead_processes(self):
+        cache, mounted = self.mount_cache()
+        cache.acquire('ab')
+        with open(cache.state_file) as f:
+            state = json.load(f)
+        for entry in state.values():
+            # Past the largest pid linux hands out.
+            entry['holders'] = {'4194305': 1}
+        with open(cache.state_file, 'w') as f:
+            json.dump(state, f)
+        cache.evict(all_idle=True)
+        self.assertEqual(mounted, [])
+
+    def test_mount_cache_cleans_up_failed_mounts(self):
+        cache, mounted = self.mount_cache(fail=True)
+        self.assertRaises(mount.MountError, cache.acquire, 'ab')
+        self.assertEqual(os.listdir(cache.mount_dir), [])
+        with open(cache.state_file) as f:
+            self.assertEqual(json.load(f), {})
+
+    def test_unmount_many_removes_only_created_mountpoints(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        created = mount.CREATED_MOUNTPOINTS
+        mount.CREATED_MOUNTPOINTS = os.path.join(root, 'mount-many.json')
+        self.addCleanup(setattr, mount, 'CREATED_MOUNTPOINTS', created)
+
+        class FakeMount(mount.DockerMount):
+            def _resolve_identifier(self, identifier):
+                return 'image', identifier * 4
+
+            def _share_listing(self, other):
+                pass
+
+            def mount(self, identifier, options=[]):
+                self._make_mountpoint(identifier)
+                return self.mountpoint
+
+            def unmount(self):
+                self._remove_mountpoint()
+
+        mountpoints = FakeMount.mount_many(['ab', 'cd'], root)
+        mine = os.path.join(root, 'mine')
+        os.mkdir(mine)
+        FakeMount.unmount_many(list(mountpoints.values()) + [mine])
+        self.assertEqual(sorted(os.listdir(root)),
+                         ['mine', 'mount-many.json', 'mount-many.json.lock'])
+        with open(mount.CREATED_MOUNTPOINTS) as f:
+            self.assertEqual(json.load(f), [])
+
+    def test_overlay2_lowerdir_uses_short_links_when_too_long(self):
+        root = tempfile.mkdtemp()
+        try:
+            dirs = []
+            for n in range(64):
+                layer = os.path.join(root, '{0:064x}'.format(n))
+                os.mkdir(layer)
+                with open(os.path.join(layer, 'link'), 'w') as f:
+                    f.write('L{0:025d}\n'.format(n))
+                dirs.append(os.path.join(layer, 'diff'))
+            lowerdir, cwd = mount.DockerMount._overlay2_lowerdir(dirs[:2])
+            self.assertEqual(lowerdir, 'lowerdir=' + ':'.join(dirs[:2]))
+            self.assertEqual(cwd, None)
+            lowerdir, cwd = mount.DockerMount._overlay2_lowerdir(dirs)
+            self.assertEqual(cwd, root)
+            self.assertTrue(lowerdir.startswith(
+                'lowerdir=l/L{0:025d}:l/L{1:025d}:'.format(0, 1)))
+        finally:
+            shutil.rmtree(root)
+
+    def fake_subp(self, outputs):
+        """
+        Replaces util.subp with one which records the commands run and
+        answers them from outputs, keyed by their first two words.
+        """
+        commands = []
+
+        def subp(cmd, cwd=None):
+            commands.append(cmd)
+            r = outputs.get(' '.join(cmd[:2]), (0, ''))
+            return mount.util.ReturnTuple(r[0], stdout=r[1], stderr=r[1])
+
+        subp_, device_lock = mount.util.subp, mount._device_lock
+        mount.util.subp = subp
+        mount._device_lock = unlocked
+        self.addCleanup(setattr, mount.util, 'subp', subp_)
+        self.addCleanup(setattr, mount, '_device_lock', device_lock)
+        return commands
+
+    def test_create_thin_snapshot_allocates_below_used_ids(self):
+        pool = 'docker-253:0-1-pool'
+        listing = ('docker-253:0-1-snap-16777200-c0ffee\t(253:3)\n'
+                   'docker-253:0-1-snap-16777210-c0ffee\t(253:4)\n'
+                   'docker-253:0-2-snap-12-c0ffee\t(253:5)\n'
+                   'docker-253:0-1-snap-x-c0ffee\t(253:6)\n'
+                   'vg-my-snap-data\t(253:7)\n')
+        commands = self.fake_subp({
+            'dmsetup ls': (0, listing),
+            'dmsetup message': (1, 'File exists')})
+        self.assertRaises(mount.MountError, mount.Mount._create_thin_snapshot,
+                          pool, 7, 'docker-253:0-1-c0ffee')
+        tried = [c[4] for c in commands if c[1] == 'message']
+        self.assertEqual(tried[:2], ['create_snap 16777199 7',
+                                     'create_snap 16777198 7'])
+        self.assertEqual(len(tried), 64)
+
+        commands = self.fake_subp({'dmsetup ls': (0, 'No devices found')})
+        self.assertEqual(mount.Mount._create_thin_snapshot(
+            pool, 7, 'docker-253:0-1-c0ffee'), mount.THIN_ID_MAX)
+
+    def test_mount_devicemapper_image_activates_image_device(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        commands = self.fake_subp({'lsblk -o': (0, 'xfs\n')})
+
+        class FakeClient(object):
+            def inspect_image(self, iid):
+                return {'GraphDriver': {'Data': {'DeviceId': '12',
+                                                 'DeviceSize': '1024'}}}
+
+        m = mount.DockerMount(root, mnt_mkdir=True)
+        m.client = FakeClient()
+        m._mount_devicemapper_image('abcdef01', [], 'docker-253:0-1-pool')
+        device = 'docker-253:0-1-image-abcdef01'
+        self.assertEqual(m.mountpoint, os.path.join(root, 'abcdef01'))
+        create = commands[0]
+        self.assertEqual(create[:3], ['dmsetup', 'create', device])
+        self.assertEqual(create[-1], '--readonly')
+        self.assertEqual(create[4],
+                         '0 2 thin /dev/mapper/docker-253:0-1-pool 12')
+        options = commands[-1][2].split(',')
+        self.assertEqual(options[:5], ['ro', 'nosuid', 'nodev',
+                                       options[3], 'nouuid'])
+        self.assertEqual(commands[-1][3:], ['/dev/mapper/' + device,
+                                            m.mountpoint])
+
+        # A failed mount leaves no mountpoint behind.
+        self.fake_subp({'mount -o': (1, 'bad superblock')})
+        m = mount.DockerMount(root, mnt_mkdir=True)
+        m.client = FakeClient()
+        self.assertRaises(mount.MountError, m._mount_devicemapper_image,
+                          'abcdef02', [], 'docker-253:0-1-pool')
+        self.assertEqual(os.listdir(root), ['abcdef01'])
+
     def test_not_implemented_container_backend(self):
         m = mount.Mount('foobar')
         self.assertRaises(NotImplementedError, m.mount, '')
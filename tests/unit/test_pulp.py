@@ -0,0 +1,487 @@
+import hashlib
+import gzip
+import io
+import os
+import requests
+import shutil
+import tarfile
+import tempfile
+import threading
+import unittest
+
+import Atomic
+from Atomic import config
+from Atomic import pulp
+from fake_pulp import FakeDocker, FakePulp, synthetic_save
+from test_layers import FakeClient, IMAGE, make_save
+
+
+class FakeResponse(object):
+    reason = 'Service Unavailable'
+    headers = {}
+
+    def __init__(self, r_json=None, status_code=200, text='null'):
+        self.r_json = r_json
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        if self.text != 'null':
+            raise ValueError('No JSON object could be decoded')
+        return self.r_json
+
+
+class FlakySession(object):
+    """Answers every call with the next of responses"""
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = 0
+
+    def request(self, *args, **kwargs):
+        self.calls += 1
+        r = self.responses.pop(0)
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+    get = put = post = delete = request
+
+
+class FakeSession(object):
+    def __init__(self, fail_at=None):
+        self.chunks = {}
+        self.fail_at = fail_at
+        self.lock = threading.Lock()
+
+    def get(self, url, timeout):
+        # Every task finishes on its third poll.
+        self.polls = getattr(self, 'polls', {})
+        self.polls[url] = self.polls.get(url, 0) + 1
+        task = {'task_id': url, 'state': 'running'}
+        if self.polls[url] == 3:
+            task['state'] = 'error' if 'bad' in url else 'finished'
+            task['error'] = {'description': 'no space left'}
+        return FakeResponse(task)
+
+    def put(self, url, data, timeout):
+        offset = int(url.rstrip('/').rsplit('/', 1)[1])
+        if offset == self.fail_at:
+            raise IOError('connection reset')
+        with self.lock:
+            self.chunks[offset] = data
+        return FakeResponse()
+
+    def close(self):
+        pass
+
+
+class RecordingServer(object):
+    """
+    Records the calls push_images_to_pulp makes, failing image 'bad' and
+    repositories 'broken' and 'flaky'
+    """
+    def __init__(self):
+        self.calls = []
+        self.stats = pulp.UploadStats()
+
+    def ensure_repo(self, image, repo):
+        self.calls.append(('ensure', repo))
+        if repo == 'broken':
+            raise IOError('no route to host')
+
+    def is_repo(self, repo):
+        if repo == 'flaky':
+            raise IOError('connection reset')
+        return True
+
+    def upload_docker_image(self, image, repo, resume=False):
+        if image == 'bad':
+            raise IOError('broken pipe')
+        self.calls.append(('upload', image))
+
+    def publish_repo(self, repo, wait=True):
+        self.calls.append(('publish', repo))
+        return [{'_href': '/publish/' + repo}]
+
+    def export_repo(self, repo, wait=True):
+        self.calls.append(('export', repo))
+        return [{'_href': '/export/' + repo}]
+
+    def wait_for_tasks(self, tasks):
+        self.calls.append(('wait', len(tasks)))
+        return dict((t['_href'], 1.0) for t in tasks)
+
+
+def make_server(session, **kwargs):
+    server = pulp.PulpServer('http://pulp', 'u', 'p', False, None, **kwargs)
+    server._session = session
+    return server
+
+
+class TestAtomicPulp(unittest.TestCase):
+    def setUp(self):
+        self.poll_min, self.retry_min = pulp.TASK_POLL_MIN, pulp.RETRY_MIN
+        pulp.TASK_POLL_MIN = pulp.RETRY_MIN = 0.001
+
+    def tearDown(self):
+        pulp.TASK_POLL_MIN, pulp.RETRY_MIN = self.poll_min, self.retry_min
+
+    def test_transient_failures_are_retried(self):
+        session = FlakySession([
+            requests.ConnectionError('reset'),
+            FakeResponse(status_code=503, text='<html>busy</html>'),
+            FakeResponse()])
+        server = make_server(session)
+        self.assertEqual(server._call_pulp('http://pulp/x/', 'put', b'ab'),
+                         None)
+        summary = server.stats.summary()
+        self.assertEqual(summary['calls'], {
+            'put': {'calls': 1, 'retries': 2, 'failures': 2,
+                    'seconds': server.stats.calls['put']['seconds']}})
+        self.assertEqual(summary['bytes_put'], 2)
+        # Only the successful attempt is in the latency histogram.
+        self.assertEqual(sum(summary['put_latency'].values()), 1)
+
+    def test_fatal_failures_are_not_retried(self):
+        session = FlakySession([FakeResponse(status_code=404,
+                                             text='<html>gone</html>')])
+        server = make_server(session)
+        try:
+            server._call_pulp('http://pulp/x/')
+            self.fail('PulpError not raised')
+        except pulp.PulpError as e:
+            self.assertEqual(e.status_code, 404)
+            self.assertTrue('gone' in str(e))
+        # Pulp may have acted on a POST which timed out.
+        session = FlakySession([requests.ReadTimeout('slow'), FakeResponse()])
+        self.assertRaises(pulp.PulpError, make_server(session)._call_pulp,
+                          'http://pulp/x/', 'post', {})
+        self.assertEqual(session.calls, 1)
+
+    def test_wait_for_tasks(self):
+        session = FakeSession()
+        server = make_server(session)
+        finished = server.wait_for_tasks([{'_href': '/tasks/1/'},
+                                          {'_href': '/tasks/2/'}])
+        self.assertEqual(sorted(finished), ['/tasks/1/', '/tasks/2/'])
+        self.assertEqual(session.polls, {'http://pulp/tasks/1/': 3,
+                                         'http://pulp/tasks/2/': 3})
+        self.assertRaisesRegexp(pulp.PulpTaskError, 'no space left',
+                                server.wait_for_tasks,
+                                [{'_href': '/tasks/bad/'}])
+        server = make_server(FakeSession(), task_timeout=0)
+        self.assertRaisesRegexp(pulp.PulpTaskError, 'Timed out',
+                                server.wait_for_tasks,
+                                [{'_href': '/tasks/1/'}])
+
+    def test_responses_without_json(self):
+        session = FlakySession([FakeResponse(),
+                                FakeResponse({'state': 'finished'})])
+        finished = make_server(session).wait_for_tasks([{'_href': '/t/'}])
+        self.assertEqual(list(finished), ['/t/'])
+        self.assertEqual(session.calls, 2)
+        server = make_server(FlakySession([FakeResponse()] * 3))
+        self.assertRaisesRegexp(Exception, 'Unable to publish',
+                                server.publish_repo, 'r')
+        self.assertRaisesRegexp(Exception, 'Unable to export',
+                                server.export_repo, 'r')
+        self.assertRaisesRegexp(Exception, 'Unable to import',
+                                server._import_upload, 'id', 'r')
+
+    def test_unknown_compression_is_refused(self):
+        home = tempfile.mkdtemp()
+        old_home = os.environ.get('HOME')
+        try:
+            os.makedirs(os.path.join(home, '.pulp'))
+            with open(os.path.join(home, '.pulp/admin.conf'), 'w') as f:
+                f.write('[upload]\ncompression = gz\n')
+            os.environ['HOME'] = home
+            self.assertRaisesRegexp(ValueError, 'compression',
+                                    config.PulpConfig)
+        finally:
+            if old_home is None:
+                del os.environ['HOME']
+            else:
+                os.environ['HOME'] = old_home
+            shutil.rmtree(home)
+        self.assertRaisesRegexp(IOError, 'Unknown compression: gz',
+                                Atomic._pulp_server, 'http://pulp', 'u',
+                                'p', False, None, 1, compression='gz')
+        for level in (0, 10):
+            self.assertRaisesRegexp(IOError, 'Unknown compress_level: {0}'
+                                    ''.format(level), Atomic._pulp_server,
+                                    'http://pulp', 'u', 'p', False, None, 1,
+                                    compress_level=level)
+
+    def test_chunks_and_workers_must_be_positive(self):
+        for option in ('chunk_size', 'upload_workers'):
+            for value in (0, -1):
+                self.assertRaisesRegexp(
+                    IOError, 'Invalid {0}: {1}'.format(option, value),
+                    Atomic._pulp_server, 'http://pulp', 'u', 'p', False,
+                    None, 1, **{option: value})
+
+    def test_parallel_chunks_land_at_their_offsets(self):
+        data = bytes(bytearray(range(256))) * 41
+        session = FakeSession()
+        server = make_server(session, chunk_size=1000, upload_workers=3)
+        server._upload_stream(pulp.UploadState(None, 'id', 'iid', 1000),
+                              io.BytesIO(data))
+        self.assertEqual(sorted(session.chunks), list(range(0, 10496, 1000)))
+        self.assertEqual(b''.join(session.chunks[o]
+                                  for o in sorted(session.chunks)), data)
+
+    def test_failed_chunk_stops_the_upload(self):
+        session = FakeSession(fail_at=3000)
+        server = make_server(session, chunk_size=1000, upload_workers=2)
+        state = pulp.UploadState(None, 'id', 'iid', 1000)
+        self.assertRaises(IOError, server._upload_stream, state,
+                          io.BytesIO(b'x' * 100000))
+        self.assertTrue(len(session.chunks) < 100)
+        self.assertEqual(sorted(int(o) for o in state.chunks),
+                         sorted(session.chunks))
+
+    def test_resume_skips_acknowledged_chunks(self):
+        data = b'a' * 2500
+        state = pulp.UploadState(None, 'id', 'iid', 1000)
+        state.acknowledge(0, hashlib.sha256(b'a' * 1000).hexdigest())
+        # Acknowledged with other contents, so uploaded again.
+        state.acknowledge(1000, hashlib.sha256(b'b' * 1000).hexdigest())
+        session = FakeSession()
+        make_server(session, chunk_size=4096)._upload_stream(
+            state, io.BytesIO(data))
+        self.assertEqual(sorted(session.chunks), [1000, 2000])
+
+    def test_batch_publishes_each_repo_once(self):
+        server = RecordingServer()
+        failures = Atomic._push_images_to_pulp(
+            server, 'https://pulp', [('a', 'r1'), ('b', 'r1'), ('bad', 'r2'),
+                                     ('c', 'r3'), ('d', 'broken'),
+                                     ('e', 'flaky')], 2, False)
+        self.assertEqual([f.split(':')[0] for f in failures],
+                         ['bad', 'd', 'e'])
+        self.assertTrue('no route to host' in failures[1])
+        self.assertTrue('connection reset' in failures[2])
+        calls = server.calls
+        self.assertEqual([c for c in calls if c[0] == 'ensure'],
+                         [('ensure', 'broken'), ('ensure', 'flaky'),
+                          ('ensure', 'r1'), ('ensure', 'r2'),
+                          ('ensure', 'r3')])
+        self.assertEqual(calls[-5:], [('publish', 'r1'), ('export', 'r1'),
+                                      ('publish', 'r3'), ('export', 'r3'),
+                                      ('wait', 4)])
+        self.assertEqual(server.stats.phases, {'publish': 1.0,
+                                               'export': 1.0})
+
+    def test_stats_summary(self):
+        stats = pulp.UploadStats()
+        for seconds in (0.01, 0.3, 0.3, 60):
+            stats.record('put', seconds, nbytes=10)
+        stats.record('put', 0.01, failed=True)
+        stats.read(100, 0.5)
+        stats.read(50, 0.25)
+        with stats.phase('import'):
+            pass
+        summary = stats.summary()
+        self.assertEqual(summary['bytes_put'], 40)
+        self.assertEqual(summary['bytes_read'], 150)
+        self.assertEqual(summary['phases']['save'], 0.75)
+        self.assertTrue('import' in summary['phases'])
+        latency = summary['put_latency']
+        self.assertEqual((latency['<=0.05'], latency['<=0.5'],
+                          latency['>30'], sum(latency.values())),
+                         (1, 2, 1, 4))
+
+    def test_progress(self):
+        out = io.StringIO()
+        progress = pulp.Progress(out).image('fedora', 2048)
+        progress.read(1024)
+        progress.uploaded()
+        progress.finish()
+        # Not a TTY: a dot per chunk and no progress line.
+        self.assertEqual(out.getvalue(), u'.\n')
+
+        out.isatty = lambda: True
+        out.seek(0)
+        out.truncate()
+        progress = pulp.Progress(out).image('fedora', 2048)
+        progress.read(1024)
+        progress.uploaded()
+        progress.finish()
+        self.assertTrue(out.getvalue().startswith(
+            u'\rfedora: 1.0 KiB of 2.0 KiB (50%)'))
+        self.assertTrue(u' left' in out.getvalue())
+
+    def test_progress_of_images_in_flight(self):
+        out = io.StringIO()
+        out.isatty = lambda: True
+        progress = pulp.Progress(out)
+        fedora = progress.image('fedora', 2048)
+        centos = progress.image('centos', 4096)
+        fedora.read(1024)
+        centos.read(1024)
+        progress._drawn = 0
+        centos.read(1024)
+        self.assertTrue(out.getvalue().rsplit(u'\r', 1)[1].startswith(
+            u'2 images: 3.0 KiB of 6.0 KiB (50%)'))
+        fedora.finish()
+        # The finished image is left on a line of its own, above the line
+        # of the images still in flight.
+        lines = out.getvalue().split(u'\n')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].rsplit(u'\r', 1)[1].startswith(
+            u'fedora: 1.0 KiB of 2.0 KiB (50%)'))
+        self.assertTrue(lines[1].startswith(
+            u'\rcentos: 2.0 KiB of 4.0 KiB (50%)'))
+        centos.finish()
+        self.assertEqual(out.getvalue().count(u'\n'), 2)
+        self.assertEqual(progress.images, [])
+
+    def test_ensure_repo(self):
+        session = FlakySession([
+            FakeResponse(status_code=404, text='{}'),
+            FakeResponse(status_code=409, text='{}')])
+        server = make_server(session)
+        server.ensure_repo('fedora', 'fedora')
+        # Known to exist now, created by someone else meanwhile.
+        self.assertTrue(server.is_repo('fedora'))
+        self.assertEqual(session.calls, 2)
+
+    def test_filter_save_through_pipe(self):
+        pipe = pulp.QueuePipe(depth=2)
+        save = make_save(IMAGE, manifest=True)
+        t = threading.Thread(target=lambda: (
+            pulp.filter_save(io.BytesIO(save), lambda l: l == 'layer0',
+                             pipe),
+            pipe.close()))
+        t.start()
+        out = b''
+        while True:
+            data = pipe.read(1000)
+            if not data:
+                break
+            out += data
+        t.join()
+        names = tarfile.open(fileobj=io.BytesIO(out)).getnames()
+        self.assertEqual(sorted(names), ['layer1/json', 'layer1/layer.tar'])
+
+    def test_compressed_upload(self):
+        session = FakeSession()
+        server = make_server(session, chunk_size=100, dedup_layers=False)
+        state = pulp.UploadState(None, 'id', 'iid', 100, compression='gzip')
+        server._docker_client = FakeClient(make_save(IMAGE))
+        server._upload_docker_image(state, 'image')
+        data = b''.join(session.chunks[o] for o in sorted(session.chunks))
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(data)).read(),
+                         make_save(IMAGE))
+
+    def test_pipe_raises_writer_errors(self):
+        pipe = pulp.QueuePipe()
+        pipe.write(b'abc')
+        pipe.fail(IOError('docker went away'))
+        self.assertRaises(IOError, pipe.read, 10)
+
+
+class TestAtomicPulpStandIn(unittest.TestCase):
+    def setUp(self):
+        self.retry_min = pulp.RETRY_MIN
+        pulp.RETRY_MIN = 0.001
+        self.state_dir = tempfile.mkdtemp()
+        self.fake = FakePulp()
+        self.fake.start()
+
+    def tearDown(self):
+        self.fake.stop()
+        shutil.rmtree(self.state_dir)
+        pulp.RETRY_MIN = self.retry_min
+
+    def push(self, images, docker, **options):
+        Atomic.push_images_to_pulp(images, self.fake.url, 'u', 'p', False,
+                                   docker, state_dir=self.state_dir,
+                                   chunk_size=65536, **options)
+
+    def test_push_image(self):
+        docker = FakeDocker()
+        layer_ids, save = synthetic_save(300000)
+        docker.add('fedora', layer_ids, save)
+        self.push(['fedora'], docker)
+        self.assertEqual(self.fake.imported['fedora'], [save])
+        self.assertEqual(self.fake.repos['fedora'], set(layer_ids))
+        self.assertEqual(self.fake.uploads, {})
+        self.assertEqual(self.fake.requests['POST publish'], 2)
+
+    def test_digests_are_checked_and_recorded(self):
+        docker = FakeDocker()
+        layer_ids, save = synthetic_save(300000, layers=2)
+        docker.add('fedora', layer_ids, save)
+        server = pulp.PulpServer(self.fake.url, 'u', 'p', False, docker,
+                                 state_dir=self.state_dir, chunk_size=65536)
+        server.ensure_repo('fedora', 'fedora')
+        server.upload_docker_image('fedora', 'fedora')
+        digests = server.stats.summary()['images']['fedora']
+        self.assertEqual(digests['digest'],
+                         'sha256:' + hashlib.sha256(save).hexdigest())
+        self.assertEqual(sorted(digests['layers'].values()),
+                         sorted(docker.diff_ids['fedora']))
+
+        docker.diff_ids['fedora'][0] = 'sha256:' + '0' * 64
+        self.assertRaisesRegexp(pulp.PulpError, 'do not match',
+                                server.upload_docker_image, 'fedora',
+                                'fedora')
+        self.assertEqual(self.fake.uploads, {})
+        self.assertEqual(len(self.fake.imported['fedora']), 1)
+
+    def test_shared_layers_are_not_uploaded_again(self):
+        docker = FakeDocker()
+        layer_ids, save = synthetic_save(300000, layers=2)
+        docker.add('base', layer_ids, save)
+        self.push(['base'], docker)
+        puts = self.fake.requests['PUT put_chunk']
+
+        child_ids, child = synthetic_save(300000, layers=3)
+        self.assertEqual(child_ids[1:], layer_ids)
+        docker.add('child', child_ids, child)
+        self.push(['child'], docker, compression='none')
+        self.assertEqual(self.fake.repos['child'], set(child_ids))
+        with tarfile.open(fileobj=io.BytesIO(
+                self.fake.imported['child'][0])) as tar:
+            self.assertEqual(set(n.split('/')[0] for n in tar.getnames()),
+                             set([child_ids[0]]))
+        self.assertTrue(self.fake.requests['PUT put_chunk'] - puts <= 2)
+
+    def test_layers_are_left_out_while_the_image_is_read(self):
+        docker = FakeDocker()
+        layer_ids, save = synthetic_save(300000, layers=2)
+        docker.add('base', layer_ids, save)
+        self.push(['base'], docker)
+        # A new top layer on base, which docker history lists as pulled.
+        child_ids, child = synthetic_save(300000, layers=3)
+        docker.add('child', child_ids, child)
+        self.assertEqual(docker.history('child')[1]['Id'], '<missing>')
+
+        state = pulp.UploadState(None, 'id', 'iid', 1)
+        server = pulp.PulpServer(self.fake.url, 'u', 'p', False, docker,
+                                 state_dir=self.state_dir)
+        self.assertEqual([server._skip_layer(state, l) for l in child_ids],
+                         [False, True, True])
+        self.assertEqual(state.upload_layers, child_ids[:1])
+        # Decided once, as a resumed upload must send the same bytes.
+        self.assertFalse(server._skip_layer(state, child_ids[0]))
+
+        reads = docker.reads
+        self.push(['child'], docker)
+        self.assertEqual(docker.reads - reads, 1)
+        self.assertEqual(self.fake.repos['child'], set(child_ids))
+
+    def test_injected_errors_are_retried(self):
+        self.fake.error_rate = 0.3
+        docker = FakeDocker()
+        layer_ids, save = synthetic_save(300000)
+        docker.add('fedora', layer_ids, save)
+        self.push(['fedora'], docker, compression='none')
+        self.assertTrue(self.fake.errors > 0)
+        self.assertEqual(self.fake.imported['fedora'], [save])
+
+
+if __name__ == '__main__':
+    unittest.main()